@@ -0,0 +1,147 @@
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import metriche
+
+# ========== AMMISSIONE ANALISI SCONTRINI ==========
+# /analizza_scontrino tiene occupato un thread di gunicorn per secondi (e, con
+# OCR_PROCESSO_DEDICATO=0, anche un core): senza limiti una raffica di scontrini
+# prende tutti i thread e le pagine restano in attesa dietro di loro.
+# Il limitatore fa entrare al più OCR_MAX_IN_CORSO immagini alla volta, ne fa
+# aspettare al più OCR_MAX_IN_ATTESA in ordine di arrivo (per non più di
+# OCR_ATTESA_MASSIMA_SECONDI) e rifiuta subito le altre: 429 se l'utente ha già
+# OCR_MAX_PER_UTENTE scontrini in analisi, 503 se la coda è piena o l'attesa
+# scade, entrambe con Retry-After.
+# OCR_MAX_IN_CORSO + OCR_MAX_IN_ATTESA va tenuto sotto i --threads di gunicorn:
+# i thread restanti servono sempre le altre rotte.
+# Con OCR_PROCESSO_DEDICATO=1 coda_ocr manda le analisi ammesse al pool prima
+# dei job in attesa: aspettano al più la fine dei job già partiti, non la coda.
+
+OCR_MAX_IN_CORSO = int(os.environ.get('OCR_MAX_IN_CORSO', '2'))
+OCR_MAX_IN_ATTESA = int(os.environ.get('OCR_MAX_IN_ATTESA', '2'))
+OCR_MAX_PER_UTENTE = int(os.environ.get('OCR_MAX_PER_UTENTE', '1'))
+OCR_ATTESA_MASSIMA_SECONDI = float(os.environ.get('OCR_ATTESA_MASSIMA_SECONDI', '15'))
+
+# Durata di un'analisi prima che ne sia stata misurata qualcuna
+DURATA_STIMATA_INIZIALE = 3.0
+
+RIFIUTO_UTENTE = 'utente'
+RIFIUTO_CODA_PIENA = 'coda_piena'
+RIFIUTO_ATTESA_SCADUTA = 'attesa_scaduta'
+
+CODICI_RIFIUTO = {
+    RIFIUTO_UTENTE: 429,
+    RIFIUTO_CODA_PIENA: 503,
+    RIFIUTO_ATTESA_SCADUTA: 503,
+}
+
+
+class StimaDurata:
+    """Media mobile della durata di un'analisi, per calcolare il Retry-After."""
+
+    def __init__(self, iniziale=DURATA_STIMATA_INIZIALE, peso=0.2):
+        self.media = iniziale
+        self.peso = peso
+        self._lock = threading.Lock()
+
+    def aggiorna(self, secondi):
+        with self._lock:
+            self.media += self.peso * (secondi - self.media)
+
+    def riprova_tra(self, davanti, posti):
+        """Secondi interi (almeno 1) prima che si liberi un posto con `davanti` analisi prima."""
+        turni = (davanti + max(1, posti)) // max(1, posti)
+        return max(1, math.ceil(self.media * turni))
+
+
+STIMA_DURATA_OCR = StimaDurata()
+
+
+def rifiuto(motivo, riprova_tra):
+    """{'motivo', 'codice_http', 'riprova_tra'} di una richiesta non ammessa."""
+    return {'motivo': motivo, 'codice_http': CODICI_RIFIUTO[motivo], 'riprova_tra': riprova_tra}
+
+
+class LimitatoreOCR:
+    """Posti limitati per le analisi sincrone, con coda d'attesa FIFO limitata e limite per utente."""
+
+    def __init__(self, max_in_corso=OCR_MAX_IN_CORSO, max_in_attesa=OCR_MAX_IN_ATTESA,
+                 max_per_utente=OCR_MAX_PER_UTENTE, attesa_massima=OCR_ATTESA_MASSIMA_SECONDI,
+                 stima=STIMA_DURATA_OCR):
+        self.max_in_corso = max(1, max_in_corso)
+        self.max_in_attesa = max_in_attesa
+        self.max_per_utente = max(1, max_per_utente)
+        self.attesa_massima = attesa_massima
+        self.stima = stima
+        self._condizione = threading.Condition()
+        self._in_corso = 0
+        self._attesa = deque()  # un biglietto per richiesta, in ordine di arrivo
+        self._per_utente = Counter()  # analisi in corso o in attesa per uid
+
+    def _aggiorna_indicatori(self):
+        metriche.OCR_IN_CORSO.imposta(self._in_corso)
+        metriche.OCR_IN_ATTESA.imposta(len(self._attesa))
+
+    def _rifiuta(self, motivo):
+        davanti = self._in_corso + len(self._attesa) - self.max_in_corso
+        return rifiuto(motivo, self.stima.riprova_tra(max(0, davanti), self.max_in_corso))
+
+    def _lascia(self, uid):
+        self._per_utente[uid] -= 1
+        if self._per_utente[uid] <= 0:
+            del self._per_utente[uid]
+
+    def entra(self, uid, posti=1):
+        """
+        Prende `posti` posti (uno per immagine da analizzare in parallelo, al più
+        max_in_corso) per un'analisi di `uid`, aspettando il proprio turno se
+        serve. Restituisce None se ammessa (va chiusa con esci() con gli stessi
+        posti), altrimenti il rifiuto da restituire al client.
+        """
+        posti = min(max(1, posti), self.max_in_corso)
+        with self._condizione:
+            if self._per_utente[uid] >= self.max_per_utente:
+                return self._rifiuta(RIFIUTO_UTENTE)
+            if self._in_corso + posti <= self.max_in_corso and not self._attesa:
+                self._per_utente[uid] += 1
+                self._in_corso += posti
+                self._aggiorna_indicatori()
+                return None
+            if len(self._attesa) >= self.max_in_attesa:
+                return self._rifiuta(RIFIUTO_CODA_PIENA)
+
+            biglietto = object()
+            self._attesa.append(biglietto)
+            self._per_utente[uid] += 1
+            self._aggiorna_indicatori()
+            inizio = time.perf_counter()
+            ammessa = self._condizione.wait_for(
+                lambda: self._attesa[0] is biglietto and self._in_corso + posti <= self.max_in_corso,
+                timeout=self.attesa_massima
+            )
+            self._attesa.remove(biglietto)
+            metriche.OCR_ATTESA.osserva(time.perf_counter() - inizio)
+            # Il prossimo biglietto ora è in testa: se c'è un posto libero può entrare
+            self._condizione.notify_all()
+            if not ammessa:
+                self._lascia(uid)
+                self._aggiorna_indicatori()
+                return self._rifiuta(RIFIUTO_ATTESA_SCADUTA)
+            self._in_corso += posti
+            self._aggiorna_indicatori()
+            return None
+
+    def esci(self, uid, posti=1):
+        """Libera i posti presi con entra()."""
+        posti = min(max(1, posti), self.max_in_corso)
+        with self._condizione:
+            self._in_corso -= posti
+            self._lascia(uid)
+            self._aggiorna_indicatori()
+            self._condizione.notify_all()
+
+
+limitatore_ocr = LimitatoreOCR()
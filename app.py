@@ -1,13 +1,21 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, g
 import firebase_admin
-from firebase_admin import credentials, auth, firestore
+from firebase_admin import credentials, auth
 import json
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
-from ocr_processor import analizza_scontrino
-from werkzeug.utils import secure_filename
-import re
+import threading
+import time
+from coda_ocr import OCR_PROCESSO_DEDICATO, coda_ocr, preriscalda_motore
+from ammissione_ocr import limitatore_ocr
+from cache_token import cache_token
+from unita_lavoro import UnitaDiLavoroDispense
+from archivio import TIMESTAMP_SERVER, crea_archivio, scadenza_come_numero
+from indice_alimenti import trova_categoria
+from scadenze import scadenze_categoria, scadenze_da_range
+import metriche
+import profilazione
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'chiave-segreta-fissa-da-cambiare-in-produzione')
@@ -15,144 +23,207 @@ app.secret_key = os.environ.get('SECRET_KEY', 'chiave-segreta-fissa-da-cambiare-
 # make routing less strict about trailing slashes
 app.url_map.strict_slashes = False
 
-# Configurazione upload
-UPLOAD_FOLDER = 'uploads'
+# Configurazione upload (gli scontrini sono analizzati in memoria, senza scriverli su disco)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Foto accettate da /analizza_scontrino/multiplo (uno scontrino lungo ripreso a pezzi)
+OCR_MAX_FOTO_SCONTRINO = int(os.environ.get('OCR_MAX_FOTO_SCONTRINO', '5'))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-if os.environ.get('FIREBASE_CREDENTIALS'):
-    firebase_creds = json.loads(os.environ.get('FIREBASE_CREDENTIALS'))
-    cred = credentials.Certificate(firebase_creds)
-elif os.path.exists('serviceAccountKey.json'):
-    cred = credentials.Certificate('serviceAccountKey.json')
-elif os.path.exists('/etc/secrets/serviceAccountKey.json'):
-    cred = credentials.Certificate('/etc/secrets/serviceAccountKey.json')
-else:
-    cred = credentials.Certificate("backend/serviceAccountKey.json")
-
-firebase_admin.initialize_app(cred)
-
-db = firestore.client()
-
-with open('food_data.json', 'r', encoding='utf-8') as f:
-    food_data = json.load(f)
-
-def trova_categoria(nome_alimento):
-    nome_lower = nome_alimento.lower().strip()
-
-    for categoria in food_data['categorie_cibi']:
-        nome_categoria = categoria['nome_categoria']
-        prodotti = categoria['prodotti']
-
-        if nome_lower in [p.lower() for p in prodotti]:
-            return nome_categoria
-
-    for categoria in food_data['categorie_cibi']:
-        nome_categoria = categoria['nome_categoria']
-        prodotti = categoria['prodotti']
-
-        for prodotto in prodotti:
-            prodotto_lower = prodotto.lower()
-            parole_prodotto = prodotto_lower.split()
-            parole_alimento = nome_lower.split()
-
-            if any(parola in parole_prodotto for parola in parole_alimento if len(parola) > 2):
-                return nome_categoria
-
-    return 'altro'
-
-def calcola_scadenza(categoria, surgelato=False):
-    """Calcola la data di scadenza basandosi sulla categoria"""
-    oggi = datetime.now()
-    
-    for cat in food_data['categorie_cibi']:
-        if cat['nome_categoria'] == categoria:
-            range_scadenza = cat['range_scadenza']
-            
-            if 'giorni' in range_scadenza and not surgelato:
-                giorni = re.findall(r'(\d+)-(\d+)\s*giorni', range_scadenza)
-                if giorni:
-                    giorni_medio = (int(giorni[0][0]) + int(giorni[0][1])) // 2
-                    return (oggi + timedelta(days=giorni_medio)).strftime('%Y-%m-%d')
-            
-            if surgelato and 'mesi' in range_scadenza:
-                mesi = re.findall(r'(\d+)-(\d+)\s*mesi', range_scadenza)
-                if mesi:
-                    mesi_medio = (int(mesi[0][0]) + int(mesi[0][1])) // 2
-                    return (oggi + timedelta(days=mesi_medio*30)).strftime('%Y-%m-%d')
-    
-    return (oggi + timedelta(days=7)).strftime('%Y-%m-%d')
+# Archivio dati: 'firestore' in produzione, 'sqlite' per lavorare in locale senza credenziali
+ARCHIVIO = os.environ.get('DISPENSA_ARCHIVIO', 'firestore')
+
+if ARCHIVIO == 'firestore':
+    if os.environ.get('FIREBASE_CREDENTIALS'):
+        firebase_creds = json.loads(os.environ.get('FIREBASE_CREDENTIALS'))
+        cred = credentials.Certificate(firebase_creds)
+    elif os.path.exists('serviceAccountKey.json'):
+        cred = credentials.Certificate('serviceAccountKey.json')
+    elif os.path.exists('/etc/secrets/serviceAccountKey.json'):
+        cred = credentials.Certificate('/etc/secrets/serviceAccountKey.json')
+    else:
+        cred = credentials.Certificate("backend/serviceAccountKey.json")
+
+    firebase_admin.initialize_app(cred)
+
+archivio = metriche.misura_archivio(crea_archivio(ARCHIVIO))
+
+# ========== PROFILAZIONE (opzionale, vedi profilazione.py) ==========
+# Hook registrati per primi: il profilo copre anche metriche e commit delle dispense
+if profilazione.PROFILAZIONE_ABILITATA:
+    profilatore = profilazione.Profilatore()
+
+    @app.before_request
+    def avvia_profilazione():
+        if profilatore.deve_profilare(request.headers.get(profilazione.HEADER_PROFILAZIONE)):
+            g.profilo = profilatore.avvia()
+            g.inizio_profilo = time.perf_counter()
+
+    @app.after_request
+    def salva_profilazione(response):
+        profilo = g.pop('profilo', None)
+        if profilo is not None:
+            rotta = request.url_rule.rule if request.url_rule else request.path
+            durata = time.perf_counter() - g.inizio_profilo
+            percorso = profilatore.salva(profilo, rotta, g.get('uid'), durata)
+            if percorso:
+                app.logger.info(f"Profilo di {rotta} salvato in {percorso}")
+        return response
+
+# ========== METRICHE ==========
+# Se impostato, /metrics richiede l'header "Authorization: Bearer <METRICHE_TOKEN>"
+METRICHE_TOKEN = os.environ.get('METRICHE_TOKEN')
+
+@app.before_request
+def inizia_metriche_richiesta():
+    metriche.inizia_richiesta(request.url_rule.rule if request.url_rule else 'sconosciuta')
+
+@app.after_request
+def registra_metriche_richiesta(response):
+    # Registrato per primo, quindi eseguito dopo gli altri after_request (commit delle dispense incluso)
+    metriche.termina_richiesta(request.method, response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if METRICHE_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICHE_TOKEN}':
+        return 'Non autorizzato', 401
+    return Response(metriche.registro.esporta(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 def verifica_autenticazione():
+    # Già verificato in questa richiesta (es. da richiede_autenticazione)
+    if 'uid' in g:
+        return g.uid
+
     id_token = request.cookies.get('token')
 
     if not id_token:
+        g.uid = None
         return None
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        return uid
-    except Exception as e:
-        print(f"Errore durante la verifica del token: {e}")
-        return None
+    inizio = time.perf_counter()
+    uid = cache_token.leggi(id_token)
+    esito = 'cache'
+    if uid is None:
+        try:
+            decoded_token = auth.verify_id_token(id_token)
+            uid = decoded_token['uid']
+            cache_token.scrivi(id_token, uid, decoded_token.get('exp'))
+            esito = 'verificato'
+        except Exception as e:
+            print(f"Errore durante la verifica del token: {e}")
+            esito = 'errore'
+    metriche.VERIFICA_TOKEN.osserva(time.perf_counter() - inizio, esito=esito)
+
+    g.uid = uid
+    return uid
 
 def richiede_autenticazione(f):
     from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # Il token viene verificato una sola volta: l'uid resta in g per la view
         uid = verifica_autenticazione()
         if uid is None:
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+def scrivi(operazione):
+    """Esegue subito `operazione(batch)` sull'archivio, in un commit a sé"""
+    batch = archivio.nuovo_batch()
+    operazione(batch)
+    batch.commit()
+
 def carica_dispense_utente(uid):
     try:
-        dispense_ref = db.collection('utenti').document(uid).collection('dispense')
-        dispense_docs = dispense_ref.stream()
-
-        dispense = {}
-        for doc in dispense_docs:
-            dispense[doc.id] = doc.to_dict().get('alimenti', {})
-
-        return dispense
+        return archivio.carica_dispense(uid)
     except Exception as e:
         print(f"Errore nel caricamento delle dispense: {e}")
         return {}
 
-def salva_dispensa_utente(uid, nome_dispensa, alimenti):
+def carica_dispense_scadute(uid, oggi):
+    """Solo le dispense con almeno un alimento scaduto, grazie al campo 'prossima_scadenza'"""
     try:
-        dispensa_ref = db.collection('utenti').document(uid).collection('dispense').document(nome_dispensa)
-        dispensa_ref.set({
-            'alimenti': alimenti,
-            'ultima_modifica': firestore.SERVER_TIMESTAMP
-        })
+        return archivio.carica_dispense_scadute(uid, scadenza_come_numero(oggi))
+    except Exception as e:
+        print(f"Errore nella ricerca delle dispense scadute: {e}")
+        return {}
+
+def carica_alimento_utente(uid, nome_dispensa, nome_alimento):
+    """Legge un solo alimento della dispensa, oppure None"""
+    try:
+        return archivio.carica_alimento(uid, nome_dispensa, nome_alimento)
+    except Exception as e:
+        print(f"Errore nel caricamento dell'alimento: {e}")
+        return None
+
+def salva_dispensa_utente(uid, nome_dispensa, alimenti, batch=None):
+    try:
+        if batch is not None:
+            archivio.salva_dispensa(batch, uid, nome_dispensa, alimenti)
+        else:
+            scrivi(lambda batch: archivio.salva_dispensa(batch, uid, nome_dispensa, alimenti))
         return True
     except Exception as e:
         print(f"Errore nel salvataggio della dispensa: {e}")
         return False
 
-def elimina_dispensa_utente(uid, nome_dispensa):
+def salva_alimenti_utente(uid, nome_dispensa, modifiche, alimenti, batch):
+    """Scrive solo gli alimenti modificati (None = eliminato), vedi Archivio.salva_alimenti"""
+    archivio.salva_alimenti(batch, uid, nome_dispensa, modifiche, alimenti)
+
+def elimina_dispensa_utente(uid, nome_dispensa, batch=None):
     try:
-        db.collection('utenti').document(uid).collection('dispense').document(nome_dispensa).delete()
+        if batch is not None:
+            archivio.elimina_dispensa(batch, uid, nome_dispensa)
+        else:
+            scrivi(lambda batch: archivio.elimina_dispensa(batch, uid, nome_dispensa))
         return True
     except Exception as e:
         print(f"Errore nell'eliminazione della dispensa: {e}")
         return False
 
+def carica_lista_spesa(uid, nome_lista):
+    """Prodotti della lista spesa, oppure None se la lista non esiste"""
+    return archivio.carica_lista(uid, nome_lista)
+
+def aggiungi_a_lista_spesa(uid, nome_lista, prodotti, batch):
+    """Aggiunge i prodotti alla lista (senza duplicati) senza doverla rileggere"""
+    archivio.aggiungi_a_lista(batch, uid, nome_lista, prodotti)
+
+def rimuovi_da_lista_spesa(uid, nome_lista, prodotti, batch):
+    archivio.rimuovi_da_lista(batch, uid, nome_lista, prodotti)
+
+def nuova_unita_lavoro(uid):
+    return UnitaDiLavoroDispense(
+        uid, carica_dispense_utente, carica_alimento_utente,
+        salva_dispensa_utente, salva_alimenti_utente, elimina_dispensa_utente, archivio.nuovo_batch
+    )
+
+def dispense_richiesta(uid):
+    """Dispense dell'utente per la richiesta corrente: caricate una volta sola, salvate in after_request"""
+    if 'unita_lavoro' not in g:
+        g.unita_lavoro = {}
+    if uid not in g.unita_lavoro:
+        g.unita_lavoro[uid] = nuova_unita_lavoro(uid)
+    return g.unita_lavoro[uid]
+
+@app.after_request
+def salva_dispense_modificate(response):
+    if response.status_code < 400:
+        for unita in g.get('unita_lavoro', {}).values():
+            if unita.ha_modifiche():
+                unita.commit()
+    return response
+
 def crea_profilo_utente(uid, email):
     try:
-        user_ref = db.collection('utenti').document(uid)
-        user_ref.set({
+        scrivi(lambda batch: archivio.salva_profilo(batch, uid, {
             'email': email,
-            'data_creazione': firestore.SERVER_TIMESTAMP
-        })
+            'data_creazione': TIMESTAMP_SERVER
+        }, merge=False))
         return True
     except Exception as e:
         print(f"Errore nella creazione del profilo utente: {e}")
@@ -162,8 +233,8 @@ def crea_profilo_utente(uid, email):
 @richiede_autenticazione
 def home():
     uid = verifica_autenticazione()
+    dispense = dispense_richiesta(uid).dispense()
     aggiorna_prodotti_scaduti(uid)
-    dispense = carica_dispense_utente(uid)
     dispense_list = []
     for nome, alimenti in dispense.items():
         dispense_list.append({'nome_dispensa': nome, 'alimenti': list(alimenti.values())})
@@ -173,22 +244,19 @@ def home():
 @richiede_autenticazione
 def dispense_page():
     uid = verifica_autenticazione()
+    dispense = dispense_richiesta(uid).dispense()
     aggiorna_prodotti_scaduti(uid)
-    dispense = carica_dispense_utente(uid)
     return render_template('dispense.html', dispense=dispense, show_menu=True)
 
 @app.route('/lista_spesa')
 @richiede_autenticazione
 def lista_spesa_page():
     uid = verifica_autenticazione()
-    aggiorna_prodotti_scaduti(uid)
+    aggiorna_prodotti_scaduti(uid, salva_subito=True)
     prodotti_generale = []  # Sostituisci con la logica reale
     prodotti_scaduti = []
     # Carica prodotti scaduti dalla lista dedicata
-    lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document('Prodotti Scaduti')
-    lista_doc = lista_ref.get()
-    if lista_doc.exists:
-        prodotti_scaduti = lista_doc.to_dict().get('prodotti', [])
+    prodotti_scaduti = carica_lista_spesa(uid, 'Prodotti Scaduti') or []
     return render_template('lista_spesa.html', prodotti_generale=prodotti_generale, prodotti_scaduti=prodotti_scaduti, show_menu=True)
 
 @app.route('/aggiungi', methods=['POST'])
@@ -204,20 +272,13 @@ def aggiungi():
     categoria = trova_categoria(nome_alimento)
     tipo = "alimento"
 
-    dispense = carica_dispense_utente(uid)
-
-    if nome_dispensa not in dispense:
-        dispense[nome_dispensa] = {}
-
-    dispense[nome_dispensa][nome_alimento] = {
+    dispense_richiesta(uid).imposta_alimento(nome_dispensa, nome_alimento, {
         "quantita": quantita,
         "scadenza": scadenza,
         "unita": unita,
         "categoria": categoria,
         "tipo": tipo
-    }
-
-    salva_dispensa_utente(uid, nome_dispensa, dispense[nome_dispensa])
+    })
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'message': 'Alimento aggiunto alla dispensa!'})
@@ -231,11 +292,7 @@ def rimuovi():
     nome_dispensa = request.form['nome_dispensa']
     nome_alimento = request.form['nome_alimento']
 
-    dispense = carica_dispense_utente(uid)
-
-    if nome_dispensa in dispense and nome_alimento in dispense[nome_dispensa]:
-        del dispense[nome_dispensa][nome_alimento]
-        salva_dispensa_utente(uid, nome_dispensa, dispense[nome_dispensa])
+    if dispense_richiesta(uid).rimuovi_alimento(nome_dispensa, nome_alimento) is not None:
         return jsonify({'message': 'Alimento rimosso dalla dispensa!'})
     else:
         return jsonify({'message': 'Alimento non trovato nella dispensa!'}), 404
@@ -244,8 +301,8 @@ def rimuovi():
 @richiede_autenticazione
 def dispensa_detail(nome_dispensa):
     uid = verifica_autenticazione()
+    dispense = dispense_richiesta(uid).dispense()
     aggiorna_prodotti_scaduti(uid)
-    dispense = carica_dispense_utente(uid)
     prodotti = dispense.get(nome_dispensa, {})
     if not prodotti:
         for key, val in dispense.items():
@@ -259,12 +316,7 @@ def dispensa_detail(nome_dispensa):
 @app.route('/profilo')
 def profilo_page():  # <-- rinominato da 'profilo' a 'profilo_page'
     uid = verifica_autenticazione()
-    user_ref = db.collection('utenti').document(uid)
-    user_doc = user_ref.get()
-
-    profilo = None
-    if user_doc.exists:
-        profilo = user_doc.to_dict()
+    profilo = archivio.carica_profilo(uid)
 
     return render_template('profilo.html', profilo=profilo)
 
@@ -291,7 +343,7 @@ def salva_profilo():
             'data_nascita': data_nascita,
             'dieta': dieta,
             'biografia': biografia,
-            'aggiornato_il': firestore.SERVER_TIMESTAMP
+            'aggiornato_il': TIMESTAMP_SERVER
         }
 
         if 'foto' in request.files:
@@ -299,8 +351,7 @@ def salva_profilo():
             if foto.filename:
                 profilo_data['foto_url'] = 'https://via.placeholder.com/150x150.png?text=' + nickname[0].upper()
 
-        user_ref = db.collection('utenti').document(uid)
-        user_ref.set(profilo_data, merge=True)
+        scrivi(lambda batch: archivio.salva_profilo(batch, uid, profilo_data, merge=True))
 
         return jsonify({'success': True, 'message': 'Profilo salvato con successo!'})
     except Exception as e:
@@ -313,10 +364,10 @@ def crea_dispensa():
     uid = verifica_autenticazione()
     nome_nuova_dispensa = request.form['nome_nuova_dispensa']
 
-    dispense = carica_dispense_utente(uid)
+    unita = dispense_richiesta(uid)
 
-    if nome_nuova_dispensa and nome_nuova_dispensa not in dispense:
-        salva_dispensa_utente(uid, nome_nuova_dispensa, {})
+    if nome_nuova_dispensa and nome_nuova_dispensa not in unita.dispense():
+        unita.crea_dispensa(nome_nuova_dispensa)
         return jsonify({'message': 'Dispensa creata!', 'success': True})
     else:
         return jsonify({'message': 'Nome non valido o già esistente.', 'success': False}), 400
@@ -330,7 +381,8 @@ def modifica_dispensa():
     alimenti_json = request.form['alimenti']
     alimenti = json.loads(alimenti_json)
 
-    dispense = carica_dispense_utente(uid)
+    unita = dispense_richiesta(uid)
+    dispense = unita.dispense()
 
     if nome_dispensa_originale not in dispense:
         return jsonify({'message': 'Dispensa non trovata!', 'success': False}), 404
@@ -338,9 +390,9 @@ def modifica_dispensa():
     if nuovo_nome_dispensa != nome_dispensa_originale:
         if nuovo_nome_dispensa in dispense:
             return jsonify({'message': 'Il nuovo nome della dispensa è già in uso!', 'success': False}), 400
-        elimina_dispensa_utente(uid, nome_dispensa_originale)
+        unita.elimina_dispensa(nome_dispensa_originale)
 
-    salva_dispensa_utente(uid, nuovo_nome_dispensa, alimenti)
+    unita.sostituisci_dispensa(nuovo_nome_dispensa, alimenti)
 
     return jsonify({'message': 'Dispensa modificata con successo!', 'success': True})
 
@@ -350,10 +402,10 @@ def elimina_dispensa():
     uid = verifica_autenticazione()
     nome_dispensa = request.form['nome_dispensa']
 
-    dispense = carica_dispense_utente(uid)
+    unita = dispense_richiesta(uid)
 
-    if nome_dispensa in dispense:
-        elimina_dispensa_utente(uid, nome_dispensa)
+    if nome_dispensa in unita.dispense():
+        unita.elimina_dispensa(nome_dispensa)
         return jsonify({'message': 'Dispensa eliminata con successo!', 'success': True})
     else:
         return jsonify({'message': 'Dispensa non trovata!', 'success': False}), 404
@@ -366,15 +418,13 @@ def rimuovi_prodotto_lista_spesa():
     nome_prodotto = request.form['nome_prodotto']
 
     # Recupera la lista dal database
-    lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document(nome_lista)
-    lista_doc = lista_ref.get()
-    if not lista_doc.exists:
+    prodotti = carica_lista_spesa(uid, nome_lista)
+    if prodotti is None:
         return jsonify({'success': False, 'message': 'Lista non trovata'}), 404
 
-    prodotti = lista_doc.to_dict().get('prodotti', [])
     if nome_prodotto in prodotti:
         prodotti.remove(nome_prodotto)
-        lista_ref.set({'prodotti': prodotti}, merge=True)
+        scrivi(lambda batch: archivio.salva_lista(batch, uid, nome_lista, prodotti))
         return jsonify({'success': True, 'message': 'Prodotto rimosso'})
     else:
         return jsonify({'success': False, 'message': 'Prodotto non trovato'}), 404
@@ -388,23 +438,14 @@ def sposta_in_lista_spesa():
     lista_destinazione = request.form['lista_destinazione']
 
     # Rimuovi il prodotto dalla dispensa
-    dispense = carica_dispense_utente(uid)
-    if nome_dispensa not in dispense or nome_alimento not in dispense[nome_dispensa]:
+    unita = dispense_richiesta(uid)
+    if unita.rimuovi_alimento(nome_dispensa, nome_alimento) is None:
         return jsonify({'success': False, 'message': 'Prodotto non trovato nella dispensa'}), 404
 
-    prodotto = dispense[nome_dispensa][nome_alimento]
-    del dispense[nome_dispensa][nome_alimento]
-    salva_dispensa_utente(uid, nome_dispensa, dispense[nome_dispensa])
-
-    # Aggiungi il prodotto alla lista spesa
-    lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document(lista_destinazione)
-    lista_doc = lista_ref.get()
-    prodotti = []
-    if lista_doc.exists:
-        prodotti = lista_doc.to_dict().get('prodotti', [])
-    if nome_alimento not in prodotti:
-        prodotti.append(nome_alimento)
-    lista_ref.set({'prodotti': prodotti}, merge=True)
+    # Aggiungi il prodotto alla lista spesa, nello stesso commit della dispensa
+    unita.in_commit(lambda batch: aggiungi_a_lista_spesa(uid, lista_destinazione, [nome_alimento], batch))
+    if not unita.commit():
+        return jsonify({'success': False, 'message': 'Errore nello spostamento del prodotto'}), 500
 
     return jsonify({'success': True, 'message': 'Prodotto spostato'})
 
@@ -416,30 +457,25 @@ def sposta_in_dispensa():
     nome_prodotto = request.form['nome_prodotto']
     nome_dispensa = request.form['nome_dispensa']
 
-    # Rimuovi il prodotto dalla lista spesa
-    lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document(nome_lista)
-    lista_doc = lista_ref.get()
-    prodotti = []
-    if lista_doc.exists:
-        prodotti = lista_doc.to_dict().get('prodotti', [])
-    if nome_prodotto in prodotti:
-        prodotti.remove(nome_prodotto)
-        lista_ref.set({'prodotti': prodotti}, merge=True)
-    else:
+    # Verifica che il prodotto sia nella lista spesa
+    prodotti = carica_lista_spesa(uid, nome_lista) or []
+    if nome_prodotto not in prodotti:
         return jsonify({'success': False, 'message': 'Prodotto non trovato nella lista'}), 404
 
     # Aggiungi il prodotto alla dispensa (aggiunto come semplice nome, puoi estendere con dettagli)
-    dispense = carica_dispense_utente(uid)
-    if nome_dispensa not in dispense:
-        dispense[nome_dispensa] = {}
-    dispense[nome_dispensa][nome_prodotto] = {
+    unita = dispense_richiesta(uid)
+    unita.imposta_alimento(nome_dispensa, nome_prodotto, {
         "quantita": 1,
         "scadenza": "",
         "unita": "",
         "categoria": trova_categoria(nome_prodotto),
         "tipo": "alimento"
-    }
-    salva_dispensa_utente(uid, nome_dispensa, dispense[nome_dispensa])
+    })
+
+    # Rimozione dalla lista e aggiunta alla dispensa in un unico commit
+    unita.in_commit(lambda batch: rimuovi_da_lista_spesa(uid, nome_lista, [nome_prodotto], batch))
+    if not unita.commit():
+        return jsonify({'success': False, 'message': 'Errore nello spostamento del prodotto'}), 500
 
     return jsonify({'success': True, 'message': 'Prodotto spostato nella dispensa'})
 
@@ -476,17 +512,58 @@ def register():
 @richiede_autenticazione
 def lista_spesa_detail(nome_lista):
     uid = verifica_autenticazione()
-    aggiorna_prodotti_scaduti(uid)
-    lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document(nome_lista)
-    lista_doc = lista_ref.get()
-    prodotti = []
-    if lista_doc.exists:
-        prodotti = lista_doc.to_dict().get('prodotti', [])
+    aggiorna_prodotti_scaduti(uid, salva_subito=True)
+    prodotti = carica_lista_spesa(uid, nome_lista) or []
     return render_template('lista_spesa_detail.html', nome_lista=nome_lista, prodotti=prodotti, show_menu=True)
 
-def aggiorna_prodotti_scaduti(uid):
-    dispense = carica_dispense_utente(uid)
-    oggi = datetime.now().date()
+# ========== PULIZIA PRODOTTI SCADUTI ==========
+# La pulizia gira al massimo una volta al giorno per utente: la data dell'ultima
+# esecuzione è salvata nel profilo ('ultima_pulizia_scaduti') e ricordata in
+# memoria, così le pagine successive non rileggono tutte le dispense.
+# Ogni dispensa tiene inoltre 'prossima_scadenza' (la scadenza più vicina):
+# la pulizia legge solo le dispense con prossima_scadenza < oggi.
+
+PULIZIA_SCADUTI_INTERVALLO_MINUTI = int(os.environ.get('PULIZIA_SCADUTI_INTERVALLO_MINUTI', '0'))
+
+_ultima_pulizia = {}  # uid -> 'YYYY-MM-DD'
+_ultima_pulizia_lock = threading.Lock()
+
+def pulizia_gia_eseguita(uid, oggi):
+    oggi_str = oggi.isoformat()
+    with _ultima_pulizia_lock:
+        if _ultima_pulizia.get(uid) == oggi_str:
+            return True
+    try:
+        profilo = archivio.carica_profilo(uid)
+        ultima = profilo.get('ultima_pulizia_scaduti') if profilo else None
+    except Exception as e:
+        print(f"Errore nella lettura dell'ultima pulizia: {e}")
+        return False
+    if ultima == oggi_str:
+        with _ultima_pulizia_lock:
+            _ultima_pulizia[uid] = oggi_str
+        return True
+    return False
+
+def segna_pulizia_eseguita(uid, oggi, batch):
+    archivio.salva_profilo(batch, uid, {'ultima_pulizia_scaduti': oggi.isoformat()}, merge=True)
+
+def ricorda_pulizia_eseguita(uid, oggi):
+    with _ultima_pulizia_lock:
+        _ultima_pulizia[uid] = oggi.isoformat()
+
+def esegui_pulizia_scaduti(uid, unita, oggi, dispense_scadute=None):
+    """
+    Toglie dalle dispense i prodotti scaduti e li aggiunge alla lista 'Prodotti Scaduti'.
+    Le scritture (dispense, lista e data della pulizia) finiscono nel commit di `unita`.
+    `dispense_scadute` sono le dispense già trovate dalla query, se disponibili.
+    """
+    if unita.caricata():
+        dispense = unita.dispense()
+    else:
+        if dispense_scadute is None:
+            dispense_scadute = carica_dispense_scadute(uid, oggi)
+        dispense = unita.registra(dispense_scadute)
     prodotti_scaduti = []
 
     for nome_dispensa, alimenti in dispense.items():
@@ -501,66 +578,271 @@ def aggiorna_prodotti_scaduti(uid):
                         to_remove.append(nome_alimento)
                 except Exception:
                     continue
-        # Rimuovi i prodotti scaduti dalla dispensa
+        # Rimuovi i prodotti scaduti dalla dispensa (salvati al commit dell'unità di lavoro)
         for nome_alimento in to_remove:
-            del dispense[nome_dispensa][nome_alimento]
-        if to_remove:
-            salva_dispensa_utente(uid, nome_dispensa, dispense[nome_dispensa])
+            unita.rimuovi_alimento(nome_dispensa, nome_alimento)
+        if not to_remove and not unita.caricata():
+            # prossima_scadenza era rimasta indietro (alimenti tolti con scritture per campo)
+            unita.in_commit(lambda batch, nome=nome_dispensa, alimenti=alimenti: archivio.aggiorna_prossima_scadenza(batch, uid, nome, alimenti))
 
     # Aggiungi i prodotti scaduti alla lista "Prodotti Scaduti"
     if prodotti_scaduti:
-        lista_ref = db.collection('utenti').document(uid).collection('liste_spesa').document('Prodotti Scaduti')
-        lista_doc = lista_ref.get()
-        prodotti_lista = []
-        if lista_doc.exists:
-            prodotti_lista = lista_doc.to_dict().get('prodotti', [])
-        for prod in prodotti_scaduti:
-            if prod not in prodotti_lista:
-                prodotti_lista.append(prod)
-        lista_ref.set({'prodotti': prodotti_lista}, merge=True)
+        unita.in_commit(lambda batch: aggiungi_a_lista_spesa(uid, 'Prodotti Scaduti', prodotti_scaduti, batch))
+
+    unita.in_commit(lambda batch: segna_pulizia_eseguita(uid, oggi, batch))
+    # In memoria solo a commit riuscito: se fallisce la pulizia si ripete alla prossima pagina
+    unita.dopo_commit(lambda: ricorda_pulizia_eseguita(uid, oggi))
+    return prodotti_scaduti
+
+def aggiorna_prodotti_scaduti(uid, salva_subito=False):
+    """
+    Pulizia giornaliera dell'utente, salvata con le altre modifiche in after_request.
+    Con `salva_subito` il commit avviene qui: serve alle pagine che subito dopo
+    leggono le liste spesa, che devono già contenere i prodotti appena spostati.
+    """
+    oggi = datetime.now().date()
+    if pulizia_gia_eseguita(uid, oggi):
+        return
+    unita = dispense_richiesta(uid)
+    esegui_pulizia_scaduti(uid, unita, oggi)
+    if salva_subito:
+        unita.commit()
+
+def pulisci_scaduti_tutti_gli_utenti():
+    """
+    Pulizia batch: una query su tutte le dispense (collection group) con
+    prossima_scadenza < oggi, poi pulizia dei soli utenti coinvolti.
+    Restituisce (utenti puliti, prodotti spostati).
+    """
+    oggi = datetime.now().date()
+    utenti_puliti = 0
+    prodotti_spostati = 0
+
+    dispense_per_utente = {}
+    for uid, nome_dispensa, alimenti in archivio.dispense_scadute_tutti(scadenza_come_numero(oggi)):
+        dispense_per_utente.setdefault(uid, {})[nome_dispensa] = alimenti
+
+    for uid, dispense in dispense_per_utente.items():
+        unita = nuova_unita_lavoro(uid)
+        prodotti_spostati += len(esegui_pulizia_scaduti(uid, unita, oggi, dispense))
+        unita.commit()
+        utenti_puliti += 1
+
+    return utenti_puliti, prodotti_spostati
+
+def avvia_pulizia_periodica(intervallo_minuti):
+    """Thread in background che esegue la pulizia di tutti gli utenti ogni `intervallo_minuti`"""
+    def ciclo():
+        while True:
+            try:
+                utenti, prodotti = pulisci_scaduti_tutti_gli_utenti()
+                app.logger.info(f"Pulizia scaduti: {utenti} utenti, {prodotti} prodotti spostati")
+            except Exception as e:
+                print(f"Errore nella pulizia periodica dei prodotti scaduti: {e}")
+            time.sleep(intervallo_minuti * 60)
+
+    thread = threading.Thread(target=ciclo, name='pulizia-scaduti', daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command('pulisci-scaduti')
+def pulisci_scaduti_command():
+    """Sposta nella lista 'Prodotti Scaduti' i prodotti scaduti di tutti gli utenti."""
+    utenti, prodotti = pulisci_scaduti_tutti_gli_utenti()
+    print(f"Utenti puliti: {utenti}, prodotti spostati: {prodotti}")
+
+@app.cli.command('aggiorna-prossime-scadenze')
+def aggiorna_prossime_scadenze_command():
+    """Calcola 'prossima_scadenza' per le dispense senza il campo (o salvate con il vecchio formato)."""
+    aggiornate = 0
+    batch = archivio.nuovo_batch()
+    for uid, nome_dispensa, alimenti in archivio.dispense_da_aggiornare():
+        archivio.aggiorna_prossima_scadenza(batch, uid, nome_dispensa, alimenti)
+        aggiornate += 1
+        # Firestore accetta al massimo 500 scritture per batch
+        if aggiornate % 400 == 0:
+            batch.commit()
+            batch = archivio.nuovo_batch()
+    batch.commit()
+    print(f"Dispense aggiornate: {aggiornate}")
+
+if PULIZIA_SCADUTI_INTERVALLO_MINUTI > 0:
+    avvia_pulizia_periodica(PULIZIA_SCADUTI_INTERVALLO_MINUTI)
+
+# ========== PRERISCALDAMENTO OCR ==========
+# All'avvio del worker si avviano i processi della coda OCR e, se l'analisi sincrona
+# gira nel processo web, si carica anche qui il motore usato da /analizza_scontrino,
+# così il primo scontrino dopo un deploy non è il più lento.
+# Non succede all'import: lo chiama l'hook post_worker_init di gunicorn.conf.py,
+# così i comandi flask, gli script e chi importa app non avviano processi OCR
+# (senza preriscaldamento il pool parte comunque al primo scontrino).
+OCR_PRERISCALDA = os.environ.get('OCR_PRERISCALDA', '1') == '1'
+
+def preriscalda_ocr():
+    if not OCR_PRERISCALDA:
+        return
+    coda_ocr.avvia()
+    if not OCR_PROCESSO_DEDICATO:
+        threading.Thread(target=preriscalda_motore, daemon=True).start()
+
+def arricchisci_prodotti(prodotti):
+    """
+    Prodotti letti dallo scontrino per la risposta: categoria e range_scadenza
+    sono quelli già trovati da identifica_prodotti (che tollera gli errori
+    dell'OCR), le date suggerite sono ricalcolate rispetto a oggi.
+    """
+    prodotti_arricchiti = []
+    for prod in prodotti:
+        if 'categoria' in prod:
+            categoria = prod['categoria']
+            scadenza_suggerita, scadenza_surgelato = scadenze_da_range(prod.get('range_scadenza', ''))
+        else:
+            categoria = trova_categoria(prod['nome'])
+            scadenza_suggerita, scadenza_surgelato = scadenze_categoria(categoria)
+        prodotti_arricchiti.append({
+            'nome': prod['nome'],
+            'quantita': prod['quantita'],
+            'categoria': categoria,
+            'scadenza_suggerita': scadenza_suggerita,
+            'scadenza_surgelato': scadenza_surgelato
+        })
+    return prodotti_arricchiti
+
+def leggi_file_scontrino(file):
+    """Legge in memoria un file caricato; restituisce (contenuto, errore)"""
+    if file.filename == '':
+        return None, 'Nessun file selezionato'
+
+    if not allowed_file(file.filename):
+        return None, 'Formato file non valido'
+
+    contenuto = file.read()
+    if not contenuto:
+        return None, 'File vuoto'
+    return contenuto, None
+
+def leggi_scontrino_caricato():
+    """Legge in memoria il file 'scontrino' della richiesta; restituisce (contenuto, errore)"""
+    if 'scontrino' not in request.files:
+        return None, 'Nessun file caricato'
+    return leggi_file_scontrino(request.files['scontrino'])
+
+def leggi_scontrini_caricati():
+    """Legge i file 'scontrino' della richiesta, nell'ordine di invio; restituisce (contenuti, errore)"""
+    file_caricati = request.files.getlist('scontrino')
+    if not file_caricati:
+        return None, 'Nessun file caricato'
+    if len(file_caricati) > OCR_MAX_FOTO_SCONTRINO:
+        return None, f'Al massimo {OCR_MAX_FOTO_SCONTRINO} foto per scontrino'
+
+    contenuti = []
+    for numero, file in enumerate(file_caricati, 1):
+        contenuto, errore = leggi_file_scontrino(file)
+        if errore:
+            return None, f'Foto {numero}: {errore}'
+        contenuti.append(contenuto)
+    return contenuti, None
+
+def risposta_ocr_rifiutata(rifiuto):
+    """429/503 con Retry-After per un'analisi non ammessa (vedi ammissione_ocr)"""
+    metriche.OCR_RIFIUTATE.inc(rotta=request.url_rule.rule, motivo=rifiuto['motivo'])
+    if rifiuto['codice_http'] == 429:
+        messaggio = 'Hai già degli scontrini in analisi, attendi che finiscano'
+    else:
+        messaggio = 'Troppi scontrini in analisi, riprova tra poco'
+    risposta = jsonify({'success': False, 'error': messaggio, 'riprova_tra': rifiuto['riprova_tra']})
+    risposta.headers['Retry-After'] = str(rifiuto['riprova_tra'])
+    return risposta, rifiuto['codice_http']
 
 @app.route('/analizza_scontrino', methods=['POST'])
 @richiede_autenticazione
 def analizza_scontrino_route():
-    if 'scontrino' not in request.files:
-        return jsonify({'success': False, 'error': 'Nessun file caricato'}), 400
-    
-    file = request.files['scontrino']
-    
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'Nessun file selezionato'}), 400
-    
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-        
-        risultato = analizza_scontrino(filepath)
-        
-        if risultato['success']:
-            prodotti_arricchiti = []
-            for prod in risultato['prodotti']:
-                categoria = trova_categoria(prod['nome'])
-                prodotti_arricchiti.append({
-                    'nome': prod['nome'],
-                    'quantita': prod['quantita'],
-                    'categoria': categoria,
-                    'scadenza_suggerita': calcola_scadenza(categoria, False),
-                    'scadenza_surgelato': calcola_scadenza(categoria, True)
-                })
-            
-            os.remove(filepath)
-            
-            return jsonify({
-                'success': True,
-                'prodotti': prodotti_arricchiti
-            })
-        else:
-            return jsonify(risultato), 500
-    
-    return jsonify({'success': False, 'error': 'Formato file non valido'}), 400
+    uid = verifica_autenticazione()
+    contenuto, errore = leggi_scontrino_caricato()
+    if errore:
+        return jsonify({'success': False, 'error': errore}), 400
+
+    rifiuto = limitatore_ocr.entra(uid)
+    if rifiuto:
+        return risposta_ocr_rifiutata(rifiuto)
+    try:
+        risultato = coda_ocr.analizza(contenuto)
+    finally:
+        limitatore_ocr.esci(uid)
+
+    if risultato['success']:
+        return jsonify({
+            'success': True,
+            'prodotti': arricchisci_prodotti(risultato['prodotti'])
+        })
+    else:
+        return jsonify(risultato), 500
+
+@app.route('/analizza_scontrino/multiplo', methods=['POST'])
+@richiede_autenticazione
+def analizza_scontrino_multiplo_route():
+    """Più foto consecutive dello stesso scontrino: analizzate in parallelo, un'unica lista prodotti"""
+    uid = verifica_autenticazione()
+    contenuti, errore = leggi_scontrini_caricati()
+    if errore:
+        return jsonify({'success': False, 'error': errore}), 400
+
+    # Un posto per foto: le foto sono analizzate contemporaneamente
+    rifiuto = limitatore_ocr.entra(uid, posti=len(contenuti))
+    if rifiuto:
+        return risposta_ocr_rifiutata(rifiuto)
+    try:
+        risultato = coda_ocr.analizza_multiplo(contenuti)
+    finally:
+        limitatore_ocr.esci(uid, posti=len(contenuti))
+
+    if risultato['success']:
+        return jsonify({
+            'success': True,
+            'prodotti': arricchisci_prodotti(risultato['prodotti'])
+        })
+    else:
+        return jsonify(risultato), 500
+
+@app.route('/analizza_scontrino/job', methods=['POST'])
+@richiede_autenticazione
+def avvia_job_scontrino():
+    uid = verifica_autenticazione()
+    contenuto, errore = leggi_scontrino_caricato()
+    if errore:
+        return jsonify({'success': False, 'error': errore}), 400
+
+    job_id, rifiuto = coda_ocr.invia(uid, contenuto)
+    if rifiuto:
+        return risposta_ocr_rifiutata(rifiuto)
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'stato_url': url_for('stato_job_scontrino', job_id=job_id)
+    }), 202
+
+@app.route('/analizza_scontrino/job/<job_id>')
+@richiede_autenticazione
+def stato_job_scontrino(job_id):
+    uid = verifica_autenticazione()
+    job = coda_ocr.stato(uid, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Analisi non trovata'}), 404
+
+    if job['stato'] in ('in_coda', 'in_corso'):
+        return jsonify({'success': True, 'stato': job['stato']})
+
+    risultato = job['risultato']
+    if job['stato'] == 'errore':
+        return jsonify({'success': False, 'stato': 'errore', 'error': risultato.get('error', 'Errore sconosciuto')}), 500
+
+    return jsonify({
+        'success': True,
+        'stato': 'completato',
+        'prodotti': arricchisci_prodotti(risultato['prodotti'])
+    })
 
 if __name__ == "__main__":
+    preriscalda_ocr()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,466 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# ========== ARCHIVIO DATI (DISPENSE, LISTE SPESA, PROFILI) ==========
+# Interfaccia unica per l'accesso ai dati con due implementazioni:
+# - ArchivioFirestore: produzione
+# - ArchivioSQLite: file locale o ':memory:', per sviluppo, benchmark e load test
+#   senza credenziali Firebase
+# Le scritture passano sempre da un batch (`nuovo_batch()`), così le operazioni
+# su più documenti restano un unico commit atomico in entrambi i casi.
+
+# Segnaposto per "ora del server" nei dati del profilo, tradotto da ogni implementazione
+TIMESTAMP_SERVER = object()
+
+
+def scadenza_come_numero(scadenza):
+    """'YYYY-MM-DD' (o date) -> YYYYMMDD intero, oppure None se la data non è valida"""
+    if not isinstance(scadenza, str):
+        data = scadenza
+    else:
+        try:
+            data = datetime.strptime(scadenza, "%Y-%m-%d")
+        except ValueError:
+            return None
+    return data.year * 10000 + data.month * 100 + data.day
+
+
+def calcola_prossima_scadenza(alimenti):
+    """
+    Scadenza più vicina tra gli alimenti della dispensa come intero YYYYMMDD, oppure None.
+    È un numero (e non una stringa) così su Firestore si può aggiornare con Minimum.
+    """
+    scadenze = []
+    for dati in alimenti.values():
+        scadenza = dati.get('scadenza') if isinstance(dati, dict) else None
+        if not scadenza:
+            continue
+        numero = scadenza_come_numero(scadenza)
+        if numero is not None:
+            scadenze.append(numero)
+    return min(scadenze) if scadenze else None
+
+
+def nuove_scadenze_minime(modifiche):
+    """Scadenza più vicina tra gli alimenti aggiunti/modificati (None = eliminati)"""
+    return calcola_prossima_scadenza({
+        nome: dati for nome, dati in modifiche.items() if dati is not None
+    })
+
+
+class Archivio:
+    """
+    Operazioni richieste all'archivio. I metodi di scrittura ricevono il batch
+    come primo argomento; le modifiche diventano effettive con batch.commit().
+    """
+
+    OPERAZIONI_LETTURA = (
+        'carica_dispense', 'carica_dispense_scadute', 'dispense_scadute_tutti', 'dispense_da_aggiornare',
+        'carica_alimento', 'carica_lista', 'carica_profilo',
+    )
+    OPERAZIONI_SCRITTURA = (
+        'salva_dispensa', 'salva_alimenti', 'aggiorna_prossima_scadenza', 'elimina_dispensa',
+        'salva_lista', 'aggiungi_a_lista', 'rimuovi_da_lista', 'salva_profilo',
+    )
+
+    def nuovo_batch(self):
+        raise NotImplementedError
+
+    # --- dispense ---
+
+    def carica_dispense(self, uid):
+        """{nome_dispensa: alimenti} di tutte le dispense dell'utente"""
+        raise NotImplementedError
+
+    def carica_dispense_scadute(self, uid, soglia):
+        """Solo le dispense dell'utente con prossima_scadenza < soglia (YYYYMMDD)"""
+        raise NotImplementedError
+
+    def dispense_scadute_tutti(self, soglia):
+        """(uid, nome_dispensa, alimenti) per tutte le dispense con prossima_scadenza < soglia"""
+        raise NotImplementedError
+
+    def dispense_da_aggiornare(self):
+        """(uid, nome_dispensa, alimenti) delle dispense senza prossima_scadenza numerica"""
+        raise NotImplementedError
+
+    def carica_alimento(self, uid, nome_dispensa, nome_alimento):
+        """Dati di un solo alimento, oppure None"""
+        raise NotImplementedError
+
+    def salva_dispensa(self, batch, uid, nome_dispensa, alimenti):
+        """Riscrive l'intera dispensa (e la sua prossima_scadenza)"""
+        raise NotImplementedError
+
+    def salva_alimenti(self, batch, uid, nome_dispensa, modifiche, alimenti=None):
+        """
+        Scrive solo gli alimenti in `modifiche` ({nome: dati, None = elimina}).
+        Se `alimenti` (il contenuto completo) è noto, prossima_scadenza viene
+        ricalcolata; altrimenti può solo scendere alle nuove scadenze.
+        """
+        raise NotImplementedError
+
+    def aggiorna_prossima_scadenza(self, batch, uid, nome_dispensa, alimenti):
+        raise NotImplementedError
+
+    def elimina_dispensa(self, batch, uid, nome_dispensa):
+        raise NotImplementedError
+
+    # --- liste spesa ---
+
+    def carica_lista(self, uid, nome_lista):
+        """Prodotti della lista, oppure None se la lista non esiste"""
+        raise NotImplementedError
+
+    def salva_lista(self, batch, uid, nome_lista, prodotti):
+        raise NotImplementedError
+
+    def aggiungi_a_lista(self, batch, uid, nome_lista, prodotti):
+        """Aggiunge i prodotti non ancora presenti, senza rileggere la lista"""
+        raise NotImplementedError
+
+    def rimuovi_da_lista(self, batch, uid, nome_lista, prodotti):
+        raise NotImplementedError
+
+    # --- profili ---
+
+    def carica_profilo(self, uid):
+        """Documento utente (profilo e metadati), oppure None"""
+        raise NotImplementedError
+
+    def salva_profilo(self, batch, uid, dati, merge=True):
+        raise NotImplementedError
+
+
+# ========== FIRESTORE ==========
+
+class ArchivioFirestore(Archivio):
+
+    def __init__(self, db):
+        from firebase_admin import firestore
+        from google.cloud.firestore_v1.field_path import FieldPath
+        self.db = db
+        self._firestore = firestore
+        self._FieldPath = FieldPath
+
+    def _utente(self, uid):
+        return self.db.collection('utenti').document(uid)
+
+    def _dispensa(self, uid, nome_dispensa):
+        return self._utente(uid).collection('dispense').document(nome_dispensa)
+
+    def _lista(self, uid, nome_lista):
+        return self._utente(uid).collection('liste_spesa').document(nome_lista)
+
+    def _campo_alimento(self, nome_alimento):
+        """Percorso 'alimenti.<nome>' con il nome dell'alimento correttamente escapato"""
+        return self._FieldPath('alimenti', nome_alimento)
+
+    def nuovo_batch(self):
+        return self.db.batch()
+
+    def carica_dispense(self, uid):
+        return {
+            doc.id: doc.to_dict().get('alimenti', {})
+            for doc in self._utente(uid).collection('dispense').stream()
+        }
+
+    def carica_dispense_scadute(self, uid, soglia):
+        query = self._utente(uid).collection('dispense').where(
+            filter=self._firestore.FieldFilter('prossima_scadenza', '<', soglia)
+        )
+        return {doc.id: doc.to_dict().get('alimenti', {}) for doc in query.stream()}
+
+    def dispense_scadute_tutti(self, soglia):
+        query = self.db.collection_group('dispense').where(
+            filter=self._firestore.FieldFilter('prossima_scadenza', '<', soglia)
+        )
+        for doc in query.stream():
+            yield doc.reference.parent.parent.id, doc.id, doc.to_dict().get('alimenti', {})
+
+    def dispense_da_aggiornare(self):
+        for doc in self.db.collection_group('dispense').stream():
+            dati = doc.to_dict()
+            valore = dati.get('prossima_scadenza', '')
+            if valore is None or isinstance(valore, int):
+                continue
+            yield doc.reference.parent.parent.id, doc.id, dati.get('alimenti', {})
+
+    def carica_alimento(self, uid, nome_dispensa, nome_alimento):
+        doc = self._dispensa(uid, nome_dispensa).get(
+            field_paths=[self._campo_alimento(nome_alimento).to_api_repr()]
+        )
+        if not doc.exists:
+            return None
+        return (doc.to_dict().get('alimenti') or {}).get(nome_alimento)
+
+    def salva_dispensa(self, batch, uid, nome_dispensa, alimenti):
+        batch.set(self._dispensa(uid, nome_dispensa), {
+            'alimenti': alimenti,
+            # Denormalizzato: permette di trovare con una query le dispense con prodotti scaduti
+            'prossima_scadenza': calcola_prossima_scadenza(alimenti),
+            'ultima_modifica': self._firestore.SERVER_TIMESTAMP
+        })
+
+    def salva_alimenti(self, batch, uid, nome_dispensa, modifiche, alimenti=None):
+        dati = {'alimenti': {}, 'ultima_modifica': self._firestore.SERVER_TIMESTAMP}
+        campi = ['ultima_modifica']
+        for nome_alimento, valore in modifiche.items():
+            dati['alimenti'][nome_alimento] = self._firestore.DELETE_FIELD if valore is None else valore
+            campi.append(self._campo_alimento(nome_alimento))
+
+        if alimenti is not None:
+            dati['prossima_scadenza'] = calcola_prossima_scadenza(alimenti)
+            campi.append('prossima_scadenza')
+        else:
+            minima = nuove_scadenze_minime(modifiche)
+            if minima is not None:
+                dati['prossima_scadenza'] = self._firestore.Minimum(minima)
+                campi.append('prossima_scadenza')
+
+        # set con merge sui soli campi indicati: payload costante e crea la dispensa se non esiste
+        batch.set(self._dispensa(uid, nome_dispensa), dati, merge=campi)
+
+    def aggiorna_prossima_scadenza(self, batch, uid, nome_dispensa, alimenti):
+        batch.set(self._dispensa(uid, nome_dispensa), {
+            'prossima_scadenza': calcola_prossima_scadenza(alimenti)
+        }, merge=True)
+
+    def elimina_dispensa(self, batch, uid, nome_dispensa):
+        batch.delete(self._dispensa(uid, nome_dispensa))
+
+    def carica_lista(self, uid, nome_lista):
+        doc = self._lista(uid, nome_lista).get()
+        if not doc.exists:
+            return None
+        return doc.to_dict().get('prodotti', [])
+
+    def salva_lista(self, batch, uid, nome_lista, prodotti):
+        batch.set(self._lista(uid, nome_lista), {'prodotti': prodotti}, merge=True)
+
+    def aggiungi_a_lista(self, batch, uid, nome_lista, prodotti):
+        batch.set(self._lista(uid, nome_lista), {'prodotti': self._firestore.ArrayUnion(list(prodotti))}, merge=True)
+
+    def rimuovi_da_lista(self, batch, uid, nome_lista, prodotti):
+        batch.set(self._lista(uid, nome_lista), {'prodotti': self._firestore.ArrayRemove(list(prodotti))}, merge=True)
+
+    def carica_profilo(self, uid):
+        doc = self._utente(uid).get()
+        return doc.to_dict() if doc.exists else None
+
+    def salva_profilo(self, batch, uid, dati, merge=True):
+        dati = {
+            chiave: (self._firestore.SERVER_TIMESTAMP if valore is TIMESTAMP_SERVER else valore)
+            for chiave, valore in dati.items()
+        }
+        batch.set(self._utente(uid), dati, merge=merge)
+
+
+# ========== SQLITE / IN MEMORIA ==========
+
+class BatchSQLite:
+    """Operazioni accodate ed eseguite in un'unica transazione al commit."""
+
+    def __init__(self, archivio):
+        self._archivio = archivio
+        self._operazioni = []
+
+    def aggiungi(self, operazione):
+        self._operazioni.append(operazione)
+
+    def commit(self):
+        with self._archivio._lock:
+            with self._archivio.conn:
+                for operazione in self._operazioni:
+                    operazione(self._archivio.conn)
+        self._operazioni = []
+
+
+class ArchivioSQLite(Archivio):
+    """
+    Stessa semantica di ArchivioFirestore su SQLite (file o ':memory:').
+    Gli alimenti sono salvati come JSON; prossima_scadenza è una colonna indicizzata.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dispense (
+            uid TEXT NOT NULL,
+            nome TEXT NOT NULL,
+            alimenti TEXT NOT NULL,
+            prossima_scadenza INTEGER,
+            ultima_modifica TEXT,
+            PRIMARY KEY (uid, nome)
+        );
+        CREATE INDEX IF NOT EXISTS dispense_prossima_scadenza ON dispense (prossima_scadenza);
+        CREATE TABLE IF NOT EXISTS liste_spesa (
+            uid TEXT NOT NULL,
+            nome TEXT NOT NULL,
+            prodotti TEXT NOT NULL,
+            PRIMARY KEY (uid, nome)
+        );
+        CREATE TABLE IF NOT EXISTS utenti (
+            uid TEXT PRIMARY KEY,
+            dati TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, percorso=':memory:'):
+        self.percorso = percorso
+        self.conn = sqlite3.connect(percorso, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+    def _leggi(self, query, parametri=()):
+        with self._lock:
+            return self.conn.execute(query, parametri).fetchall()
+
+    @staticmethod
+    def _adesso():
+        return datetime.now().isoformat()
+
+    def nuovo_batch(self):
+        return BatchSQLite(self)
+
+    def carica_dispense(self, uid):
+        righe = self._leggi("SELECT nome, alimenti FROM dispense WHERE uid = ?", (uid,))
+        return {nome: json.loads(alimenti) for nome, alimenti in righe}
+
+    def carica_dispense_scadute(self, uid, soglia):
+        righe = self._leggi(
+            "SELECT nome, alimenti FROM dispense WHERE uid = ? AND prossima_scadenza < ?", (uid, soglia)
+        )
+        return {nome: json.loads(alimenti) for nome, alimenti in righe}
+
+    def dispense_scadute_tutti(self, soglia):
+        righe = self._leggi("SELECT uid, nome, alimenti FROM dispense WHERE prossima_scadenza < ?", (soglia,))
+        for uid, nome, alimenti in righe:
+            yield uid, nome, json.loads(alimenti)
+
+    def dispense_da_aggiornare(self):
+        # In SQLite la colonna è sempre calcolata al salvataggio
+        return iter(())
+
+    def carica_alimento(self, uid, nome_dispensa, nome_alimento):
+        righe = self._leggi("SELECT alimenti FROM dispense WHERE uid = ? AND nome = ?", (uid, nome_dispensa))
+        if not righe:
+            return None
+        return json.loads(righe[0][0]).get(nome_alimento)
+
+    def salva_dispensa(self, batch, uid, nome_dispensa, alimenti):
+        contenuto = json.dumps(alimenti)
+        prossima = calcola_prossima_scadenza(alimenti)
+        adesso = self._adesso()
+        batch.aggiungi(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO dispense (uid, nome, alimenti, prossima_scadenza, ultima_modifica) VALUES (?, ?, ?, ?, ?)",
+            (uid, nome_dispensa, contenuto, prossima, adesso)
+        ))
+
+    def salva_alimenti(self, batch, uid, nome_dispensa, modifiche, alimenti=None):
+        modifiche = json.loads(json.dumps(modifiche))
+        esatta = calcola_prossima_scadenza(alimenti) if alimenti is not None else None
+        minima = nuove_scadenze_minime(modifiche)
+        adesso = self._adesso()
+
+        def operazione(conn):
+            riga = conn.execute(
+                "SELECT alimenti, prossima_scadenza FROM dispense WHERE uid = ? AND nome = ?", (uid, nome_dispensa)
+            ).fetchone()
+            correnti = json.loads(riga[0]) if riga else {}
+            prossima = riga[1] if riga else None
+            for nome_alimento, valore in modifiche.items():
+                if valore is None:
+                    correnti.pop(nome_alimento, None)
+                else:
+                    correnti[nome_alimento] = valore
+            if alimenti is not None:
+                prossima = esatta
+            elif minima is not None:
+                prossima = minima if prossima is None else min(prossima, minima)
+            conn.execute(
+                "INSERT OR REPLACE INTO dispense (uid, nome, alimenti, prossima_scadenza, ultima_modifica) VALUES (?, ?, ?, ?, ?)",
+                (uid, nome_dispensa, json.dumps(correnti), prossima, adesso)
+            )
+
+        batch.aggiungi(operazione)
+
+    def aggiorna_prossima_scadenza(self, batch, uid, nome_dispensa, alimenti):
+        prossima = calcola_prossima_scadenza(alimenti)
+        batch.aggiungi(lambda conn: conn.execute(
+            "UPDATE dispense SET prossima_scadenza = ? WHERE uid = ? AND nome = ?", (prossima, uid, nome_dispensa)
+        ))
+
+    def elimina_dispensa(self, batch, uid, nome_dispensa):
+        batch.aggiungi(lambda conn: conn.execute(
+            "DELETE FROM dispense WHERE uid = ? AND nome = ?", (uid, nome_dispensa)
+        ))
+
+    def carica_lista(self, uid, nome_lista):
+        righe = self._leggi("SELECT prodotti FROM liste_spesa WHERE uid = ? AND nome = ?", (uid, nome_lista))
+        return json.loads(righe[0][0]) if righe else None
+
+    def _modifica_lista(self, batch, uid, nome_lista, modifica):
+        def operazione(conn):
+            riga = conn.execute(
+                "SELECT prodotti FROM liste_spesa WHERE uid = ? AND nome = ?", (uid, nome_lista)
+            ).fetchone()
+            prodotti = modifica(json.loads(riga[0]) if riga else [])
+            conn.execute(
+                "INSERT OR REPLACE INTO liste_spesa (uid, nome, prodotti) VALUES (?, ?, ?)",
+                (uid, nome_lista, json.dumps(prodotti))
+            )
+        batch.aggiungi(operazione)
+
+    def salva_lista(self, batch, uid, nome_lista, prodotti):
+        prodotti = list(prodotti)
+        self._modifica_lista(batch, uid, nome_lista, lambda correnti: prodotti)
+
+    def aggiungi_a_lista(self, batch, uid, nome_lista, prodotti):
+        nuovi = list(prodotti)
+        self._modifica_lista(batch, uid, nome_lista, lambda correnti: correnti + [
+            p for i, p in enumerate(nuovi) if p not in correnti and p not in nuovi[:i]
+        ])
+
+    def rimuovi_da_lista(self, batch, uid, nome_lista, prodotti):
+        da_rimuovere = list(prodotti)
+        self._modifica_lista(batch, uid, nome_lista, lambda correnti: [p for p in correnti if p not in da_rimuovere])
+
+    def carica_profilo(self, uid):
+        righe = self._leggi("SELECT dati FROM utenti WHERE uid = ?", (uid,))
+        return json.loads(righe[0][0]) if righe else None
+
+    def salva_profilo(self, batch, uid, dati, merge=True):
+        adesso = self._adesso()
+        dati = {
+            chiave: (adesso if valore is TIMESTAMP_SERVER else valore)
+            for chiave, valore in dati.items()
+        }
+
+        def operazione(conn):
+            correnti = {}
+            if merge:
+                riga = conn.execute("SELECT dati FROM utenti WHERE uid = ?", (uid,)).fetchone()
+                correnti = json.loads(riga[0]) if riga else {}
+            correnti.update(dati)
+            conn.execute("INSERT OR REPLACE INTO utenti (uid, dati) VALUES (?, ?)", (uid, json.dumps(correnti)))
+
+        batch.aggiungi(operazione)
+
+
+# ========== SCELTA DELL'ARCHIVIO ==========
+
+def crea_archivio(tipo=None):
+    """
+    Archivio configurato da DISPENSA_ARCHIVIO: 'firestore' (predefinito) oppure
+    'sqlite' (DISPENSA_SQLITE_PATH, predefinito ':memory:').
+    """
+    tipo = tipo or os.environ.get('DISPENSA_ARCHIVIO', 'firestore')
+    if tipo == 'sqlite':
+        return ArchivioSQLite(os.environ.get('DISPENSA_SQLITE_PATH', ':memory:'))
+    if tipo == 'firestore':
+        from firebase_admin import firestore
+        return ArchivioFirestore(firestore.client())
+    raise ValueError(f"Archivio non supportato: {tipo}")
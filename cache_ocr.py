@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# ========== CACHE RISULTATI OCR ==========
+# I risultati di analizza_scontrino sono indicizzati per hash del contenuto
+# dell'immagine: un LRU in memoria davanti a un archivio su disco di dimensione
+# limitata. La chiave include anche una "versione" (config Tesseract, versione
+# di food_data.json...) così un cambio di configurazione invalida le voci vecchie.
+
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dispensa_cache_ocr'))
+OCR_CACHE_MAX_VOCI_MEMORIA = int(os.environ.get('OCR_CACHE_MAX_VOCI_MEMORIA', '128'))
+OCR_CACHE_MAX_MB_DISCO = float(os.environ.get('OCR_CACHE_MAX_MB_DISCO', '50'))
+# 'lru': sul disco si elimina la voce letta meno di recente; 'fifo': la più vecchia scritta
+OCR_CACHE_POLITICA = os.environ.get('OCR_CACHE_POLITICA', 'lru')
+
+POLITICHE_SUPPORTATE = ('lru', 'fifo')
+
+
+class CacheOCR:
+    """Cache a due livelli (memoria + disco) per risultati serializzabili in JSON."""
+
+    def __init__(self, versione, directory=OCR_CACHE_DIR, max_voci_memoria=OCR_CACHE_MAX_VOCI_MEMORIA,
+                 max_byte_disco=int(OCR_CACHE_MAX_MB_DISCO * 1024 * 1024), politica=OCR_CACHE_POLITICA):
+        if politica not in POLITICHE_SUPPORTATE:
+            raise ValueError(f"Politica di eviction non supportata: {politica}")
+        self.versione = versione
+        self.directory = directory
+        self.max_voci_memoria = max_voci_memoria
+        self.max_byte_disco = max_byte_disco
+        self.politica = politica
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+        # Voci su disco (percorso -> byte) dalla meno recente e loro totale: la
+        # cartella si scorre una volta sola, alla prima scrittura, poi si tengono
+        # aggiornati qui. Ogni processo conta le voci che trova all'avvio e quelle
+        # che scrive lui.
+        self._voci_disco = None
+        self._byte_disco = 0
+        self._lock_disco = threading.Lock()
+
+    def chiave(self, contenuto):
+        """Chiave content-addressed: hash dei byte dell'immagine più la versione della pipeline."""
+        h = hashlib.sha256()
+        h.update(self.versione.encode('utf-8'))
+        h.update(b'\0')
+        h.update(contenuto)
+        return h.hexdigest()
+
+    def _percorso(self, chiave):
+        return os.path.join(self.directory, chiave[:2], f"{chiave}.json")
+
+    def leggi(self, chiave):
+        with self._lock:
+            if chiave in self._memoria:
+                self._memoria.move_to_end(chiave)
+                return self._memoria[chiave]
+
+        if self.max_byte_disco <= 0:
+            return None
+
+        percorso = self._percorso(chiave)
+        try:
+            with open(percorso, 'r', encoding='utf-8') as f:
+                valore = json.load(f)
+            if self.politica == 'lru':
+                os.utime(percorso)
+                with self._lock_disco:
+                    if self._voci_disco is not None and percorso in self._voci_disco:
+                        self._voci_disco.move_to_end(percorso)
+        except (OSError, ValueError):
+            return None
+
+        self._ricorda(chiave, valore)
+        return valore
+
+    def scrivi(self, chiave, valore):
+        self._ricorda(chiave, valore)
+
+        if self.max_byte_disco <= 0:
+            return
+
+        percorso = self._percorso(chiave)
+        try:
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            fd, temporaneo = tempfile.mkstemp(dir=os.path.dirname(percorso), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(valore, f, ensure_ascii=False)
+            os.replace(temporaneo, percorso)
+            self._registra_su_disco(percorso, os.path.getsize(percorso))
+        except OSError as e:
+            print(f"Errore nella scrittura della cache OCR: {e}")
+
+    def _ricorda(self, chiave, valore):
+        if self.max_voci_memoria <= 0:
+            return
+        with self._lock:
+            self._memoria[chiave] = valore
+            self._memoria.move_to_end(chiave)
+            while len(self._memoria) > self.max_voci_memoria:
+                self._memoria.popitem(last=False)
+
+    def _leggi_voci_disco(self):
+        """Voci già presenti in cartella, ordinate per mtime (chiamata una volta sola)."""
+        voci = []
+        for radice, _, files in os.walk(self.directory):
+            for nome in files:
+                if not nome.endswith('.json'):
+                    continue
+                percorso = os.path.join(radice, nome)
+                try:
+                    stat = os.stat(percorso)
+                except OSError:
+                    continue
+                voci.append((stat.st_mtime, stat.st_size, percorso))
+        voci.sort()
+        self._voci_disco = OrderedDict((percorso, dimensione) for _, dimensione, percorso in voci)
+        self._byte_disco = sum(self._voci_disco.values())
+
+    def _registra_su_disco(self, percorso, dimensione):
+        """Aggiorna il totale con la voce appena scritta ed elimina le più vecchie oltre il limite."""
+        with self._lock_disco:
+            if self._voci_disco is None:
+                self._leggi_voci_disco()
+            self._byte_disco -= self._voci_disco.pop(percorso, 0)
+            self._voci_disco[percorso] = dimensione
+            self._byte_disco += dimensione
+
+            while self._byte_disco > self.max_byte_disco and self._voci_disco:
+                vecchio, dimensione_vecchio = self._voci_disco.popitem(last=False)
+                self._byte_disco -= dimensione_vecchio
+                try:
+                    os.remove(vecchio)
+                except OSError:
+                    continue
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# ========== CACHE TOKEN FIREBASE VERIFICATI ==========
+# Evita di ripetere la verifica RSA di auth.verify_id_token per lo stesso
+# cookie: la voce vale fino alla scadenza ('exp') del token stesso.
+# Le chiavi sono hash del token, così il token in chiaro non resta in memoria.
+
+TOKEN_CACHE_MAX_VOCI = int(os.environ.get('TOKEN_CACHE_MAX_VOCI', '1024'))
+
+
+class CacheToken:
+    """Cache LRU limitata token -> uid, con scadenza per voce."""
+
+    def __init__(self, max_voci=TOKEN_CACHE_MAX_VOCI):
+        self.max_voci = max_voci
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chiave(id_token):
+        return hashlib.sha256(id_token.encode('utf-8')).digest()
+
+    def leggi(self, id_token):
+        """uid associato al token, oppure None se assente o scaduto."""
+        chiave = self._chiave(id_token)
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None:
+                return None
+            uid, scadenza = voce
+            if scadenza <= time.time():
+                del self._voci[chiave]
+                return None
+            self._voci.move_to_end(chiave)
+            return uid
+
+    def scrivi(self, id_token, uid, scadenza):
+        """Memorizza l'uid fino a `scadenza` (timestamp unix, il campo 'exp' del token)."""
+        if not scadenza or scadenza <= time.time() or self.max_voci <= 0:
+            return
+        chiave = self._chiave(id_token)
+        with self._lock:
+            self._voci[chiave] = (uid, scadenza)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+
+
+cache_token = CacheToken()
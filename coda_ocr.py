@@ -0,0 +1,345 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metriche
+from ammissione_ocr import RIFIUTO_CODA_PIENA, RIFIUTO_UTENTE, STIMA_DURATA_OCR, rifiuto
+
+# ========== CODA DI ANALISI SCONTRINI ==========
+# L'OCR gira in un pool di processi separato dai thread di gunicorn: la
+# richiesta POST restituisce subito un job_id e la pagina interroga lo stato.
+# ocr_processor e motore_ocr (OpenCV, numpy, PIL, Tesseract) sono importati
+# solo dove servono: con OCR_PROCESSO_DEDICATO=1 (default) anche
+# /analizza_scontrino usa il pool e il processo web non li carica mai;
+# con 0 l'analisi sincrona gira nel processo web e li importa al primo uso.
+# Le analisi sincrone hanno la precedenza sui job: i job restano in una coda
+# di CodaOCR e passano al pool solo quando un worker è libero, mentre le
+# analisi sincrone (già limitate da ammissione_ocr) vanno subito al pool. Così
+# un'analisi ammessa aspetta al più la fine di un job già partito, non tutta la
+# coda, e non servono processi in più.
+#
+# Memoria: ogni worker occupa circa 55 MB (Python, OpenCV, numpy, PIL, indice
+# alimenti) più le OCR_ISTANZE_MOTORE istanze di Tesseract con ita.traineddata
+# e le immagini in elaborazione (OCR_THREAD_STRISCE strisce alla volta). Con il
+# piano free di render.yaml (512 MB, processo web compreso) conviene restare a
+# OCR_WORKERS=2 e OCR_ISTANZE_MOTORE=1.
+# Se un worker muore (immagine che fa andare in crash Tesseract, OOM) falliscono
+# solo le analisi in corso in quel pool: PoolOCR lo ricrea alla richiesta dopo.
+
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', '2'))
+OCR_MAX_JOB_IN_CODA = int(os.environ.get('OCR_MAX_JOB_IN_CODA', '32'))
+OCR_MAX_JOB_PER_UTENTE = int(os.environ.get('OCR_MAX_JOB_PER_UTENTE', '2'))
+OCR_JOB_TTL_SECONDI = int(os.environ.get('OCR_JOB_TTL_SECONDI', '600'))
+OCR_PROCESSO_DEDICATO = os.environ.get('OCR_PROCESSO_DEDICATO', '1') == '1'
+
+
+def _esegui_analisi(contenuto):
+    """Eseguita nel processo worker sui byte dell'immagine caricata."""
+    from ocr_processor import analizza_scontrino
+    inizio = time.perf_counter()
+    risultato = analizza_scontrino(contenuto)
+    risultato['durata_secondi'] = time.perf_counter() - inizio
+    return risultato
+
+
+def _unisci_analisi(testi):
+    """Eseguita nel processo worker: unione del testo di più foto e identificazione prodotti."""
+    from ocr_processor import analizza_testi_scontrino
+    return analizza_testi_scontrino(testi)
+
+
+def preriscalda_motore():
+    """Carica lo stack OCR e il motore nel processo corrente."""
+    from motore_ocr import preriscalda
+    preriscalda()
+
+
+def _avviato():
+    return os.getpid()
+
+
+def _registra_risultato(risultato):
+    metriche.registra_fasi_ocr(risultato.get('tempi_fasi'))
+    STIMA_DURATA_OCR.aggiorna(risultato['durata_secondi'])
+
+
+def _registra_tempi(future):
+    """Nel processo principale: le metriche dei worker non sarebbero visibili da /metrics."""
+    if not future.cancelled() and future.exception() is None:
+        _registra_risultato(future.result())
+
+
+class PoolOCR:
+    """
+    ProcessPoolExecutor creato al primo uso e ricreato se si rompe: se un worker
+    muore (crash di Tesseract, OOM killer) l'executor resta in BrokenProcessPool
+    e rifiuterebbe ogni analisi successiva fino al riavvio del processo.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _crea(self):
+        # 'spawn' evita di fare fork di un processo con più thread attivi
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=preriscalda_motore
+        )
+
+    def _ricrea(self):
+        print("Pool OCR rotto (worker terminato): lo ricreo")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._crea()
+
+    def invia(self, funzione, *args):
+        """Come ProcessPoolExecutor.submit; può sollevare eccezioni se nemmeno un pool nuovo accetta il lavoro."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._crea()
+            elif getattr(self._executor, '_broken', False):
+                self._ricrea()
+            try:
+                return self._executor.submit(funzione, *args)
+            except BrokenProcessPool:
+                self._ricrea()
+                return self._executor.submit(funzione, *args)
+
+    def avvia(self):
+        """Avvia subito i processi worker (che caricano Tesseract), invece che al primo scontrino."""
+        for _ in range(self.max_workers):
+            self.invia(_avviato)
+
+    def chiudi(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+def _errore_analisi(errore):
+    """Risultato di un'analisi che non è arrivata alla fine nel worker."""
+    if isinstance(errore, BrokenProcessPool):
+        return {'success': False, 'error': "Analisi interrotta (processo OCR terminato), riprova"}
+    return {'success': False, 'error': str(errore)}
+
+
+def _errore_foto(risultati):
+    """Risultato d'errore per la prima foto non analizzata, oppure None."""
+    for numero, risultato in enumerate(risultati, 1):
+        if not risultato['success']:
+            return {'success': False, 'error': f"Foto {numero}: {risultato.get('error', 'errore sconosciuto')}"}
+    return None
+
+
+def _copia_esito(future, future_job):
+    """Riporta sul future del job l'esito dell'analisi eseguita nel pool."""
+    if future.exception() is not None:
+        future_job.set_exception(future.exception())
+    else:
+        future_job.set_result(future.result())
+
+
+def _future_fallito(errore):
+    future = Future()
+    future.set_exception(errore)
+    return future
+
+
+class CodaOCR:
+    """Job di OCR in un pool di processi limitato, con risultati tenuti in memoria per un TTL."""
+
+    def __init__(self, max_workers=OCR_WORKERS, max_in_coda=OCR_MAX_JOB_IN_CODA,
+                 max_per_utente=OCR_MAX_JOB_PER_UTENTE, ttl_secondi=OCR_JOB_TTL_SECONDI):
+        self.max_workers = max_workers
+        self.max_in_coda = max_in_coda
+        self.max_per_utente = max_per_utente
+        self.ttl_secondi = ttl_secondi
+        self._pool = PoolOCR(max_workers)
+        # Rientrante: i callback dei future già conclusi girano subito, nel thread che li aggiunge
+        self._lock = threading.RLock()
+        self._job = {}
+        self._nel_pool = 0            # analisi inviate al pool e non ancora concluse
+        self._da_inviare = deque()    # (future del job, contenuto) in attesa di un worker libero
+        self._riservati = 0           # worker tenuti liberi per le analisi sincrone in corso
+
+    def avvia(self):
+        """Avvia subito i processi worker (che caricano Tesseract), invece che al primo scontrino."""
+        self._pool.avvia()
+
+    def _pulisci_scaduti(self, adesso):
+        scaduti = [
+            job_id for job_id, job in self._job.items()
+            if job['future'].done() and adesso - job['creato_il'] > self.ttl_secondi
+        ]
+        for job_id in scaduti:
+            del self._job[job_id]
+
+    def _job_attivi(self):
+        return [job for job in self._job.values() if not job['future'].done()]
+
+    def _job_terminato(self, future):
+        with self._lock:
+            metriche.OCR_JOB_IN_CODA.imposta(len(self._job_attivi()))
+
+    def _nel_pool_concluso(self, future):
+        with self._lock:
+            self._nel_pool -= 1
+            self._invia_job_in_attesa()
+
+    def _invia_al_pool(self, funzione, *args):
+        """Invia subito al pool (va chiamata con self._lock preso)."""
+        future = self._pool.invia(funzione, *args)
+        self._nel_pool += 1
+        future.add_done_callback(self._nel_pool_concluso)
+        return future
+
+    def _invia_job_in_attesa(self):
+        """Passa al pool i job in attesa finché ci sono worker liberi (con self._lock preso)."""
+        while self._da_inviare and self._nel_pool + self._riservati < self.max_workers:
+            future_job, contenuto = self._da_inviare.popleft()
+            if not future_job.set_running_or_notify_cancel():
+                continue
+            try:
+                future = self._invia_al_pool(_esegui_analisi, contenuto)
+            except Exception as e:
+                future = _future_fallito(e)
+            future.add_done_callback(lambda f, future_job=future_job: _copia_esito(f, future_job))
+
+    def invia(self, uid, contenuto):
+        """
+        Accoda l'analisi e restituisce (job_id, None), oppure (None, rifiuto) se
+        l'utente ha già troppi job aperti o la coda è piena (vedi ammissione_ocr).
+        """
+        with self._lock:
+            adesso = time.time()
+            self._pulisci_scaduti(adesso)
+            attivi = self._job_attivi()
+            davanti = max(0, len(attivi) - self.max_workers)
+            if sum(1 for job in attivi if job['uid'] == uid) >= self.max_per_utente:
+                return None, rifiuto(RIFIUTO_UTENTE, STIMA_DURATA_OCR.riprova_tra(davanti, self.max_workers))
+            if len(attivi) >= self.max_in_coda:
+                return None, rifiuto(RIFIUTO_CODA_PIENA, STIMA_DURATA_OCR.riprova_tra(davanti, self.max_workers))
+
+            job_id = uuid.uuid4().hex
+            # Se l'invio al pool fallisce il job esiste comunque: la pagina ne leggerà l'errore dallo stato
+            future = Future()
+            self._da_inviare.append((future, contenuto))
+            self._invia_job_in_attesa()
+            self._job[job_id] = {
+                'uid': uid,
+                'creato_il': adesso,
+                'future': future
+            }
+            metriche.OCR_JOB_IN_CODA.imposta(len(attivi) + 1)
+        # Fuori dal lock: se il future è già concluso il callback gira subito qui
+        future.add_done_callback(_registra_tempi)
+        future.add_done_callback(self._job_terminato)
+        return job_id, None
+
+    def analizza(self, contenuto):
+        """
+        Analisi sincrona per /analizza_scontrino: nel pool, prima dei job in
+        attesa, se OCR_PROCESSO_DEDICATO, altrimenti nel thread corrente.
+        Le fasi finiscono comunque nelle metriche.
+        """
+        if not OCR_PROCESSO_DEDICATO:
+            risultato = _esegui_analisi(contenuto)
+            _registra_risultato(risultato)
+            return risultato
+
+        try:
+            with self._lock:
+                future = self._invia_al_pool(_esegui_analisi, contenuto)
+            future.add_done_callback(_registra_tempi)
+            return future.result()
+        except Exception as e:
+            return _errore_analisi(e)
+
+    def analizza_multiplo(self, contenuti):
+        """
+        Come analizza(), per più foto dello stesso scontrino: le foto sono
+        analizzate in parallelo (nel pool o in thread del processo corrente),
+        poi il testo viene unito e i prodotti identificati una volta sola.
+        """
+        if not OCR_PROCESSO_DEDICATO:
+            with ThreadPoolExecutor(max_workers=min(len(contenuti), self.max_workers), thread_name_prefix='ocr-foto') as esecutore:
+                risultati = list(esecutore.map(_esegui_analisi, contenuti))
+            for risultato in risultati:
+                _registra_risultato(risultato)
+            errore = _errore_foto(risultati)
+            if errore:
+                return errore
+            unione = _unisci_analisi([risultato['testo_completo'] for risultato in risultati])
+            metriche.registra_fasi_ocr(unione.get('tempi_fasi'))
+            return unione
+
+        # Un worker resta riservato all'unione del testo: quando le foto finiscono
+        # i posti liberati non devono andare tutti ai job in attesa
+        with self._lock:
+            self._riservati += 1
+        try:
+            with self._lock:
+                futures = [self._invia_al_pool(_esegui_analisi, contenuto) for contenuto in contenuti]
+            for future in futures:
+                future.add_done_callback(_registra_tempi)
+            risultati = [future.result() for future in futures]
+
+            errore = _errore_foto(risultati)
+            if errore:
+                return errore
+            with self._lock:
+                future = self._invia_al_pool(_unisci_analisi, [risultato['testo_completo'] for risultato in risultati])
+            unione = future.result()
+        except Exception as e:
+            return _errore_analisi(e)
+        finally:
+            with self._lock:
+                self._riservati -= 1
+                self._invia_job_in_attesa()
+        metriche.registra_fasi_ocr(unione.get('tempi_fasi'))
+        return unione
+
+    def stato(self, uid, job_id):
+        """
+        Stato del job per il suo proprietario:
+        {'stato': 'in_coda' | 'in_corso' | 'completato' | 'errore', 'risultato': ...}
+        Restituisce None se il job non esiste (o appartiene a un altro utente).
+        """
+        with self._lock:
+            job = self._job.get(job_id)
+        if job is None or job['uid'] != uid:
+            return None
+
+        future = job['future']
+        if not future.done():
+            return {'stato': 'in_corso' if future.running() else 'in_coda'}
+
+        try:
+            risultato = future.result()
+        except Exception as e:
+            risultato = _errore_analisi(e)
+
+        return {
+            'stato': 'completato' if risultato.get('success') else 'errore',
+            'risultato': risultato
+        }
+
+    def chiudi(self):
+        with self._lock:
+            for future_job, _ in self._da_inviare:
+                future_job.cancel()
+            self._da_inviare.clear()
+        self._pool.chiudi()
+
+
+coda_ocr = CodaOCR()
+atexit.register(coda_ocr.chiudi)
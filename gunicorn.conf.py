@@ -0,0 +1,8 @@
+# Configurazione letta automaticamente da gunicorn (gunicorn.conf.py nella
+# cartella di avvio): vale per Dockerfile, Procfile e render.yaml.
+
+
+def post_worker_init(worker):
+    """Preriscalda l'OCR nel worker appena avviato, non all'import di app"""
+    from app import preriscalda_ocr
+    preriscalda_ocr()
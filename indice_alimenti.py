@@ -0,0 +1,466 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+from collections import Counter, deque
+
+# ========== INDICE PRODOTTI / CATEGORIE ==========
+# Costruito una sola volta all'import a partire da food_data.json e condiviso
+# da app.py e ocr_processor.py, così il costo di un match dipende dalla
+# lunghezza del nome cercato e non dal numero di prodotti nel catalogo.
+
+FOOD_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'food_data.json')
+# Indice già costruito (pickle), valido finché non cambiano food_data.json e
+# questo file: i worker lo caricano invece di rileggere il JSON e ricostruire
+# gli indici. Se manca o è di un'altra versione viene ricostruito e riscritto.
+FOOD_DATA_SNAPSHOT = os.environ.get('FOOD_DATA_SNAPSHOT', os.path.join(os.path.dirname(FOOD_DATA_PATH), 'food_data.snapshot'))
+FORMATO_SNAPSHOT = 3
+# Hash del codice dell'indice, nell'intestazione dello snapshot: una modifica a
+# IndiceAlimenti invalida gli snapshot vecchi senza doverlo ricordare a mano
+with open(os.path.abspath(__file__), 'rb') as _sorgente:
+    VERSIONE_CODICE_INDICE = hashlib.sha256(_sorgente.read()).hexdigest()[:16]
+
+LUNGHEZZA_MINIMA_PAROLA = 3
+
+# ========== MATCH APPROSSIMATO ==========
+# L'OCR sbaglia singoli caratteri ("MOZZAREILA", "M0ZZARELLA"): la parola
+# principale (la prima) di ogni prodotto è indicizzata per trigrammi, i candidati
+# che condividono abbastanza trigrammi vengono verificati con una distanza di
+# edit limitata. Le parole corte sono troppo vicine a parole non alimentari
+# (PENNA/panna, COLLA/cola, CESTO/pesto) e le parole secondarie dei prodotti
+# portano fuori strada (SPUGNA/"... di spagna"): per questo la soglia è alta.
+LUNGHEZZA_MINIMA_FUZZY = 4
+DISTANZA_MASSIMA_FUZZY = 2
+# Punteggio minimo (1 - distanza / lunghezza) perché il match sia accettato:
+# 1 errore da 7 lettere in su, 2 da 14
+PUNTEGGIO_MINIMO_FUZZY = 0.85
+# Cifre che l'OCR legge al posto di lettere, dentro le parole
+CONFUSIONI_OCR = str.maketrans({'0': 'o', '1': 'i', '5': 's'})
+RE_PAROLA = re.compile(r'[^\W\d_]+')
+RE_PAROLA_OCR = re.compile(r'[^\W_]*[^\W\d_][^\W_]*')
+
+
+# ========== GIORNI DI SCADENZA ==========
+# range_scadenza ("5-7 giorni (fresca), 3-4 mesi (congelata)") letto una volta
+# sola per categoria: le date vere e proprie le calcola scadenze.py
+
+GIORNI_FRESCO_DEFAULT = 5
+GIORNI_SURGELATO_DEFAULT = 90
+
+GIORNI_PER_UNITA = {'giorn': 1, 'settiman': 7, 'mes': 30, 'ann': 365}
+
+# "5-7 giorni (fresca)", "3 giorni (fresco)", "1-2 settimane (fresca)", "6 mesi (congelato)"
+RE_DURATA = re.compile(r'(\d+)\s*(?:-\s*(\d+))?\s*(giorn|settiman|mes|ann)[a-z]*\s*\(\s*([a-z]+)')
+
+
+def giorni_da_range(range_scadenza):
+    """
+    (giorni fresco, giorni surgelato) dal testo di range_scadenza: la media del
+    primo intervallo marcato (fresc...) e del primo marcato (congel...), con
+    i default se mancano.
+    """
+    fresco = surgelato = None
+    for minimo, massimo, unita, stato in RE_DURATA.findall((range_scadenza or '').lower()):
+        media = (int(minimo) + int(massimo or minimo)) // 2
+        giorni = media * GIORNI_PER_UNITA[unita]
+        if fresco is None and stato.startswith('fresc'):
+            fresco = giorni
+        elif surgelato is None and stato.startswith('congel'):
+            surgelato = giorni
+    return (
+        GIORNI_FRESCO_DEFAULT if fresco is None else fresco,
+        GIORNI_SURGELATO_DEFAULT if surgelato is None else surgelato,
+    )
+
+
+def parole_normalizzate(testo):
+    """Parole (solo lettere) di un nome letto dall'OCR, con le cifre confuse riportate a lettere."""
+    return [parola.translate(CONFUSIONI_OCR) for parola in RE_PAROLA_OCR.findall(testo.lower())]
+
+
+def trigrammi(parola):
+    """Trigrammi della parola con uno spazio ai bordi (' mo', 'moz', ..., 'la ')."""
+    esteso = f' {parola} '
+    return {esteso[i:i + 3] for i in range(len(esteso) - 2)}
+
+
+def distanza_limitata(a, b, limite):
+    """
+    Distanza di Levenshtein tra `a` e `b` se è al massimo `limite`, altrimenti
+    limite + 1. Calcola solo la fascia diagonale larga 2*limite+1 e si ferma
+    appena tutta una riga supera il limite.
+    """
+    if abs(len(a) - len(b)) > limite:
+        return limite + 1
+    oltre = limite + 1
+    precedente = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        corrente = [oltre] * (len(b) + 1)
+        if i <= limite:
+            corrente[0] = i
+        inizio = max(1, i - limite)
+        fine = min(len(b), i + limite)
+        minimo_riga = corrente[0]
+        carattere = a[i - 1]
+        for j in range(inizio, fine + 1):
+            costo = precedente[j - 1] + (carattere != b[j - 1])
+            if precedente[j] + 1 < costo:
+                costo = precedente[j] + 1
+            if corrente[j - 1] + 1 < costo:
+                costo = corrente[j - 1] + 1
+            corrente[j] = costo
+            if costo < minimo_riga:
+                minimo_riga = costo
+        if minimo_riga > limite:
+            return oltre
+        precedente = corrente
+    return min(precedente[len(b)], oltre)
+
+
+class AutomaAhoCorasick:
+    """
+    Automa Aho-Corasick su un insieme di chiavi.
+    Ad ogni chiave è associato un valore intero (es. la posizione del prodotto):
+    `minimo(testo)` restituisce il valore più piccolo tra tutte le chiavi
+    contenute nel testo, con una sola scansione del testo.
+    """
+
+    def __init__(self, chiavi):
+        self._figli = [{}]
+        self._fallimento = [0]
+        self._migliore = [None]
+
+        if isinstance(chiavi, dict):
+            coppie = chiavi.items()
+        else:
+            coppie = ((chiave, posizione) for posizione, chiave in enumerate(chiavi))
+
+        for chiave, valore in coppie:
+            if not chiave:
+                continue
+            nodo = 0
+            for carattere in chiave:
+                prossimo = self._figli[nodo].get(carattere)
+                if prossimo is None:
+                    prossimo = len(self._figli)
+                    self._figli[nodo][carattere] = prossimo
+                    self._figli.append({})
+                    self._fallimento.append(0)
+                    self._migliore.append(None)
+                nodo = prossimo
+            if self._migliore[nodo] is None or valore < self._migliore[nodo]:
+                self._migliore[nodo] = valore
+
+        self._costruisci_fallimenti()
+
+    def _costruisci_fallimenti(self):
+        coda = deque(self._figli[0].values())
+        while coda:
+            nodo = coda.popleft()
+            for carattere, figlio in self._figli[nodo].items():
+                coda.append(figlio)
+                f = self._fallimento[nodo]
+                while f and carattere not in self._figli[f]:
+                    f = self._fallimento[f]
+                candidato = self._figli[f].get(carattere, 0)
+                self._fallimento[figlio] = candidato if candidato != figlio else 0
+                # Propaga il valore migliore lungo il link di fallimento
+                ereditato = self._migliore[self._fallimento[figlio]]
+                if ereditato is not None and (self._migliore[figlio] is None or ereditato < self._migliore[figlio]):
+                    self._migliore[figlio] = ereditato
+
+    def minimo(self, testo):
+        """Valore minimo tra le chiavi contenute in `testo`, oppure None."""
+        figli = self._figli
+        fallimento = self._fallimento
+        migliore = self._migliore
+        risultato = None
+        nodo = 0
+        for carattere in testo:
+            while nodo and carattere not in figli[nodo]:
+                nodo = fallimento[nodo]
+            nodo = figli[nodo].get(carattere, 0)
+            valore = migliore[nodo]
+            if valore is not None and (risultato is None or valore < risultato):
+                risultato = valore
+        return risultato
+
+    def contiene(self, testo):
+        """True se almeno una chiave compare in `testo`."""
+        return self.minimo(testo) is not None
+
+
+class IndiceAlimenti:
+    """
+    Indice precompilato del catalogo alimentare:
+    - dizionario per il match esatto nome -> prodotto
+    - indice parola -> categoria (match per parole intere)
+    - indice sottostringa -> prodotto (parola contenuta in un prodotto)
+    - automa Aho-Corasick (prodotto contenuto in una parola)
+    - indice trigramma -> parola principale dei prodotti (match approssimato)
+    - giorni di scadenza (fresco, surgelato) per categoria e per range_scadenza
+    I prodotti sono numerati nell'ordine del JSON: a parità di match vince
+    sempre il primo, come nelle vecchie scansioni lineari.
+    """
+
+    def __init__(self, food_data):
+        self.food_data = food_data
+        self.categorie = []        # [(nome_categoria, range_scadenza)]
+        self.prodotti = []         # nomi in minuscolo, senza duplicati
+        self.categoria_prodotto = []  # indice categoria per ogni prodotto
+
+        self._esatto = {}
+        self._parola_categoria = {}
+        self._sottostringhe = {}
+        self._parole = []          # prime parole dei prodotti (solo lettere) per il match approssimato
+        self._prodotto_parola = [] # primo prodotto che inizia con ogni parola
+        self._posizione_parola = {}
+        self._trigrammi = {}
+        self.giorni_per_range = {'': giorni_da_range('')}
+        self.giorni_per_categoria = {}
+
+        for indice_cat, categoria in enumerate(food_data['categorie_cibi']):
+            range_scadenza = categoria.get('range_scadenza', '')
+            self.categorie.append((categoria['nome_categoria'], range_scadenza))
+            if range_scadenza not in self.giorni_per_range:
+                self.giorni_per_range[range_scadenza] = giorni_da_range(range_scadenza)
+            self.giorni_per_categoria.setdefault(categoria['nome_categoria'], self.giorni_per_range[range_scadenza])
+            for prodotto in categoria['prodotti']:
+                nome = prodotto.lower().strip()
+                if nome in self._esatto:
+                    continue
+                posizione = len(self.prodotti)
+                self._esatto[nome] = posizione
+                self.prodotti.append(nome)
+                self.categoria_prodotto.append(indice_cat)
+
+                for parola in nome.split():
+                    self._parola_categoria.setdefault(parola, indice_cat)
+                    self._indicizza_sottostringhe(parola, posizione)
+                parole = RE_PAROLA.findall(nome)
+                if parole:
+                    self._indicizza_trigrammi(parole[0], posizione)
+
+        self._automa = AutomaAhoCorasick({
+            nome: posizione
+            for posizione, nome in enumerate(self.prodotti)
+            if ' ' not in nome
+        })
+
+    def _indicizza_sottostringhe(self, parola, posizione):
+        n = len(parola)
+        for inizio in range(n - LUNGHEZZA_MINIMA_PAROLA + 1):
+            for fine in range(inizio + LUNGHEZZA_MINIMA_PAROLA, n + 1):
+                self._sottostringhe.setdefault(parola[inizio:fine], posizione)
+
+    def _indicizza_trigrammi(self, parola, posizione):
+        if len(parola) < LUNGHEZZA_MINIMA_FUZZY or parola in self._posizione_parola:
+            return
+        indice_parola = len(self._parole)
+        self._posizione_parola[parola] = indice_parola
+        self._parole.append(parola)
+        self._prodotto_parola.append(posizione)
+        for trigramma in trigrammi(parola):
+            self._trigrammi.setdefault(trigramma, []).append(indice_parola)
+
+    def parola_approssimata(self, parola):
+        """
+        (posizione del prodotto, distanza) per la parola dei prodotti più vicina a
+        `parola` entro gli errori ammessi, oppure None. A parità di distanza vince
+        il prodotto che viene prima nel JSON.
+        """
+        esatta = self._posizione_parola.get(parola)
+        if esatta is not None:
+            return self._prodotto_parola[esatta], 0
+        if len(parola) < LUNGHEZZA_MINIMA_FUZZY:
+            return None
+
+        # Errori che lasciano il punteggio sopra PUNTEGGIO_MINIMO_FUZZY
+        limite = min(DISTANZA_MASSIMA_FUZZY, int(len(parola) * (1 - PUNTEGGIO_MINIMO_FUZZY) + 1e-9))
+        if limite == 0:
+            return None
+        propri = trigrammi(parola)
+        # Ogni errore distrugge al massimo 3 trigrammi della parola
+        comuni_minimi = max(1, len(propri) - 3 * limite)
+
+        conteggi = Counter()
+        for trigramma in propri:
+            conteggi.update(self._trigrammi.get(trigramma, ()))
+
+        migliore = None
+        for indice_parola, comuni in conteggi.items():
+            if comuni < comuni_minimi:
+                continue
+            distanza = distanza_limitata(parola, self._parole[indice_parola], limite)
+            if distanza > limite:
+                continue
+            candidato = (distanza, self._prodotto_parola[indice_parola])
+            if migliore is None or candidato < migliore:
+                migliore = candidato
+        if migliore is None:
+            return None
+        return migliore[1], migliore[0]
+
+    def prodotto_approssimato(self, nome):
+        """
+        (posizione del prodotto, punteggio 0-1) per il nome letto dall'OCR: la
+        parola del nome che si avvicina di più a una parola di un prodotto
+        (a parità di punteggio vince la prima parola del nome). None se nessuna
+        parola raggiunge PUNTEGGIO_MINIMO_FUZZY.
+        """
+        migliore = None
+        for parola in parole_normalizzate(nome):
+            if len(parola) < LUNGHEZZA_MINIMA_FUZZY:
+                continue
+            trovato = self.parola_approssimata(parola)
+            if trovato is None:
+                continue
+            posizione, distanza = trovato
+            punteggio = 1 - distanza / len(parola)
+            if punteggio >= PUNTEGGIO_MINIMO_FUZZY and (migliore is None or punteggio > migliore[1]):
+                migliore = (posizione, punteggio)
+                if distanza == 0:
+                    break
+        return migliore
+
+    def trova_prodotto_approssimato(self, nome):
+        """(prodotto, categoria, punteggio) del prodotto più vicino al nome letto dall'OCR, oppure None."""
+        trovato = self.prodotto_approssimato(nome)
+        if trovato is None:
+            return None
+        posizione, punteggio = trovato
+        return self.prodotti[posizione], self.categorie[self.categoria_prodotto[posizione]][0], punteggio
+
+    def prodotto_esatto(self, nome):
+        """Posizione del prodotto con nome identico (case-insensitive), oppure None."""
+        return self._esatto.get(nome.lower().strip())
+
+    def prodotto_parziale(self, parola):
+        """
+        Primo prodotto che contiene `parola` o che è contenuto in `parola`.
+        Equivale a scorrere tutti i prodotti con `parola in p or p in parola`.
+        """
+        candidati = [
+            self._sottostringhe.get(parola),
+            self._automa.minimo(parola),
+        ]
+        candidati = [c for c in candidati if c is not None]
+        return min(candidati) if candidati else None
+
+    def categoria_per_parole(self, nome):
+        """Nome della prima categoria con un prodotto che condivide una parola intera con `nome`."""
+        migliore = None
+        for parola in nome.lower().split():
+            if len(parola) < LUNGHEZZA_MINIMA_PAROLA:
+                continue
+            indice_cat = self._parola_categoria.get(parola)
+            if indice_cat is not None and (migliore is None or indice_cat < migliore):
+                migliore = indice_cat
+        if migliore is None:
+            return None
+        return self.categorie[migliore][0]
+
+    def trova_categoria(self, nome_alimento):
+        """Categoria di un alimento inserito a mano: match esatto, poi per parole intere."""
+        posizione = self.prodotto_esatto(nome_alimento)
+        if posizione is not None:
+            return self.categorie[self.categoria_prodotto[posizione]][0]
+        return self.categoria_per_parole(nome_alimento) or 'altro'
+
+    def trova_categoria_e_range(self, nome):
+        """
+        Categoria e range_scadenza di un nome letto dallo scontrino: match esatto,
+        poi approssimato per parole (tollera gli errori dell'OCR), infine parziale.
+        """
+        nome_lower = nome.lower()
+        posizione = self._esatto.get(nome_lower)
+        if posizione is None:
+            trovato = self.prodotto_approssimato(nome_lower)
+            if trovato is not None:
+                posizione = trovato[0]
+        if posizione is None:
+            for parola in nome_lower.split():
+                if len(parola) < LUNGHEZZA_MINIMA_PAROLA:
+                    continue
+                posizione = self.prodotto_parziale(parola)
+                if posizione is not None:
+                    break
+        if posizione is None:
+            return 'altro', ''
+        return self.categorie[self.categoria_prodotto[posizione]]
+
+    def corrisponde_a_prodotto(self, nome):
+        """
+        True se il nome coincide con un prodotto, ne condivide una parte (parole di
+        almeno 3 lettere) o ha una parola che, corretti gli errori tipici dell'OCR,
+        coincide con la parola principale di un prodotto o ci si avvicina entro
+        PUNTEGGIO_MINIMO_FUZZY (MOZZAREILA, M0ZZARELLA; non PENNA/panna).
+        """
+        nome_lower = nome.lower().strip()
+        if nome_lower in self._esatto:
+            return True
+        return any(
+            self.prodotto_parziale(parola) is not None
+            for parola in nome_lower.split()
+            if len(parola) >= LUNGHEZZA_MINIMA_PAROLA
+        ) or self.prodotto_approssimato(nome_lower) is not None
+
+
+def carica_food_data(percorso=FOOD_DATA_PATH):
+    """Restituisce (food_data, versione) dove la versione è l'hash del file JSON."""
+    with open(percorso, 'rb') as f:
+        contenuto = f.read()
+    return json.loads(contenuto.decode('utf-8')), hashlib.sha256(contenuto).hexdigest()[:16]
+
+
+def _leggi_snapshot(percorso, versione):
+    """Indice salvato in `percorso` se è della versione richiesta, altrimenti None."""
+    try:
+        with open(percorso, 'rb') as f:
+            # Prima l'intestazione: uno snapshot vecchio non viene deserializzato
+            if pickle.load(f) != (FORMATO_SNAPSHOT, VERSIONE_CODICE_INDICE, versione):
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Snapshot di food_data non leggibile ({e}): lo ricostruisco")
+        return None
+
+
+def salva_snapshot(indice, versione, percorso=FOOD_DATA_SNAPSHOT):
+    """Scrive lo snapshot in modo atomico (più worker possono farlo insieme)."""
+    try:
+        descrittore, temporaneo = tempfile.mkstemp(dir=os.path.dirname(percorso) or '.', suffix='.tmp')
+        with os.fdopen(descrittore, 'wb') as f:
+            pickle.dump((FORMATO_SNAPSHOT, VERSIONE_CODICE_INDICE, versione), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(indice, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # mkstemp crea il file con permessi 0600: altri utenti devono poterlo leggere
+        os.chmod(temporaneo, 0o644)
+        os.replace(temporaneo, percorso)
+    except OSError as e:
+        # Es. filesystem di sola lettura: si ricostruisce a ogni avvio
+        print(f"Snapshot di food_data non salvato: {e}")
+
+
+def carica_indice(percorso=FOOD_DATA_PATH, percorso_snapshot=FOOD_DATA_SNAPSHOT):
+    """Restituisce (indice, versione): dallo snapshot se aggiornato, altrimenti dal JSON."""
+    with open(percorso, 'rb') as f:
+        versione = hashlib.sha256(f.read()).hexdigest()[:16]
+    indice = _leggi_snapshot(percorso_snapshot, versione)
+    if indice is None:
+        food_data, versione = carica_food_data(percorso)
+        indice = IndiceAlimenti(food_data)
+        salva_snapshot(indice, versione, percorso_snapshot)
+    return indice, versione
+
+
+INDICE, VERSIONE_FOOD_DATA = carica_indice()
+food_data = INDICE.food_data
+
+trova_categoria = INDICE.trova_categoria
+trova_categoria_e_range = INDICE.trova_categoria_e_range
+corrisponde_a_prodotto = INDICE.corrisponde_a_prodotto
+trova_prodotto_approssimato = INDICE.trova_prodotto_approssimato
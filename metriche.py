@@ -0,0 +1,241 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+# ========== METRICHE ==========
+# Contatori e istogrammi in memoria, esposti in formato testo Prometheus su
+# /metrics. Ogni processo (worker gunicorn) ha il proprio registro.
+# Le operazioni sull'archivio vengono attribuite alla rotta della richiesta in
+# corso nel thread; fuori da una richiesta (pulizia periodica, comandi CLI)
+# risultano sotto la rotta 'background'.
+
+BUCKET_SECONDI = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BUCKET_CONTEGGI = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+ROTTA_BACKGROUND = 'background'
+
+
+def _formatta_etichette(nomi, valori, extra=()):
+    coppie = list(zip(nomi, valori)) + list(extra)
+    if not coppie:
+        return ''
+    testo = ','.join(
+        '{}="{}"'.format(nome, str(valore).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for nome, valore in coppie
+    )
+    return '{' + testo + '}'
+
+
+def _formatta_numero(valore):
+    if valore == float('inf'):
+        return '+Inf'
+    if float(valore).is_integer():
+        return str(int(valore))
+    return repr(float(valore))
+
+
+class Contatore:
+    tipo = 'counter'
+
+    def __init__(self, nome, descrizione, etichette=()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self._valori = {}
+        self._lock = threading.Lock()
+
+    def inc(self, valore=1, **etichette):
+        chiave = tuple(str(etichette[nome]) for nome in self.etichette)
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + valore
+
+    def totali_per(self, etichetta):
+        """Counter valore di `etichetta` -> somma delle serie con quel valore."""
+        posizione = self.etichette.index(etichetta)
+        totali = Counter()
+        with self._lock:
+            for chiave, valore in self._valori.items():
+                totali[chiave[posizione]] += valore
+        return totali
+
+    def righe(self):
+        with self._lock:
+            valori = sorted(self._valori.items())
+        for chiave, valore in valori:
+            yield f"{self.nome}{_formatta_etichette(self.etichette, chiave)} {_formatta_numero(valore)}"
+
+
+class Indicatore(Contatore):
+    """Valore che sale e scende (es. lunghezza di una coda)."""
+
+    tipo = 'gauge'
+
+    def imposta(self, valore, **etichette):
+        chiave = tuple(str(etichette[nome]) for nome in self.etichette)
+        with self._lock:
+            self._valori[chiave] = valore
+
+
+class Istogramma:
+    tipo = 'histogram'
+
+    def __init__(self, nome, descrizione, etichette=(), bucket=BUCKET_SECONDI):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self.bucket = tuple(sorted(bucket))
+        self._serie = {}  # chiave etichette -> [conteggi per bucket..., somma, totale]
+        self._lock = threading.Lock()
+
+    def osserva(self, valore, **etichette):
+        chiave = tuple(str(etichette[nome]) for nome in self.etichette)
+        indice = bisect.bisect_left(self.bucket, valore)
+        with self._lock:
+            serie = self._serie.get(chiave)
+            if serie is None:
+                serie = self._serie[chiave] = [0] * (len(self.bucket) + 2)
+            if indice < len(self.bucket):
+                serie[indice] += 1
+            serie[-2] += valore
+            serie[-1] += 1
+
+    def righe(self):
+        with self._lock:
+            serie = sorted((chiave, list(valori)) for chiave, valori in self._serie.items())
+        for chiave, valori in serie:
+            cumulato = 0
+            for limite, conteggio in zip(self.bucket, valori):
+                cumulato += conteggio
+                le = (('le', _formatta_numero(limite)),)
+                yield f"{self.nome}_bucket{_formatta_etichette(self.etichette, chiave, le)} {cumulato}"
+            le = (('le', '+Inf'),)
+            yield f"{self.nome}_bucket{_formatta_etichette(self.etichette, chiave, le)} {valori[-1]}"
+            yield f"{self.nome}_sum{_formatta_etichette(self.etichette, chiave)} {_formatta_numero(valori[-2])}"
+            yield f"{self.nome}_count{_formatta_etichette(self.etichette, chiave)} {valori[-1]}"
+
+
+class Registro:
+    def __init__(self):
+        self._metriche = []
+
+    def contatore(self, nome, descrizione, etichette=()):
+        metrica = Contatore(nome, descrizione, etichette)
+        self._metriche.append(metrica)
+        return metrica
+
+    def indicatore(self, nome, descrizione, etichette=()):
+        metrica = Indicatore(nome, descrizione, etichette)
+        self._metriche.append(metrica)
+        return metrica
+
+    def istogramma(self, nome, descrizione, etichette=(), bucket=BUCKET_SECONDI):
+        metrica = Istogramma(nome, descrizione, etichette, bucket)
+        self._metriche.append(metrica)
+        return metrica
+
+    def esporta(self):
+        """Tutte le metriche nel formato di esposizione testuale di Prometheus."""
+        righe = []
+        for metrica in self._metriche:
+            righe.append(f"# HELP {metrica.nome} {metrica.descrizione}")
+            righe.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            righe.extend(metrica.righe())
+        return '\n'.join(righe) + '\n'
+
+
+registro = Registro()
+
+DURATA_RICHIESTE = registro.istogramma(
+    'dispensa_richieste_durata_secondi', 'Durata delle richieste HTTP', ('rotta', 'metodo', 'stato'))
+OPERAZIONI_ARCHIVIO = registro.contatore(
+    'dispensa_archivio_operazioni_totale', "Letture, scritture e commit sull'archivio dati", ('rotta', 'tipo', 'operazione'))
+OPERAZIONI_PER_RICHIESTA = registro.istogramma(
+    'dispensa_archivio_operazioni_per_richiesta', "Operazioni sull'archivio eseguite da una singola richiesta",
+    ('rotta', 'tipo'), bucket=BUCKET_CONTEGGI)
+VERIFICA_TOKEN = registro.istogramma(
+    'dispensa_verifica_token_secondi', 'Tempo di verifica del token Firebase', ('esito',))
+FASI_OCR = registro.istogramma(
+    'dispensa_ocr_fase_secondi', "Durata delle fasi dell'analisi scontrini", ('fase',))
+OCR_IN_CORSO = registro.indicatore(
+    'dispensa_ocr_in_corso', 'Posti occupati da analisi scontrini sincrone (uno per immagine)')
+OCR_IN_ATTESA = registro.indicatore(
+    'dispensa_ocr_in_attesa', 'Analisi scontrini sincrone in attesa di un posto')
+OCR_JOB_IN_CODA = registro.indicatore(
+    'dispensa_ocr_job_in_coda', 'Job di analisi scontrini accodati e non ancora completati')
+for indicatore in (OCR_IN_CORSO, OCR_IN_ATTESA, OCR_JOB_IN_CODA):
+    indicatore.imposta(0)
+OCR_ATTESA = registro.istogramma(
+    'dispensa_ocr_attesa_secondi', "Attesa di un posto per l'analisi sincrona di uno scontrino")
+OCR_RIFIUTATE = registro.contatore(
+    'dispensa_ocr_rifiutate_totale', 'Analisi scontrini rifiutate per sovraccarico', ('rotta', 'motivo'))
+
+TIPI_OPERAZIONE = ('lettura', 'scrittura', 'commit')
+
+# ========== RICHIESTA CORRENTE ==========
+
+_contesto = threading.local()
+
+
+def inizia_richiesta(rotta):
+    _contesto.rotta = rotta
+    _contesto.inizio = time.perf_counter()
+    _contesto.operazioni = Counter()
+
+
+def termina_richiesta(metodo, stato):
+    rotta = getattr(_contesto, 'rotta', None)
+    if rotta is None:
+        return
+    DURATA_RICHIESTE.osserva(time.perf_counter() - _contesto.inizio, rotta=rotta, metodo=metodo, stato=stato)
+    for tipo in TIPI_OPERAZIONE:
+        OPERAZIONI_PER_RICHIESTA.osserva(_contesto.operazioni[tipo], rotta=rotta, tipo=tipo)
+    _contesto.rotta = None
+
+
+def registra_operazione_archivio(tipo, operazione):
+    rotta = getattr(_contesto, 'rotta', None)
+    if rotta is None:
+        rotta = ROTTA_BACKGROUND
+    else:
+        _contesto.operazioni[tipo] += 1
+    OPERAZIONI_ARCHIVIO.inc(rotta=rotta, tipo=tipo, operazione=operazione)
+
+
+def misura_archivio(archivio):
+    """
+    Conta le chiamate ai metodi dell'archivio (vedi Archivio.OPERAZIONI_LETTURA e
+    OPERAZIONI_SCRITTURA) e i commit dei suoi batch; restituisce lo stesso archivio.
+    """
+    def avvolgi(nome, tipo):
+        originale = getattr(archivio, nome)
+
+        def metodo(*args, **kwargs):
+            registra_operazione_archivio(tipo, nome)
+            return originale(*args, **kwargs)
+        setattr(archivio, nome, metodo)
+
+    for nome in archivio.OPERAZIONI_LETTURA:
+        avvolgi(nome, 'lettura')
+    for nome in archivio.OPERAZIONI_SCRITTURA:
+        avvolgi(nome, 'scrittura')
+
+    nuovo_batch = archivio.nuovo_batch
+
+    def nuovo_batch_misurato():
+        batch = nuovo_batch()
+        commit = batch.commit
+
+        def commit_misurato():
+            registra_operazione_archivio('commit', 'commit')
+            return commit()
+        batch.commit = commit_misurato
+        return batch
+    archivio.nuovo_batch = nuovo_batch_misurato
+    return archivio
+
+
+def registra_fasi_ocr(tempi_fasi):
+    """Registra le durate {fase: secondi} restituite da analizza_scontrino."""
+    for fase, secondi in (tempi_fasi or {}).items():
+        FASI_OCR.osserva(secondi, fase=fase)
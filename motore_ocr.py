@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:  # binding opzionale: serve libtesseract per compilarlo
+    tesserocr = None
+
+# ========== MOTORE OCR ==========
+# Con pytesseract ogni immagine avvia un nuovo processo `tesseract` che ricarica
+# ita.traineddata. Se è installato tesserocr (binding in-process) le istanze di
+# Tesseract restano caricate per tutta la vita del processo e vengono riusate;
+# altrimenti si ricade su pytesseract. preriscalda() carica le istanze all'avvio,
+# così il primo scontrino dopo un deploy non paga il caricamento.
+
+# ========== CONFIGURAZIONE TESSERACT (decommentare se necessario) ==========
+# WINDOWS:
+# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+# MAC (Homebrew):
+# pytesseract.pytesseract.tesseract_cmd = r"/usr/local/bin/tesseract"
+# pytesseract.pytesseract.tesseract_cmd = r"/opt/homebrew/bin/tesseract"
+
+# LINUX:
+# pytesseract.pytesseract.tesseract_cmd = r"/usr/bin/tesseract"
+
+# Configurazione ottimizzata per scontrini italiani
+TESSERACT_LINGUA = 'ita'
+TESSERACT_OEM = 3  # motore di default (LSTM se disponibile)
+TESSERACT_PSM = 6  # un unico blocco di testo uniforme
+TESSERACT_CONFIG = f'--oem {TESSERACT_OEM} --psm {TESSERACT_PSM} -l {TESSERACT_LINGUA}'
+
+# 'auto' (tesserocr se disponibile, altrimenti pytesseract), 'tesserocr' o 'pytesseract'
+OCR_MOTORE = os.environ.get('OCR_MOTORE', 'auto')
+# Istanze Tesseract caricate per processo: limitano le analisi contemporanee (e la memoria)
+OCR_ISTANZE_MOTORE = int(os.environ.get('OCR_ISTANZE_MOTORE', '2'))
+
+
+class MotorePytesseract:
+    """Un processo `tesseract` per immagine, tramite pytesseract."""
+
+    nome = 'pytesseract'
+
+    def riconosci(self, img):
+        """Restituisce (testo, confidenza media delle parole 0-100) con un solo passaggio di Tesseract."""
+        dati = pytesseract.image_to_data(img, config=TESSERACT_CONFIG, output_type=pytesseract.Output.DICT)
+
+        righe = {}
+        confidenze = []
+        for i, parola in enumerate(dati['text']):
+            parola = parola.strip()
+            if not parola:
+                continue
+            chiave = (dati['block_num'][i], dati['par_num'][i], dati['line_num'][i])
+            righe.setdefault(chiave, []).append(parola)
+            confidenza = float(dati['conf'][i])
+            if confidenza >= 0:
+                confidenze.append(confidenza)
+
+        testo = '\n'.join(' '.join(parole) for _, parole in sorted(righe.items()))
+        confidenza_media = sum(confidenze) / len(confidenze) if confidenze else 0.0
+        return testo, confidenza_media
+
+    def preriscalda(self):
+        # Non c'è niente da tenere caricato: verifica solo che il binario esista
+        pytesseract.get_tesseract_version()
+
+
+class MotoreTesserocr:
+    """Istanze PyTessBaseAPI caricate una volta e riusate (non sono thread-safe: una per analisi)."""
+
+    nome = 'tesserocr'
+
+    def __init__(self, max_istanze=OCR_ISTANZE_MOTORE):
+        self.max_istanze = max(1, max_istanze)
+        self._libere = queue.LifoQueue()
+        self._create = 0
+        self._lock = threading.Lock()
+
+    def _nuova_istanza(self):
+        return tesserocr.PyTessBaseAPI(lang=TESSERACT_LINGUA, psm=TESSERACT_PSM, oem=TESSERACT_OEM)
+
+    def _prendi(self):
+        try:
+            return self._libere.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            crea = self._create < self.max_istanze
+            if crea:
+                self._create += 1
+        if not crea:
+            # Tutte le istanze sono occupate: si aspetta la prima che si libera
+            return self._libere.get()
+        try:
+            return self._nuova_istanza()
+        except Exception:
+            with self._lock:
+                self._create -= 1
+            raise
+
+    def riconosci(self, img):
+        api = self._prendi()
+        try:
+            api.SetImage(Image.fromarray(img))
+            return api.GetUTF8Text(), float(api.MeanTextConf())
+        finally:
+            api.Clear()
+            self._libere.put(api)
+
+    def preriscalda(self):
+        """Carica tutte le istanze e fa un primo riconoscimento a vuoto su ognuna."""
+        vuota = np.full((32, 32), 255, dtype=np.uint8)
+        istanze = []
+        for _ in range(self.max_istanze):
+            istanze.append(self._prendi())
+        for api in istanze:
+            api.SetImage(Image.fromarray(vuota))
+            api.GetUTF8Text()
+            api.Clear()
+            self._libere.put(api)
+
+
+def nome_motore(tipo=OCR_MOTORE):
+    """Motore che crea_motore userà con questa configurazione (senza caricarlo)."""
+    if tipo == 'auto':
+        return 'tesserocr' if tesserocr is not None else 'pytesseract'
+    return tipo
+
+
+def crea_motore(tipo=OCR_MOTORE):
+    if tipo == 'tesserocr' and tesserocr is None:
+        raise ValueError("OCR_MOTORE=tesserocr ma il pacchetto tesserocr non è installato")
+    if tipo == 'tesserocr' or (tipo == 'auto' and tesserocr is not None):
+        motore = MotoreTesserocr()
+        if tipo == 'auto':
+            try:
+                # Verifica subito che le traineddata si carichino, altrimenti si usa pytesseract
+                motore._libere.put(motore._prendi())
+            except Exception as e:
+                print(f"tesserocr non utilizzabile ({e}): uso pytesseract")
+                return MotorePytesseract()
+        return motore
+    if tipo in ('auto', 'pytesseract'):
+        return MotorePytesseract()
+    raise ValueError(f"Motore OCR non supportato: {tipo}")
+
+
+_motore = None
+_motore_lock = threading.Lock()
+
+
+def motore_ocr():
+    """Motore del processo corrente, creato al primo uso."""
+    global _motore
+    if _motore is None:
+        with _motore_lock:
+            if _motore is None:
+                _motore = crea_motore()
+    return _motore
+
+
+def preriscalda():
+    """Da chiamare all'avvio del processo (worker web o worker del pool OCR)."""
+    try:
+        motore_ocr().preriscalda()
+    except Exception as e:
+        print(f"Preriscaldamento del motore OCR non riuscito: {e}")
@@ -1,40 +1,111 @@
-import pytesseract
 from PIL import Image
 import cv2
 import numpy as np
-import re
+import io
 import json
-from datetime import datetime, timedelta
-
-# ========== CONFIGURAZIONE TESSERACT (decommentare se necessario) ==========
-# WINDOWS:
-# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-
-# MAC (Homebrew):
-# pytesseract.pytesseract.tesseract_cmd = r"/usr/local/bin/tesseract"
-# pytesseract.pytesseract.tesseract_cmd = r"/opt/homebrew/bin/tesseract"
-
-# LINUX:
-# pytesseract.pytesseract.tesseract_cmd = r"/usr/bin/tesseract"
-
-# ========== CARICA DATI ALIMENTARI ==========
-with open('food_data.json', 'r', encoding='utf-8') as f:
-    food_data = json.load(f)
-
-# Crea lista di tutti i prodotti alimentari dal JSON e mappa prodotto -> categoria + range
-PRODOTTI_ALIMENTARI = []
-MAPPA_PRODOTTO_CATEGORIA = {}  # es: "finocchio" -> {"categoria": "verdura", "range_scadenza": "5-7 giorni (fresca), 3-4 mesi (congelata)"}
-
-for categoria in food_data['categorie_cibi']:
-    nome_cat = categoria['nome_categoria']
-    range_scad = categoria.get('range_scadenza', '')
-    for p in categoria['prodotti']:
-        pl = p.lower()
-        PRODOTTI_ALIMENTARI.append(pl)
-        MAPPA_PRODOTTO_CATEGORIA[pl] = {
-            'categoria': nome_cat,
-            'range_scadenza': range_scad
-        }
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from indice_alimenti import AutomaAhoCorasick, VERSIONE_FOOD_DATA, corrisponde_a_prodotto, trova_categoria_e_range
+from cache_ocr import CacheOCR
+from scadenze import scadenze_da_range
+from motore_ocr import TESSERACT_CONFIG, motore_ocr, nome_motore
+
+# La configurazione di Tesseract (percorso del binario, lingua, psm) è in motore_ocr.py
+
+# Lato corto minimo (in pixel) che serve a Tesseract: immagini molto più grandi
+# vengono decodificate già ridotte di 2x/4x/8x
+OCR_LATO_MINIMO = int(os.environ.get('OCR_LATO_MINIMO', '1000'))
+
+FLAG_DECODIFICA_RIDOTTA = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+FLAG_PER_FATTORE = {1: cv2.IMREAD_GRAYSCALE, **dict(FLAG_DECODIFICA_RIDOTTA)}
+
+# Profilo 'veloce': l'immagine viene ridotta alla risoluzione che serve davvero
+# (uno scontrino largo 80 mm a OCR_DPI_VELOCE) e il denoising NLM, che da solo
+# domina il tempo di CPU, è sostituito da un filtro mediano
+LARGHEZZA_SCONTRINO_MM = 80
+OCR_DPI_VELOCE = int(os.environ.get('OCR_DPI_VELOCE', '250'))
+OCR_LATO_VELOCE = round(LARGHEZZA_SCONTRINO_MM / 25.4 * OCR_DPI_VELOCE)
+
+PROFILI_PREPROCESSAMENTO = {
+    'veloce': {'lato_minimo': OCR_LATO_VELOCE, 'riduci': True, 'denoising': False},
+    'accurato': {'lato_minimo': OCR_LATO_MINIMO, 'riduci': False, 'denoising': True},
+}
+
+# 'adattivo': prima il profilo veloce, poi quello accurato solo se il risultato
+# non convince (confidenza media di Tesseract o prodotti trovati sotto soglia)
+OCR_PROFILO = os.environ.get('OCR_PROFILO', 'adattivo')
+OCR_CONFIDENZA_MINIMA = float(os.environ.get('OCR_CONFIDENZA_MINIMA', '60'))
+OCR_PRODOTTI_MINIMI = int(os.environ.get('OCR_PRODOTTI_MINIMI', '2'))
+
+if OCR_PROFILO != 'adattivo' and OCR_PROFILO not in PROFILI_PREPROCESSAMENTO:
+    raise ValueError(f"Profilo OCR non supportato: {OCR_PROFILO}")
+
+# OCR a strisce: uno scontrino lungo viene tagliato in strisce orizzontali in
+# corrispondenza di righe vuote e le strisce sono riconosciute in parallelo
+# (Tesseract usa un solo core per immagine). 0 o 1 thread = disattivato.
+OCR_THREAD_STRISCE = int(os.environ.get('OCR_THREAD_STRISCE', str(min(4, os.cpu_count() or 1))))
+OCR_ALTEZZA_MINIMA_STRISCIA = int(os.environ.get('OCR_ALTEZZA_MINIMA_STRISCIA', '600'))
+# Se il taglio non cade su una riga vuota le strisce si sovrappongono di tanti pixel
+OCR_SOVRAPPOSIZIONE_STRISCE = int(os.environ.get('OCR_SOVRAPPOSIZIONE_STRISCE', '48'))
+# Una riga è "vuota" se ha al massimo questa frazione di pixel scuri
+SOGLIA_RIGA_VUOTA = 0.002
+RIGHE_SOVRAPPOSTE_MAX = 4
+# Foto consecutive di uno scontrino lungo: la parte ripresa in entrambe può
+# essere molto più alta della sovrapposizione tra due strisce. Le righe in
+# comune si tolgono solo se sono identiche e tra loro ci sono almeno
+# OCR_RIGHE_COMUNI_MINIME_FOTO righe diverse: altrimenti le foto vengono solo
+# accodate (meglio un prodotto doppio da togliere a mano che uno vero perso)
+OCR_RIGHE_SOVRAPPOSTE_FOTO = int(os.environ.get('OCR_RIGHE_SOVRAPPOSTE_FOTO', '15'))
+OCR_RIGHE_COMUNI_MINIME_FOTO = int(os.environ.get('OCR_RIGHE_COMUNI_MINIME_FOTO', '3'))
+
+# Ritaglio: nelle foto lo scontrino (carta chiara) viene cercato sullo sfondo,
+# raddrizzato con una trasformazione prospettica e ritagliato, così Tesseract
+# elabora solo la carta. Con OCR_RITAGLIO_COLONNA=1 si tiene anche solo la
+# colonna delle descrizioni, tagliando IVA e prezzi a destra.
+OCR_RITAGLIO = os.environ.get('OCR_RITAGLIO', '1') == '1'
+OCR_RITAGLIO_COLONNA = os.environ.get('OCR_RITAGLIO_COLONNA', '0') == '1'
+# Il contorno si cerca su una copia ridotta a questo lato lungo
+LATO_ANALISI_RITAGLIO = 600
+# Frazione dell'immagine occupata dalla carta: sotto non è uno scontrino,
+# sopra l'immagine è già solo lo scontrino (es. screenshot o scansione)
+AREA_MINIMA_SCONTRINO = 0.15
+AREA_MASSIMA_SCONTRINO = 0.92
+# Tra due colonne l'inchiostro scende sotto questa frazione di quello del testo
+SOGLIA_VALLE_COLONNA = 0.25
+
+# Le voci in cache restano valide solo con la stessa config OCR e lo stesso
+# food_data.json: ogni impostazione che cambia il risultato di analizza_scontrino
+# va aggiunta qui (VERSIONE_PIPELINE va incrementata quando cambia il codice)
+VERSIONE_PIPELINE = 'v6'
+CONFIGURAZIONE_PIPELINE = {
+    'versione': VERSIONE_PIPELINE,
+    'food_data': VERSIONE_FOOD_DATA,
+    'tesseract': TESSERACT_CONFIG,
+    'motore': nome_motore(),
+    'profilo': OCR_PROFILO,
+    'profili': PROFILI_PREPROCESSAMENTO,
+    'confidenza_minima': OCR_CONFIDENZA_MINIMA,
+    'prodotti_minimi': OCR_PRODOTTI_MINIMI,
+    'thread_strisce': OCR_THREAD_STRISCE,
+    'altezza_minima_striscia': OCR_ALTEZZA_MINIMA_STRISCIA,
+    'sovrapposizione_strisce': OCR_SOVRAPPOSIZIONE_STRISCE,
+    'soglia_riga_vuota': SOGLIA_RIGA_VUOTA,
+    'righe_sovrapposte_max': RIGHE_SOVRAPPOSTE_MAX,
+    'ritaglio': OCR_RITAGLIO,
+    'ritaglio_colonna': OCR_RITAGLIO_COLONNA,
+    'lato_analisi_ritaglio': LATO_ANALISI_RITAGLIO,
+    'area_scontrino': (AREA_MINIMA_SCONTRINO, AREA_MASSIMA_SCONTRINO),
+    'soglia_valle_colonna': SOGLIA_VALLE_COLONNA,
+}
+cache_risultati = CacheOCR(json.dumps(CONFIGURAZIONE_PIPELINE, sort_keys=True))
 
 # ========== PAROLE CHIAVE NON ALIMENTARI ==========
 PAROLE_NON_ALIMENTARI = [
@@ -48,65 +119,243 @@ PAROLE_NON_ALIMENTARI = [
     'utensile', 'attrezzo',
     'plastica', 'carta', 'contenitore', 'borsa', 'shopper'
 ]
+AUTOMA_NON_ALIMENTARI = AutomaAhoCorasick(PAROLE_NON_ALIMENTARI)
+
+# ========== LESSICO DELLE RIGHE ==========
+# Parole che identificano intestazioni/footer (cercate ovunque nella riga)
+PAROLE_INTESTAZIONE = [
+    'totale', 'subtotale', 'resto', 'contante', 'carta',
+    'iva', 'riepilogo', 'digitale', 'acquisto', 'documento',
+    'pagamento', 'importo', 'lidl italia', 'roma', 'via',
+    'raee', 'cdc', 'valore sconti', 'totale complessivo',
+    'rt ', 'doc.', 'documento n.', 'importo pagato'
+]
+RE_INTESTAZIONE = re.compile('|'.join(map(re.escape, PAROLE_INTESTAZIONE)))
+
+# Un importo con i centesimi ("1,79", "2,50kg"): la riga non è una descrizione
+RE_PREZZO = re.compile(r'\d+[,.]\d{2}')
+
+# Quantità nella descrizione (già in minuscolo): vince la prima che trova qualcosa
+RE_NOME_KG = re.compile(r'(\d+[,.]?\d*)\s*kg')
+RE_NOME_G = re.compile(r'(\d+)\s*g\b')
+
+# Quantità nella riga di peso (già in minuscolo), nell'ordine in cui vanno provate:
+# "0,510 kg", "2 kg", "= 800g", "800g", "2 x"
+RE_PESO_KG_DECIMALI = re.compile(r'(\d+[,.]\d+)\s*kg')
+RE_PESO_KG = re.compile(r'(\d+)\s*kg')
+RE_PESO_UGUALE_G = re.compile(r'=\s*(\d+)\s*g')
+RE_PESO_G = re.compile(r'(\d+)\s*g\b')
+RE_PESO_PEZZI = re.compile(r'(\d+)\s*x\b')
+
+# Cosa pulisci_nome_prodotto toglie dal nome, nell'ordine in cui va tolto (ogni
+# sostituzione vede il risultato della precedente): prezzi, percentuali, EUR/kg,
+# pesi (1kg, 800G), PZ, valute; gli altri simboli diventano spazi
+PULIZIA_NOME = (
+    (re.compile(r'\d+[,.]\d+\s*€?'), ''),
+    (re.compile(r'\d+%'), ''),
+    (re.compile(r'eur/kg', re.IGNORECASE), ''),
+    (re.compile(r'\b\d+[,.]?\d*\s*(kg|g)\b', re.IGNORECASE), ''),
+    (re.compile(r'\bpz\b', re.IGNORECASE), ''),
+    (re.compile(r'€|eur|\$', re.IGNORECASE), ''),
+    (re.compile(r'[^\w\s.]'), ' '),
+)
 
-# ========== UTILITY PER DATE/SCADENZE ==========
-
-def aggiungi_giorni_oggi(n_giorni):
-    return (datetime.today() + timedelta(days=n_giorni)).strftime("%Y-%m-%d")
+# ========== OCR E PARSING TESTO ==========
 
-def aggiungi_mesi_oggi(n_mesi):
-    # Approssimiamo 1 mese = 30 giorni
-    return (datetime.today() + timedelta(days=30 * n_mesi)).strftime("%Y-%m-%d")
+def leggi_immagine(immagine):
+    """Accetta i byte dell'immagine (bytes, bytearray, memoryview) oppure un percorso su disco"""
+    if isinstance(immagine, (str, os.PathLike)):
+        with open(immagine, 'rb') as f:
+            return f.read()
+    return immagine
 
-def stima_scadenze_da_range(range_scadenza):
+def dimensioni_immagine(contenuto):
+    """(larghezza, altezza) dall'intestazione del file, senza decodificare i pixel; None se illeggibile"""
+    try:
+        return Image.open(io.BytesIO(contenuto)).size
+    except Exception:
+        return None
+
+def fattore_riduzione(lato, lato_minimo):
+    """Il fattore di FLAG_DECODIFICA_RIDOTTA più grande che lascia `lato` ad almeno `lato_minimo` (1 = nessuno)"""
+    for fattore, _ in FLAG_DECODIFICA_RIDOTTA:
+        if lato // fattore >= lato_minimo:
+            return fattore
+    return 1
+
+def flag_decodifica(contenuto, lato_minimo=OCR_LATO_MINIMO):
+    """Sceglie il flag di imdecode: riduce la risoluzione se l'immagine è molto più grande del necessario"""
+    dimensioni = dimensioni_immagine(contenuto)
+    if dimensioni is None:
+        return cv2.IMREAD_GRAYSCALE
+    return FLAG_PER_FATTORE[fattore_riduzione(min(dimensioni), lato_minimo)]
+
+def decodifica_con_flag(contenuto, flag):
+    buffer = np.frombuffer(memoryview(contenuto), dtype=np.uint8)
+    gray = cv2.imdecode(buffer, flag)
+    if gray is None:
+        raise ValueError("Immagine non valida o formato non supportato")
+    return gray
+
+def decodifica_immagine(contenuto, lato_minimo=OCR_LATO_MINIMO):
+    """Decodifica l'immagine direttamente dal buffer in memoria, in scala di grigi"""
+    return decodifica_con_flag(contenuto, flag_decodifica(contenuto, lato_minimo))
+
+def riduci_immagine(gray, lato_minimo):
+    """Riduce l'immagine (senza mai ingrandirla) finché il lato corto è circa `lato_minimo`"""
+    lato_corto = min(gray.shape[:2])
+    if lato_corto <= lato_minimo * 1.25:
+        return gray
+    scala = lato_minimo / lato_corto
+    return cv2.resize(gray, None, fx=scala, fy=scala, interpolation=cv2.INTER_AREA)
+
+def ordina_vertici(vertici):
+    """Ordina 4 punti come alto-sinistra, alto-destra, basso-destra, basso-sinistra"""
+    somma = vertici.sum(axis=1)
+    differenza = np.diff(vertici, axis=1).ravel()
+    return np.array([
+        vertici[np.argmin(somma)],
+        vertici[np.argmin(differenza)],
+        vertici[np.argmax(somma)],
+        vertici[np.argmax(differenza)],
+    ], dtype=np.float32)
+
+def trova_contorno_scontrino(gray):
     """
-    Dal testo tipo:
-      "5-7 giorni (fresca), 3-4 mesi (congelata)"
-    ricava due date:
-      - scadenza_suggerita (fresca)
-      - scadenza_surgelato  (congelata)
-    Se qualcosa non torna, usa fallback generici.
+    Cerca la carta dello scontrino (la regione chiara più grande) e ne restituisce
+    i 4 vertici ordinati, nelle coordinate di `gray`; None se non la trova
     """
-    range_scadenza = (range_scadenza or "").lower()
-    scadenza_suggerita = aggiungi_giorni_oggi(5)   # default fresh
-    scadenza_surgelato = aggiungi_mesi_oggi(3)     # default frozen
-
-    # fresca: "x-y giorni (fresca)"
-    match_fresca = re.search(r'(\d+)\s*-\s*(\d+)\s*giorni\s*\(fresca', range_scadenza)
-    if match_fresca:
-        min_g = int(match_fresca.group(1))
-        max_g = int(match_fresca.group(2))
-        media = (min_g + max_g) // 2
-        scadenza_suggerita = aggiungi_giorni_oggi(media)
+    altezza, larghezza = gray.shape[:2]
+    scala = min(1.0, LATO_ANALISI_RITAGLIO / max(altezza, larghezza))
+    piccola = cv2.resize(gray, None, fx=scala, fy=scala, interpolation=cv2.INTER_AREA) if scala < 1 else gray
+
+    sfocata = cv2.GaussianBlur(piccola, (5, 5), 0)
+    _, maschera = cv2.threshold(sfocata, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Chiude i buchi lasciati dal testo stampato, così la carta è un'unica regione
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+    maschera = cv2.morphologyEx(maschera, cv2.MORPH_CLOSE, kernel)
+
+    contorni, _ = cv2.findContours(maschera, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contorni:
+        return None
+    contorno = max(contorni, key=cv2.contourArea)
+    frazione = cv2.contourArea(contorno) / float(piccola.shape[0] * piccola.shape[1])
+    if not AREA_MINIMA_SCONTRINO <= frazione <= AREA_MASSIMA_SCONTRINO:
+        return None
+
+    approssimato = cv2.approxPolyDP(contorno, 0.02 * cv2.arcLength(contorno, True), True)
+    if len(approssimato) == 4 and cv2.isContourConvex(approssimato):
+        # Quadrilatero: corregge anche la prospettiva
+        vertici = approssimato.reshape(4, 2).astype(np.float32)
     else:
-        # altri pattern tipo "3 giorni (fresco)" ecc.
-        match_fresco_singolo = re.search(r'(\d+)\s*giorni?\s*\(fresc', range_scadenza)
-        if match_fresco_singolo:
-            giorni = int(match_fresco_singolo.group(1))
-            scadenza_suggerita = aggiungi_giorni_oggi(giorni)
-
-    # congelata / surgelata: "x-y mesi (congelata)"
-    match_congelata = re.search(r'(\d+)\s*-\s*(\d+)\s*mesi\s*\((congelata|congelato)', range_scadenza)
-    if match_congelata:
-        min_m = int(match_congelata.group(1))
-        max_m = int(match_congelata.group(2))
-        media = (min_m + max_m) // 2
-        scadenza_surgelato = aggiungi_mesi_oggi(media)
+        # Bordi irregolari (carta strappata o arricciata): rettangolo ruotato minimo
+        vertici = cv2.boxPoints(cv2.minAreaRect(contorno))
+    return ordina_vertici(vertici / scala)
+
+def dimensioni_quadrilatero(vertici):
+    """(larghezza, altezza) del rettangolo in cui raddrizza_scontrino porta `vertici`"""
+    alto_sx, alto_dx, basso_dx, basso_sx = vertici
+    larghezza = int(round(max(np.linalg.norm(alto_dx - alto_sx), np.linalg.norm(basso_dx - basso_sx))))
+    altezza = int(round(max(np.linalg.norm(basso_sx - alto_sx), np.linalg.norm(basso_dx - alto_dx))))
+    return larghezza, altezza
+
+def raddrizza_scontrino(gray, vertici):
+    """Porta il quadrilatero `vertici` in un rettangolo dritto (prospettiva e inclinazione)"""
+    larghezza, altezza = dimensioni_quadrilatero(vertici)
+    if larghezza < 2 or altezza < 2:
+        return gray
+
+    destinazione = np.array(
+        [[0, 0], [larghezza - 1, 0], [larghezza - 1, altezza - 1], [0, altezza - 1]], dtype=np.float32)
+    matrice = cv2.getPerspectiveTransform(vertici, destinazione)
+    return cv2.warpPerspective(gray, matrice, (larghezza, altezza),
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def ritaglia_colonna_prodotti(gray):
+    """
+    Tiene solo la colonna delle descrizioni (con le righe peso): taglia a metà
+    della valle verticale più larga nella metà destra, quella prima dei prezzi.
+    Intestazione e piè di pagina attraversano tutte le colonne, quindi la valle
+    è cercata sul profilo di inchiostro smussato e relativo alla colonna di testo.
+    """
+    _, testo = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    larghezza = testo.shape[1]
+    finestra = max(3, int(larghezza * 0.02))
+    profilo = np.convolve(np.count_nonzero(testo, axis=0), np.ones(finestra) / finestra, mode='same')
+    riferimento = np.median(profilo[:larghezza // 2])
+    if riferimento <= 0:
+        return gray
+    valle = profilo <= riferimento * SOGLIA_VALLE_COLONNA
+
+    # Tratti consecutivi di valle nella metà destra: (inizio, fine)
+    bordi = np.flatnonzero(np.diff(np.concatenate(([0], valle[larghezza // 2:].astype(np.int8), [0]))))
+    tratti = [(inizio + larghezza // 2, fine + larghezza // 2) for inizio, fine in zip(bordi[::2], bordi[1::2])]
+    # Una valle che arriva al bordo destro è solo margine, non separa due colonne
+    tratti = [(inizio, fine) for inizio, fine in tratti if fine < larghezza and fine - inizio >= larghezza * 0.03]
+    if not tratti:
+        return gray
+    inizio, fine = max(tratti, key=lambda tratto: tratto[1] - tratto[0])
+    return gray[:, :(inizio + fine) // 2]
+
+def ritaglia_scontrino(gray, solo_colonna=OCR_RITAGLIO_COLONNA):
+    """
+    Ritaglio della carta dello scontrino con correzione di prospettiva e
+    inclinazione; se la carta non si distingue dallo sfondo (o è già tutta
+    l'immagine) l'immagine resta com'è
+    """
+    vertici = trova_contorno_scontrino(gray)
+    if vertici is not None:
+        gray = raddrizza_scontrino(gray, vertici)
+    if solo_colonna:
+        gray = ritaglia_colonna_prodotti(gray)
+    return gray
+
+def decodifica_e_ritaglia(contenuto, lato_minimo, solo_colonna=OCR_RITAGLIO_COLONNA):
+    """
+    Come decodifica_immagine + ritaglia_scontrino, ma il fattore di riduzione
+    della decodifica è scelto sul lato corto della carta e non dell'intera foto:
+    il contorno si cerca su una decodifica molto ridotta, poi l'immagine viene
+    ridecodificata alla risoluzione che lascia lo scontrino ad almeno `lato_minimo`.
+    """
+    dimensioni = dimensioni_immagine(contenuto)
+    if dimensioni is None:
+        return ritaglia_scontrino(decodifica_con_flag(contenuto, cv2.IMREAD_GRAYSCALE), solo_colonna)
+
+    lato_lungo = max(dimensioni)
+    fattore_analisi = fattore_riduzione(lato_lungo, LATO_ANALISI_RITAGLIO)
+    piccola = decodifica_con_flag(contenuto, FLAG_PER_FATTORE[fattore_analisi])
+    vertici = trova_contorno_scontrino(piccola)
+    if vertici is None:
+        # Niente sfondo da togliere: vale il lato corto dell'intera foto
+        fattore = fattore_riduzione(min(dimensioni), lato_minimo)
+        gray = piccola if fattore == fattore_analisi else decodifica_con_flag(contenuto, FLAG_PER_FATTORE[fattore])
     else:
-        # pattern tipo "6 mesi (congelato)"
-        match_cong_singolo = re.search(r'(\d+)\s*mesi\s*\((congelato|congelata)', range_scadenza)
-        if match_cong_singolo:
-            mesi = int(match_cong_singolo.group(1))
-            scadenza_surgelato = aggiungi_mesi_oggi(mesi)
-
-    return scadenza_suggerita, scadenza_surgelato
-
-# ========== OCR E PARSING TESTO ==========
-
-def preprocessa_immagine(image_path):
-    """Migliora la qualità dell'immagine per OCR"""
-    img = cv2.imread(image_path)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # max dei lati: imdecode applica l'orientamento EXIF, l'intestazione no
+        scala_originale = lato_lungo / max(piccola.shape[:2])
+        lato_carta = min(dimensioni_quadrilatero(vertici)) * scala_originale
+        fattore = fattore_riduzione(lato_carta, lato_minimo)
+        gray = piccola if fattore == fattore_analisi else decodifica_con_flag(contenuto, FLAG_PER_FATTORE[fattore])
+        scala = np.array([gray.shape[1] / piccola.shape[1], gray.shape[0] / piccola.shape[0]], dtype=np.float32)
+        gray = raddrizza_scontrino(gray, vertici * scala)
+    if solo_colonna:
+        gray = ritaglia_colonna_prodotti(gray)
+    return gray
+
+def preprocessa_immagine(contenuto, profilo='accurato', tempi=None):
+    """
+    Migliora la qualità dell'immagine per OCR secondo uno dei PROFILI_PREPROCESSAMENTO;
+    se passato, `tempi` riceve anche la durata del ritaglio (es. 'ritaglio_veloce')
+    """
+    tempi = {} if tempi is None else tempi
+    parametri = PROFILI_PREPROCESSAMENTO[profilo]
+    if OCR_RITAGLIO:
+        # La riduzione (in decodifica e dopo) considera il lato corto della carta, non della foto
+        with cronometra(tempi, f'ritaglio_{profilo}'):
+            gray = decodifica_e_ritaglia(contenuto, parametri['lato_minimo'])
+    else:
+        gray = decodifica_immagine(contenuto, parametri['lato_minimo'])
+    if parametri['riduci']:
+        gray = riduci_immagine(gray, parametri['lato_minimo'])
 
     # Aumenta contrasto
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -119,66 +368,210 @@ def preprocessa_immagine(image_path):
         cv2.THRESH_BINARY, 11, 2
     )
 
+    if not parametri['denoising']:
+        # Toglie solo i puntini isolati lasciati dalla binarizzazione
+        return cv2.medianBlur(thresh, 3)
+
     # Denoising
     denoised = cv2.fastNlMeansDenoising(thresh)
 
     return denoised
 
-def estrai_testo_da_scontrino(image_path):
-    """Estrae il testo dallo scontrino"""
-    img_processed = preprocessa_immagine(image_path)
+def riconosci_testo_e_confidenza(img_processed):
+    """
+    OCR vero e proprio sull'immagine già preprocessata, con il motore del processo
+    (vedi motore_ocr.py): restituisce (testo, confidenza media delle parole, 0-100)
+    """
+    return motore_ocr().riconosci(img_processed)
 
-    # Configurazione ottimizzata per scontrini italiani
-    custom_config = r'--oem 3 --psm 6 -l ita'
-    testo = pytesseract.image_to_string(img_processed, config=custom_config)
+def riconosci_testo(img_processed):
+    return riconosci_testo_e_confidenza(img_processed)[0]
 
-    return testo
+# ========== OCR A STRISCE ==========
 
-def pulisci_nome_prodotto(nome):
-    """Pulisce il nome prodotto eliminando prezzi, numeri di peso e sigle tipo 'PZ', 'KG'."""
-    # Rimuovi prezzi e percentuali
-    nome = re.sub(r'\d+[,\.]\d+\s*€?', '', nome)
-    nome = re.sub(r'\d+%', '', nome)
-    nome = re.sub(r'EUR/kg', '', nome, flags=re.IGNORECASE)
+def trova_tagli(img, n_strisce):
+    """
+    Righe in cui tagliare l'immagine (binarizzata, testo scuro su bianco) in
+    `n_strisce` strisce di altezza simile. Dal profilo di proiezione orizzontale
+    (pixel scuri per riga) si sceglie, vicino a ogni taglio ideale, la riga vuota
+    più vicina; se non ce ne sono, la riga con meno inchiostro.
+    Restituisce [(riga, pulito)], dove pulito=False se il taglio attraversa del testo.
+    """
+    altezza, larghezza = img.shape[:2]
+    inchiostro = np.count_nonzero(img < 128, axis=1)
+    vuote = inchiostro <= larghezza * SOGLIA_RIGA_VUOTA
+    passo = altezza / n_strisce
+    raggio = int(passo / 4)
+
+    tagli = []
+    for k in range(1, n_strisce):
+        ideale = int(passo * k)
+        inizio, fine = max(0, ideale - raggio), min(altezza, ideale + raggio)
+        candidate = np.flatnonzero(vuote[inizio:fine])
+        if candidate.size:
+            riga = inizio + int(candidate[np.argmin(np.abs(candidate + inizio - ideale))])
+            tagli.append((riga, True))
+        else:
+            tagli.append((inizio + int(np.argmin(inchiostro[inizio:fine])), False))
+    return tagli
+
+def dividi_in_strisce(img, n_strisce, sovrapposizione=OCR_SOVRAPPOSIZIONE_STRISCE):
+    """
+    Strisce (viste sull'immagine, senza copie), sovrapposte solo dove il taglio
+    non è pulito: [(striscia, sovrapposta alla precedente)]
+    """
+    altezza = img.shape[0]
+    bordi = [(0, True)] + trova_tagli(img, n_strisce) + [(altezza, True)]
+    strisce = []
+    for (alto, alto_pulito), (basso, basso_pulito) in zip(bordi, bordi[1:]):
+        alto = alto if alto_pulito else max(0, alto - sovrapposizione)
+        basso = basso if basso_pulito else min(altezza, basso + sovrapposizione)
+        if basso > alto:
+            strisce.append((img[alto:basso], not alto_pulito))
+    return strisce
+
+def _righe_simili(a, b):
+    a = ' '.join(a.lower().split())
+    b = ' '.join(b.lower().split())
+    return a == b or SequenceMatcher(None, a, b).ratio() >= 0.85
+
+def _righe_in_comune(precedenti, nuove):
+    """
+    Quante righe iniziali di `nuove` ripetono la fine di `precedenti` (la zona
+    sovrapposta); tollera una riga spezzata dal taglio su ciascun lato.
+    Restituisce (righe da togliere in fondo a precedenti, righe da saltare in nuove).
+    """
+    for k in range(min(RIGHE_SOVRAPPOSTE_MAX, len(precedenti), len(nuove)), 0, -1):
+        for scarto_fine in (0, 1):
+            for scarto_inizio in (0, 1):
+                coda = precedenti[len(precedenti) - scarto_fine - k:len(precedenti) - scarto_fine]
+                testa = nuove[scarto_inizio:scarto_inizio + k]
+                if len(coda) == k and len(testa) == k and all(map(_righe_simili, coda, testa)):
+                    return scarto_fine, scarto_inizio + k
+    return 0, 0
+
+def unisci_testi_strisce(testi):
+    """
+    Concatena il testo delle strisce [(testo, sovrapposta alla precedente)]
+    togliendo le righe lette due volte nelle zone sovrapposte. Dove il taglio è
+    pulito non si toglie niente: due righe uguali lì sono due prodotti uguali.
+    """
+    righe = []
+    for testo, sovrapposta in testi:
+        nuove = [r for r in testo.split('\n') if r.strip()]
+        if not sovrapposta:
+            righe.extend(nuove)
+            continue
+        da_togliere, da_saltare = _righe_in_comune(righe, nuove)
+        if da_togliere:
+            del righe[-da_togliere:]
+        righe.extend(nuove[da_saltare:])
+    return '\n'.join(righe)
+
+def _righe_in_comune_foto(precedenti, nuove, righe_max=OCR_RIGHE_SOVRAPPOSTE_FOTO,
+                          righe_min=OCR_RIGHE_COMUNI_MINIME_FOTO):
+    """
+    Quante righe iniziali di `nuove` (già normalizzate) ripetono esattamente la
+    fine di `precedenti`: la sovrapposizione più lunga con almeno `righe_min`
+    righe diverse, senza scarti per righe tagliate. Un prodotto ripetuto (tre
+    FAGIOLI BORLOTTI di fila) non dice dove riprende la foto e non conta.
+    """
+    righe_min = max(1, righe_min)
+    for k in range(min(righe_max, len(precedenti), len(nuove)), righe_min - 1, -1):
+        if precedenti[-k:] == nuove[:k] and len(set(nuove[:k])) >= righe_min:
+            return k
+    return 0
+
+def unisci_testi_foto(testi):
+    """
+    Concatena il testo di più foto consecutive dello stesso scontrino togliendo
+    la parte ripresa in entrambe, solo se è sicuramente la stessa (vedi
+    _righe_in_comune_foto); le righe sono confrontate senza maiuscole e spazi doppi.
+    """
+    righe = []
+    normalizzate = []
+    for testo in testi:
+        nuove = [r for r in testo.split('\n') if r.strip()]
+        nuove_normalizzate = [' '.join(r.lower().split()) for r in nuove]
+        da_saltare = _righe_in_comune_foto(normalizzate, nuove_normalizzate)
+        righe.extend(nuove[da_saltare:])
+        normalizzate.extend(nuove_normalizzate[da_saltare:])
+    return '\n'.join(righe)
+
+_esecutore_strisce = None
+
+def _esecutore():
+    global _esecutore_strisce
+    if _esecutore_strisce is None:
+        _esecutore_strisce = ThreadPoolExecutor(max_workers=OCR_THREAD_STRISCE, thread_name_prefix='ocr-striscia')
+    return _esecutore_strisce
+
+def riconosci_a_strisce(img_processed):
+    """
+    Come riconosci_testo_e_confidenza, ma le immagini abbastanza alte sono
+    divise in strisce riconosciute in parallelo (pytesseract lancia un processo
+    per striscia, tesserocr rilascia il GIL: vedi OCR_ISTANZE_MOTORE).
+    """
+    n_strisce = min(OCR_THREAD_STRISCE, img_processed.shape[0] // OCR_ALTEZZA_MINIMA_STRISCIA)
+    if n_strisce < 2:
+        return riconosci_testo_e_confidenza(img_processed)
+
+    strisce = dividi_in_strisce(img_processed, n_strisce)
+    risultati = list(_esecutore().map(riconosci_testo_e_confidenza, [striscia for striscia, _ in strisce]))
+    testo = unisci_testi_strisce([(t, sovrapposta) for (t, _), (_, sovrapposta) in zip(risultati, strisce)])
+    # Confidenza media pesata sulla quantità di testo di ogni striscia
+    peso_totale = sum(len(t) for t, _ in risultati)
+    if peso_totale == 0:
+        return testo, 0.0
+    return testo, sum(len(t) * c for t, c in risultati) / peso_totale
+
+@contextmanager
+def cronometra(tempi, fase):
+    """Registra in `tempi[fase]` la durata (in secondi) del blocco"""
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tempi[fase] = time.perf_counter() - inizio
+
+def estrai_testo_e_confidenza(contenuto, profilo='accurato', tempi=None):
+    """
+    Estrae il testo dallo scontrino con il profilo di preprocessing indicato;
+    se passato, `tempi` riceve la durata di ogni fase (es. 'ocr_veloce')
+    """
+    tempi = {} if tempi is None else tempi
 
-    # Rimuovi sequenze tipo "1kg", "4Kg", "800G"
-    nome = re.sub(r'\b\d+[,\.]?\d*\s*(kg|g)\b', '', nome, flags=re.IGNORECASE)
+    # 'preprocessa_*' comprende anche 'ritaglio_*'
+    with cronometra(tempi, f'preprocessa_{profilo}'):
+        img_processed = preprocessa_immagine(contenuto, profilo, tempi)
 
-    # Rimuovi sigle di pezzi tipo "PZ", "Pz"
-    nome = re.sub(r'\bpz\b', '', nome, flags=re.IGNORECASE)
+    with cronometra(tempi, f'ocr_{profilo}'):
+        return riconosci_a_strisce(img_processed)
 
-    # Rimuovi simboli di valuta
-    nome = re.sub(r'€|EUR|\$', '', nome, flags=re.IGNORECASE)
+def estrai_testo_da_scontrino(contenuto, tempi=None, profilo='accurato'):
+    """Estrae il testo dallo scontrino"""
+    return estrai_testo_e_confidenza(contenuto, profilo, tempi)[0]
 
-    # Mantieni solo lettere, numeri, spazi e punti
-    nome = re.sub(r'[^\w\s\.]', ' ', nome)
+def pulisci_nome_prodotto(nome):
+    """Pulisce il nome prodotto eliminando prezzi, numeri di peso e sigle tipo 'PZ', 'KG'."""
+    for espressione, sostituto in PULIZIA_NOME:
+        nome = espressione.sub(sostituto, nome)
 
     # Rimuovi spazi multipli
-    nome = ' '.join(nome.split())
-
-    return nome.strip()
+    return ' '.join(nome.split())
 
 def e_prodotto_alimentare(nome):
     """Verifica se il prodotto è alimentare"""
     nome_lower = nome.lower().strip()
 
     # 1. Controlla parole chiave NON alimentari
-    for parola_non_alimentare in PAROLE_NON_ALIMENTARI:
-        if parola_non_alimentare in nome_lower:
-            return False
+    if AUTOMA_NON_ALIMENTARI.contiene(nome_lower):
+        return False
 
-    # 2. Match diretto con il db
-    if nome_lower in PRODOTTI_ALIMENTARI:
+    # 2-3. Match diretto o parziale con il db
+    if corrisponde_a_prodotto(nome_lower):
         return True
 
-    # 3. Match parziale (parole in comune)
-    parole_nome = nome_lower.split()
-    for parola in parole_nome:
-        if len(parola) > 2:
-            for prodotto_db in PRODOTTI_ALIMENTARI:
-                if parola in prodotto_db or prodotto_db in parola:
-                    return True
-
     # 4. Euristica
     parole_cibo = [
         'kg', 'grammi', 'gr', 'pz',
@@ -193,28 +586,28 @@ def e_prodotto_alimentare(nome):
 
     return False
 
-def trova_categoria_e_range(nome):
+def analizza_riga(riga):
     """
-    Dato un nome prodotto 'Finocchio', 'Mango', 'Mozzarella Multipack', ecc.
-    prova a trovare la categoria (verdura, frutta...) e il range_scadenza associato.
+    Classifica una riga dello scontrino, leggendone il testo in minuscolo una volta sola:
+      - tipo: 'intestazione' (intestazioni/footer), 'peso' (0,510 kg x 1,79 EUR/kg),
+        'prezzo' (righe con importi) oppure 'descrizione'
+      - peso_successivo: se, seguendo una descrizione, va letta come sua riga di peso
     """
-    nome_lower = nome.lower()
-    # 1) match diretto
-    if nome_lower in MAPPA_PRODOTTO_CATEGORIA:
-        info = MAPPA_PRODOTTO_CATEGORIA[nome_lower]
-        return info['categoria'], info.get('range_scadenza', '')
-
-    # 2) match parziale: se una delle parole del nome è contenuta in un prodotto noto
-    parole = nome_lower.split()
-    for parola in parole:
-        if len(parola) < 3:
-            continue
-        for prodotto_db, info in MAPPA_PRODOTTO_CATEGORIA.items():
-            if parola in prodotto_db or prodotto_db in parola:
-                return info['categoria'], info.get('range_scadenza', '')
+    low = riga.lower()
+    if RE_INTESTAZIONE.search(low):
+        tipo = 'intestazione'
+    elif 'eur/kg' in low:
+        tipo = 'peso'
+    elif RE_PREZZO.search(riga):
+        tipo = 'prezzo'
+    else:
+        tipo = 'descrizione'
 
-    # fallback
-    return 'altro', ''
+    return {
+        'testo': riga,
+        'tipo': tipo,
+        'peso_successivo': 'kg' in low or ' g' in low
+    }
 
 def estrai_quantita_e_unita_da_nome(nome_originale):
     """
@@ -223,16 +616,14 @@ def estrai_quantita_e_unita_da_nome(nome_originale):
     n = nome_originale.lower()
 
     # Patate 4Kg → 4 kg
-    match_kg = re.search(r'(\d+[,\.]?\d*)\s*kg', n, re.IGNORECASE)
-    if match_kg:
-        valore = match_kg.group(1).replace(',', '.')
-        return float(valore), 'kg'
+    m = RE_NOME_KG.search(n)
+    if m:
+        return float(m.group(1).replace(',', '.')), 'kg'
 
     # Carote 800G → 800 g
-    match_g = re.search(r'(\d+)\s*g\b', n, re.IGNORECASE)
-    if match_g:
-        valore = int(match_g.group(1))
-        return valore, 'g'
+    m = RE_NOME_G.search(n)
+    if m:
+        return int(m.group(1)), 'g'
 
     # Mango Pz → 1 pz
     if 'pz' in n:
@@ -248,46 +639,23 @@ def estrai_quantita_e_unita(riga_originale, nome_originale=None):
     - '1 x 800g = 800g'
     Se nome_originale è presente, prova anche a leggerlo da lì (Patate 4Kg, Carote 800G, Mango Pz).
     """
-    r = riga_originale.lower()
-
     # 1) Prova prima dal nome (Patate 4Kg, Carote 800G, Mango Pz)
     if nome_originale:
         q_nome, u_nome = estrai_quantita_e_unita_da_nome(nome_originale)
         if q_nome is not None:
             return q_nome, u_nome
 
-    # 2) Poi prova dalla riga di peso/prezzo
-    # Pattern tipo: 0,510 kg
-    match_kg = re.search(r'(\d+[,\.]\d+)\s*kg', r, re.IGNORECASE)
-    if match_kg:
-        peso = match_kg.group(1).replace(',', '.')
-        return float(peso), 'kg'
-
-    # Pattern tipo: 2 kg
-    match_kg_int = re.search(r'(\d+)\s*kg', r, re.IGNORECASE)
-    if match_kg_int:
-        peso = int(match_kg_int.group(1))
-        return float(peso), 'kg'
-
-    # Pattern tipo: 1 x 800g = 800g → usiamo 800g
-    match_g_eq = re.search(r'=\s*(\d+)\s*g', r, re.IGNORECASE)
-    if match_g_eq:
-        peso = int(match_g_eq.group(1))
-        return peso, 'g'
-
-    # Pattern tipo: 800g
-    match_g = re.search(r'(\d+)\s*g\b', r, re.IGNORECASE)
-    if match_g:
-        peso = int(match_g.group(1))
-        return peso, 'g'
-
-    # Pattern tipo: "1 x" o "2 x" → interpretato come pezzi/pacchetti
-    match_qty = re.search(r'(\d+)\s*x\b', r, re.IGNORECASE)
-    if match_qty:
-        qty = int(match_qty.group(1))
-        return qty, 'pacchetti'
-
-    # Default: 1 pacchetto
+    # 2) Poi dalla riga di peso/prezzo: vince il primo schema che trova qualcosa
+    r = riga_originale.lower()
+    m = RE_PESO_KG_DECIMALI.search(r) or RE_PESO_KG.search(r)
+    if m:
+        return float(m.group(1).replace(',', '.')), 'kg'
+    m = RE_PESO_UGUALE_G.search(r) or RE_PESO_G.search(r)
+    if m:
+        return int(m.group(1)), 'g'
+    m = RE_PESO_PEZZI.search(r)
+    if m:
+        return int(m.group(1)), 'pacchetti'
     return 1, 'pacchetti'
 
 def identifica_prodotti(testo):
@@ -295,112 +663,150 @@ def identifica_prodotti(testo):
     Identifica i prodotti dal testo dello scontrino usando coppie:
     - riga descrizione (FINOCCHIO, CAPPUCCIO, CAROTE...)
     - riga peso/prezzo subito sotto (0,510 kg x 1,79 EUR/kg...)
+    Ogni riga viene classificata una sola volta da analizza_riga.
     """
-    righe = [r.strip() for r in testo.split('\n') if r.strip()]
+    righe = [analizza_riga(r) for r in map(str.strip, testo.split('\n')) if r]
     prodotti = []
 
-    pattern_prezzo = r'(\d+[,\.]\d{2})\s*€?'
-
     i = 0
     while i < len(righe):
         riga = righe[i]
 
-        # Filtra intestazioni/footer e righe varie
-        keywords_skip = [
-            'totale', 'subtotale', 'resto', 'contante', 'carta',
-            'iva', 'riepilogo', 'digitale', 'acquisto', 'documento',
-            'pagamento', 'importo', 'lidl italia', 'roma', 'via',
-            'raee', 'cdc', 'valore sconti', 'totale complessivo',
-            'rt ', 'doc.', 'documento n.', 'importo pagato'
-        ]
-        if any(k in riga.lower() for k in keywords_skip):
+        # Intestazioni/footer, righe tecniche di peso e righe con prezzo non accoppiate
+        # (spesso sconti) non sono descrizioni di prodotto
+        if riga['tipo'] != 'descrizione':
+            i += 1
+            continue
+
+        nome_pulito = pulisci_nome_prodotto(riga['testo'])
+
+        # Nome troppo corto → scarta
+        if len(nome_pulito) < 3:
             i += 1
             continue
 
-        # Righe tecniche tipo "0,510 kg x 1,79 EUR/kg" NON devono essere trattate qui come prodotto
-        if 'eur/kg' in riga.lower():
+        # Non alimentare? → scarta
+        if not e_prodotto_alimentare(nome_pulito):
             i += 1
             continue
 
-        # Se la riga NON contiene prezzo, la trattiamo come possibile descrizione prodotto
-        if not re.search(pattern_prezzo, riga):
-            nome_originale = riga
-            nome_pulito = pulisci_nome_prodotto(riga)
-
-            # Nome troppo corto → scarta
-            if len(nome_pulito) < 3:
-                i += 1
-                continue
-
-            # Non alimentare? → scarta
-            if not e_prodotto_alimentare(nome_pulito):
-                i += 1
-                continue
-
-            # Trova categoria e range scadenza dal JSON
-            categoria, range_scadenza = trova_categoria_e_range(nome_pulito)
-            scad_fresco, scad_surg = stima_scadenze_da_range(range_scadenza)
-
-            # Default quantità / unità
-            quantita = 1
-            unita = 'pacchetti'
-
-            # Controlla la riga successiva per peso/quantità
-            if i + 1 < len(righe):
-                riga_next = righe[i + 1]
-                # Se contiene kg/g o la forma classica di peso, usiamo quella riga
-                if ('kg' in riga_next.lower() or ' g' in riga_next.lower() or 'eur/kg' in riga_next.lower()):
-                    q, u = estrai_quantita_e_unita(riga_next, nome_originale=nome_originale)
-                    quantita, unita = q, u
-
-                    prodotti.append({
-                        'nome': nome_pulito.title(),
-                        'quantita': quantita,
-                        'unita': unita,
-                        'categoria': categoria,
-                        'range_scadenza': range_scadenza,
-                        'scadenza_suggerita': scad_fresco,
-                        'scadenza_surgelato': scad_surg
-                    })
-
-                    i += 2
-                    continue
+        # Trova categoria e range scadenza dal JSON
+        categoria, range_scadenza = trova_categoria_e_range(nome_pulito)
+        scad_fresco, scad_surg = scadenze_da_range(range_scadenza)
 
+        # Default quantità / unità
+        quantita, unita = 1, 'pacchetti'
+        passo = 1
+
+        if i + 1 < len(righe) and righe[i + 1]['peso_successivo']:
+            # La riga successiva è il peso (kg/g): la quantità nel nome ha comunque la precedenza
+            quantita, unita = estrai_quantita_e_unita(righe[i + 1]['testo'], nome_originale=riga['testo'])
+            passo = 2
+        else:
             # Se non c'è riga successiva utile, prova comunque a estrarre dal nome stesso
-            q_nome, u_nome = estrai_quantita_e_unita_da_nome(nome_originale)
+            q_nome, u_nome = estrai_quantita_e_unita_da_nome(riga['testo'])
             if q_nome is not None:
                 quantita, unita = q_nome, u_nome
 
-            prodotti.append({
-                'nome': nome_pulito.title(),
-                'quantita': quantita,
-                'unita': unita,
-                'categoria': categoria,
-                'range_scadenza': range_scadenza,
-                'scadenza_suggerita': scad_fresco,
-                'scadenza_surgelato': scad_surg
-            })
-            i += 1
-            continue
+        prodotti.append({
+            'nome': nome_pulito.title(),
+            'quantita': quantita,
+            'unita': unita,
+            'categoria': categoria,
+            'range_scadenza': range_scadenza,
+            'scadenza_suggerita': scad_fresco,
+            'scadenza_surgelato': scad_surg
+        })
+        i += passo
+
+    return prodotti
 
-        # Righe con prezzo che non abbiamo accoppiato: spesso sconti o righe tecniche
-        i += 1
+def risultato_affidabile(confidenza, prodotti):
+    return confidenza >= OCR_CONFIDENZA_MINIMA and len(prodotti) >= OCR_PRODOTTI_MINIMI
 
+def leggi_scontrino(contenuto, tempi):
+    """
+    OCR + identificazione prodotti secondo OCR_PROFILO; restituisce (testo, prodotti).
+    In modalità adattiva il profilo accurato viene eseguito solo se quello veloce
+    non dà un risultato affidabile, e vince se trova almeno altrettanti prodotti.
+    """
+    profili = ['veloce', 'accurato'] if OCR_PROFILO == 'adattivo' else [OCR_PROFILO]
+
+    migliore = None
+    for profilo in profili:
+        testo, confidenza = estrai_testo_e_confidenza(contenuto, profilo, tempi)
+        with cronometra(tempi, f'identifica_{profilo}'):
+            prodotti = identifica_prodotti(testo)
+
+        if migliore is None or len(prodotti) >= len(migliore[1]):
+            migliore = (testo, prodotti)
+        if risultato_affidabile(confidenza, prodotti):
+            break
+    return migliore
+
+def analizza_testi_scontrino(testi):
+    """
+    Unisce il testo di più foto consecutive dello stesso scontrino (ognuna
+    ripresa da dove finiva la precedente, di solito con una parte in comune) e ne
+    identifica i prodotti una volta sola: un prodotto con il peso finito nella
+    foto successiva resta un solo prodotto. Stesso formato di analizza_scontrino.
+    """
+    tempi = {}
+    try:
+        testo = unisci_testi_foto(testi)
+        with cronometra(tempi, 'identifica_unione'):
+            prodotti = identifica_prodotti(testo)
+        return {
+            'success': True,
+            'prodotti': prodotti,
+            'testo_completo': testo,
+            'tempi_fasi': tempi
+        }
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e),
+            'tempi_fasi': tempi
+        }
+
+def aggiorna_scadenze(prodotti):
+    """Ricalcola le scadenze suggerite rispetto a oggi (servono per i risultati presi dalla cache)"""
+    for prodotto in prodotti:
+        prodotto['scadenza_suggerita'], prodotto['scadenza_surgelato'] = scadenze_da_range(prodotto.get('range_scadenza', ''))
     return prodotti
 
-def analizza_scontrino(image_path):
-    """Funzione principale per analizzare lo scontrino"""
+def analizza_scontrino(immagine):
+    """
+    Funzione principale per analizzare lo scontrino.
+    `immagine` sono i byte del file caricato (oppure un percorso su disco).
+    'tempi_fasi' riporta la durata in secondi delle fasi eseguite (vuoto se il risultato era in cache).
+    """
+    tempi = {}
     try:
-        testo = estrai_testo_da_scontrino(image_path)
-        prodotti = identifica_prodotti(testo)
+        contenuto = leggi_immagine(immagine)
+        chiave = cache_risultati.chiave(contenuto)
+
+        in_cache = cache_risultati.leggi(chiave)
+        if in_cache is not None:
+            return {
+                'success': True,
+                'prodotti': aggiorna_scadenze([dict(p) for p in in_cache['prodotti']]),
+                'testo_completo': in_cache['testo_completo'],
+                'tempi_fasi': tempi
+            }
+
+        testo, prodotti = leggi_scontrino(contenuto, tempi)
+        cache_risultati.scrivi(chiave, {'prodotti': prodotti, 'testo_completo': testo})
 
         return {
             'success': True,
             'prodotti': prodotti,
-            'testo_completo': testo
+            'testo_completo': testo,
+            'tempi_fasi': tempi
         }
     except Exception as e:
         return {
             'success': False,
-            'error': str(e)
-        }
\ No newline at end of file
+            'error': str(e),
+            'tempi_fasi': tempi
+        }
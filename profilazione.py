@@ -0,0 +1,93 @@
+import cProfile
+import hashlib
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+# ========== PROFILAZIONE DELLE RICHIESTE ==========
+# Disattivata di default: senza PROFILAZIONE_ABILITATA=1 app.py non registra
+# nemmeno gli hook, quindi il costo è nullo. Quando è attiva una richiesta viene
+# profilata con cProfile se ha l'header X-Profila uguale a PROFILAZIONE_TOKEN,
+# oppure a campione con probabilità PROFILAZIONE_CAMPIONAMENTO (0..1).
+# I profili (formato pstats, leggibili con `python -m pstats` o snakeviz)
+# finiscono in PROFILAZIONE_DIR, che tiene solo gli ultimi PROFILAZIONE_MAX_FILE.
+
+PROFILAZIONE_ABILITATA = os.environ.get('PROFILAZIONE_ABILITATA', '0') == '1'
+PROFILAZIONE_TOKEN = os.environ.get('PROFILAZIONE_TOKEN')
+PROFILAZIONE_CAMPIONAMENTO = float(os.environ.get('PROFILAZIONE_CAMPIONAMENTO', '0'))
+PROFILAZIONE_DIR = os.environ.get('PROFILAZIONE_DIR', os.path.join(tempfile.gettempdir(), 'dispensa_profili'))
+PROFILAZIONE_MAX_FILE = int(os.environ.get('PROFILAZIONE_MAX_FILE', '50'))
+
+HEADER_PROFILAZIONE = 'X-Profila'
+
+
+class Profilatore:
+    """Decide quali richieste profilare e salva i profili in una cartella di dimensione limitata."""
+
+    def __init__(self, directory=PROFILAZIONE_DIR, max_file=PROFILAZIONE_MAX_FILE,
+                 campionamento=PROFILAZIONE_CAMPIONAMENTO, token=PROFILAZIONE_TOKEN):
+        self.directory = directory
+        self.max_file = max_file
+        self.campionamento = campionamento
+        self.token = token
+        self._lock = threading.Lock()
+
+    def deve_profilare(self, valore_header):
+        # Senza token configurato l'header è ignorato: chiunque potrebbe attivarlo
+        if self.token and valore_header == self.token:
+            return True
+        return self.campionamento > 0 and random.random() < self.campionamento
+
+    def avvia(self):
+        profilo = cProfile.Profile()
+        try:
+            profilo.enable()
+        except ValueError:
+            # Un altro profiler è già attivo in questo thread
+            return None
+        return profilo
+
+    @staticmethod
+    def _hash_uid(uid):
+        if not uid:
+            return 'anonimo'
+        return hashlib.sha256(uid.encode('utf-8')).hexdigest()[:12]
+
+    def salva(self, profilo, rotta, uid, durata):
+        """Ferma il profilo e lo scrive su disco; restituisce il percorso del file."""
+        profilo.disable()
+        rotta_file = re.sub(r'[^A-Za-z0-9]+', '_', rotta).strip('_') or 'root'
+        nome = (f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}_{rotta_file}_"
+                f"{self._hash_uid(uid)}_{int(durata * 1000)}ms.prof")
+        percorso = os.path.join(self.directory, nome)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profilo.dump_stats(percorso)
+            self._libera_spazio()
+        except OSError as e:
+            print(f"Errore nel salvataggio del profilo: {e}")
+            return None
+        return percorso
+
+    def _libera_spazio(self):
+        """Elimina i profili più vecchi oltre max_file."""
+        with self._lock:
+            try:
+                profili = [
+                    os.path.join(self.directory, nome)
+                    for nome in os.listdir(self.directory) if nome.endswith('.prof')
+                ]
+            except OSError:
+                return
+            if len(profili) <= self.max_file:
+                return
+            profili.sort(key=lambda percorso: os.path.getmtime(percorso) if os.path.exists(percorso) else 0)
+            for percorso in profili[:len(profili) - self.max_file]:
+                try:
+                    os.remove(percorso)
+                except OSError:
+                    pass
@@ -0,0 +1,62 @@
+import threading
+from datetime import date, timedelta
+
+from indice_alimenti import INDICE, giorni_da_range
+
+# ========== SCADENZE SUGGERITE ==========
+# I giorni di scadenza per categoria e per range_scadenza sono calcolati da
+# IndiceAlimenti (e salvati nel suo snapshot): qui restano solo le date da
+# aggiungere a oggi per il prodotto fresco e per quello surgelato.
+# Le date calcolate sono tenute in memoria per la giornata corrente, così
+# arricchire i prodotti di uno scontrino non esegue né regex né strftime.
+
+
+class TabellaScadenze:
+    """Date di scadenza suggerite a partire dai giorni precalcolati dell'indice."""
+
+    def __init__(self, indice):
+        self.per_categoria = indice.giorni_per_categoria
+        # Copia: i range sconosciuti aggiunti a runtime non finiscono nell'indice
+        self.per_range = dict(indice.giorni_per_range)
+        self._date = (None, {})
+        self._lock = threading.Lock()
+
+    def giorni_range(self, range_scadenza):
+        giorni = self.per_range.get(range_scadenza or '')
+        if giorni is None:
+            # Testo che non viene da food_data.json: si legge e si ricorda
+            giorni = giorni_da_range(range_scadenza)
+            with self._lock:
+                self.per_range[range_scadenza] = giorni
+        return giorni
+
+    def giorni_categoria(self, nome_categoria):
+        return self.per_categoria.get(nome_categoria, self.per_range[''])
+
+    def data_tra(self, giorni):
+        """'YYYY-MM-DD' di oggi + giorni; le date valgono fino a mezzanotte."""
+        oggi = date.today()
+        giorno, date_calcolate = self._date
+        if giorno != oggi:
+            date_calcolate = {}
+            self._date = (oggi, date_calcolate)
+        data = date_calcolate.get(giorni)
+        if data is None:
+            data = date_calcolate[giorni] = (oggi + timedelta(days=giorni)).strftime('%Y-%m-%d')
+        return data
+
+    def scadenze_da_range(self, range_scadenza):
+        """(scadenza suggerita, scadenza da surgelato) per un range_scadenza."""
+        fresco, surgelato = self.giorni_range(range_scadenza)
+        return self.data_tra(fresco), self.data_tra(surgelato)
+
+    def scadenze_categoria(self, nome_categoria):
+        """(scadenza suggerita, scadenza da surgelato) per il nome di una categoria."""
+        fresco, surgelato = self.giorni_categoria(nome_categoria)
+        return self.data_tra(fresco), self.data_tra(surgelato)
+
+
+TABELLA_SCADENZE = TabellaScadenze(INDICE)
+
+scadenze_da_range = TABELLA_SCADENZE.scadenze_da_range
+scadenze_categoria = TABELLA_SCADENZE.scadenze_categoria
@@ -0,0 +1,430 @@
+"""
+Benchmark della pipeline OCR degli scontrini.
+
+Misura, per ogni scontrino in uploads/ e in un corpus sintetico generato al volo:
+  - latenza p50/p95 di ogni fase: preprocessa_immagine (e, al suo interno, il
+    ritaglio della carta, decodifica compresa), riconosci_a_strisce (Tesseract), identifica_prodotti
+    e la categorizzazione dei prodotti trovati
+  - picco di memoria (RSS) del processo e dei processi figli (Tesseract)
+  - precision/recall dei prodotti estratti rispetto ai risultati attesi
+    (scripts/benchmark_ocr_golden.json per gli scontrini reali, la lista dei
+    prodotti inseriti per quelli sintetici)
+  - precision/recall di categoria e riconoscimento "alimentare" su nomi di
+    prodotti con un errore d'OCR e su nomi non alimentari simili a prodotti
+    (PENNA/panna, COLLA/cola): un nome non alimentare riconosciuto è un falso positivo
+
+Con --salva-baseline i risultati diventano il riferimento; nelle esecuzioni
+successive lo script esce con codice 1 se una fase è più lenta o meno precisa
+della baseline oltre le soglie. La baseline dei tempi va generata sulla stessa
+macchina su cui si confronta.
+
+Uso (dalla cartella del progetto):
+    python scripts/benchmark_ocr.py
+    python scripts/benchmark_ocr.py --salva-baseline
+    python scripts/benchmark_ocr.py --solo-testo   # senza Tesseract: solo fasi sul testo
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CARTELLA_PROGETTO)
+
+from ocr_processor import (PROFILI_PREPROCESSAMENTO, e_prodotto_alimentare, identifica_prodotti, preprocessa_immagine,
+                           pulisci_nome_prodotto, riconosci_a_strisce)
+from indice_alimenti import food_data, trova_categoria, trova_categoria_e_range
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CARTELLA_UPLOADS = os.path.join(CARTELLA_PROGETTO, 'uploads')
+FILE_GOLDEN = os.path.join(CARTELLA_PROGETTO, 'scripts', 'benchmark_ocr_golden.json')
+FILE_BASELINE = os.path.join(CARTELLA_PROGETTO, 'scripts', 'benchmark_ocr_baseline.json')
+ESTENSIONI_IMMAGINI = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+FASI = ('preprocessa', 'ritaglio', 'ocr', 'identifica', 'categorizza')
+
+# Sotto questa differenza assoluta un p95 più alto è rumore di misura, non una regressione
+TOLLERANZA_MS = 1.0
+
+# ========== CORPUS ==========
+
+RIGHE_INTESTAZIONE = [
+    'RIEPILOGO DIGITALE ACQUISTO',
+    'Supermercato Esempio S.r.l.',
+    'Roma (RM) - cdc 0101',
+    'DESCRIZIONE            IVA  PREZZO(€)',
+]
+RIGHE_NON_ALIMENTARI = [
+    'SACCH.ORTOFR.BIOGRAD',
+    'BUSTE TRASP. A4 50PZ',
+    'APRIBOTTIGLIE-0480764',
+    'SHOPPER PLASTICA',
+]
+# Non alimentari a una lettera (o a una parola secondaria) da un prodotto del catalogo
+NOMI_NON_ALIMENTARI = [
+    'PENNA', 'COLLA', 'SAPONE', 'SPUGNA', 'CESTO', 'CANDELA', 'PETTINE',
+    'TAPPETO', 'MATITA', 'FORBICI', 'LAMPADINA', 'PILE STILO', 'PIATTI',
+    'TOVAGLIOLI', 'DETERSIVO', 'SHAMPOO', 'CANDEGGINA', 'SCOPA', 'SECCHIO',
+    'CALZINI', 'GOMMA', 'RASOIO', 'DENTIFRICIO', 'ACCENDINO', 'SPAZZOLINO',
+    'CEROTTI', 'QUADERNO', 'CUSCINO', 'PANNOLINI', 'SALVIETTE', 'MOLLETTE',
+    'PENNELLO', 'LAMETTE',
+]
+# Lettere che l'OCR scambia, per simulare un nome letto male
+CONFUSIONI_OCR = {'o': '0', 'i': '1', 'l': 'i', 's': '5', 'e': 'c', 'a': 'o', 'n': 'm', 'r': 'n', 'c': 'e'}
+RIGHE_PIEDE = [
+    'SUBTOTALE',
+    'TOTALE COMPLESSIVO',
+    'Pagamento contante',
+    'Resto',
+]
+
+
+def prezzo(rng):
+    return f"{rng.randint(0, 9)},{rng.randint(0, 99):02d}"
+
+
+def scontrino_sintetico(rng, n_prodotti):
+    """
+    Testo di uno scontrino inventato e prodotti che ci si aspetta di estrarne.
+    I prodotti alternano il formato "descrizione + riga peso" a quello con il
+    prezzo sulla stessa riga, come negli scontrini veri.
+    """
+    catalogo = [p for categoria in food_data['categorie_cibi'] for p in categoria['prodotti'] if len(p) >= 4]
+    righe = list(RIGHE_INTESTAZIONE)
+    attesi = []
+    for nome in rng.sample(catalogo, n_prodotti):
+        if rng.random() < 0.5:
+            righe.append(nome.upper())
+            righe.append(f"  {rng.randint(0, 2)},{rng.randint(100, 999)} kg x {prezzo(rng)}  EUR/kg")
+        else:
+            righe.append(f"{nome.upper():<24}4%   {prezzo(rng)}")
+        attesi.append(nome.title())
+        if rng.random() < 0.2:
+            righe.append(f"{rng.choice(RIGHE_NON_ALIMENTARI):<24}22%  {prezzo(rng)}")
+    for riga in RIGHE_PIEDE:
+        righe.append(f"{riga:<30}{prezzo(rng)}")
+    return '\n'.join(righe), attesi
+
+
+def disegna_scontrino(testo):
+    """Rende il testo come immagine PNG in stile scontrino (nero su bianco)"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default(size=28)
+    righe = testo.split('\n')
+    altezza_riga = 36
+    img = Image.new('L', (760, 40 + altezza_riga * len(righe)), 255)
+    disegno = ImageDraw.Draw(img)
+    for i, riga in enumerate(righe):
+        disegno.text((30, 20 + i * altezza_riga), riga, fill=0, font=font)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def carica_golden():
+    try:
+        with open(FILE_GOLDEN, 'r', encoding='utf-8') as f:
+            return {s['sha256']: s['prodotti'] for s in json.load(f)['scontrini']}
+    except FileNotFoundError:
+        return {}
+
+
+def corpus_uploads():
+    """Scontrini caricati (una sola volta per contenuto), con i prodotti attesi se noti"""
+    golden = carica_golden()
+    visti = set()
+    scontrini = []
+    if not os.path.isdir(CARTELLA_UPLOADS):
+        return scontrini
+    for nome in sorted(os.listdir(CARTELLA_UPLOADS)):
+        if not nome.lower().endswith(ESTENSIONI_IMMAGINI):
+            continue
+        with open(os.path.join(CARTELLA_UPLOADS, nome), 'rb') as f:
+            contenuto = f.read()
+        sha = hashlib.sha256(contenuto).hexdigest()
+        if sha in visti:
+            continue
+        visti.add(sha)
+        scontrini.append({
+            'nome': nome,
+            'corpus': 'uploads',
+            'contenuto': contenuto,
+            'testo': None,
+            'attesi': golden.get(sha)
+        })
+    return scontrini
+
+
+def corpus_sintetico(n_scontrini, seme, con_immagini=True):
+    rng = random.Random(seme)
+    scontrini = []
+    for i in range(n_scontrini):
+        testo, attesi = scontrino_sintetico(rng, rng.randint(8, 20))
+        scontrini.append({
+            'nome': f"sintetico_{i:02d}",
+            'corpus': 'sintetico',
+            'contenuto': disegna_scontrino(testo) if con_immagini else None,
+            'testo': testo,
+            'attesi': attesi
+        })
+    return scontrini
+
+
+def nome_letto_male(rng, nome):
+    """Il nome con un carattere della prima parola scambiato come farebbe l'OCR"""
+    prima = nome.split(' ', 1)[0]
+    posizioni = [i for i, c in enumerate(prima) if c in CONFUSIONI_OCR]
+    if not posizioni:
+        return nome
+    i = rng.choice(posizioni)
+    return nome[:i] + CONFUSIONI_OCR[nome[i]] + nome[i + 1:]
+
+
+def corpus_nomi(seme):
+    """[(nome in maiuscolo, categoria attesa o None se non alimentare)]"""
+    rng = random.Random(seme)
+    categorie = {}
+    for categoria in food_data['categorie_cibi']:
+        for prodotto in categoria['prodotti']:
+            categorie.setdefault(prodotto.lower().strip(), categoria['nome_categoria'])
+    nomi = [(nome_letto_male(rng, p).upper(), c) for p, c in categorie.items() if len(p) >= 5]
+    return nomi + [(nome, None) for nome in NOMI_NON_ALIMENTARI]
+
+# ========== MISURE ==========
+
+def cronometra(tempi, fase, funzione, *args):
+    inizio = time.perf_counter()
+    risultato = funzione(*args)
+    tempi.setdefault(fase, []).append((time.perf_counter() - inizio) * 1000)
+    return risultato
+
+
+def categorizza(prodotti):
+    return [trova_categoria(p['nome']) for p in prodotti]
+
+
+def esegui_scontrino(scontrino, tempi, solo_testo, profilo):
+    """Esegue le fasi su uno scontrino e restituisce i prodotti estratti"""
+    if solo_testo:
+        testo = scontrino['testo']
+    else:
+        fasi_interne = {}
+        img = cronometra(tempi, 'preprocessa', preprocessa_immagine, scontrino['contenuto'], profilo, fasi_interne)
+        if f'ritaglio_{profilo}' in fasi_interne:
+            tempi.setdefault('ritaglio', []).append(fasi_interne[f'ritaglio_{profilo}'] * 1000)
+        testo, _ = cronometra(tempi, 'ocr', riconosci_a_strisce, img)
+    prodotti = cronometra(tempi, 'identifica', identifica_prodotti, testo)
+    cronometra(tempi, 'categorizza', categorizza, prodotti)
+    return prodotti
+
+
+def normalizza(nome):
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in pulisci_nome_prodotto(nome).lower()).split())
+
+
+def confronta(estratti, attesi):
+    """Prodotti corretti, estratti e attesi (confronto per nome normalizzato, con ripetizioni)"""
+    trovati = Counter(normalizza(p['nome']) for p in estratti)
+    veri = Counter(normalizza(nome) for nome in attesi)
+    corretti = sum((trovati & veri).values())
+    return corretti, sum(trovati.values()), sum(veri.values())
+
+
+def confronta_nomi(nomi):
+    """
+    [corretti, estratti, attesi] per la categoria ('nomi_categoria', estratto =
+    categoria diversa da 'altro') e per il riconoscimento come alimento
+    ('nomi_alimentari') dei nomi di corpus_nomi
+    """
+    totali = {'nomi_categoria': [0, 0, 0], 'nomi_alimentari': [0, 0, 0]}
+    for nome, atteso in nomi:
+        categoria = trova_categoria_e_range(nome)[0]
+        alimentare = e_prodotto_alimentare(pulisci_nome_prodotto(nome))
+        for corpus, estratto, corretto in (
+            ('nomi_categoria', categoria != 'altro', atteso is not None and categoria == atteso),
+            ('nomi_alimentari', alimentare, atteso is not None and alimentare),
+        ):
+            totale = totali[corpus]
+            totale[0] += corretto
+            totale[1] += estratto
+            totale[2] += atteso is not None
+    return totali
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    if not ordinati:
+        return None
+    # nearest-rank
+    return ordinati[max(0, math.ceil(p / 100 * len(ordinati)) - 1)]
+
+
+def picco_rss_mb():
+    """Picco di memoria residente di questo processo e dei figli (Tesseract), in MB"""
+    if resource is None:
+        return None, None
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    divisore = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    processo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisore
+    figli = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisore
+    return round(processo, 1), round(figli, 1)
+
+
+def esegui_benchmark(scontrini, nomi, ripetizioni, solo_testo, profilo):
+    tempi = {}
+    accuratezza = confronta_nomi(nomi)
+    for scontrino in scontrini:
+        prodotti = None
+        for _ in range(ripetizioni):
+            prodotti = esegui_scontrino(scontrino, tempi, solo_testo, profilo)
+        if scontrino['attesi'] is None:
+            continue
+        corretti, estratti, attesi = confronta(prodotti, scontrino['attesi'])
+        totale = accuratezza.setdefault(scontrino['corpus'], [0, 0, 0])
+        totale[0] += corretti
+        totale[1] += estratti
+        totale[2] += attesi
+
+    processo, figli = picco_rss_mb()
+    risultati = {
+        'fasi': {
+            fase: {
+                'p50_ms': round(percentile(valori, 50), 3),
+                'p95_ms': round(percentile(valori, 95), 3),
+                'campioni': len(valori)
+            }
+            for fase, valori in tempi.items()
+        },
+        'accuratezza': {
+            corpus: {
+                'precision': round(corretti / estratti, 4) if estratti else 0.0,
+                'recall': round(corretti / attesi, 4) if attesi else 0.0,
+                'prodotti_estratti': estratti,
+                'prodotti_attesi': attesi
+            }
+            for corpus, (corretti, estratti, attesi) in accuratezza.items()
+        },
+        'picco_rss_mb': {'processo': processo, 'figli': figli},
+        'solo_testo': solo_testo,
+        'profilo': None if solo_testo else profilo
+    }
+    return risultati
+
+# ========== CONFRONTO CON LA BASELINE ==========
+
+def regressioni(risultati, baseline, soglia_tempo, soglia_accuratezza, soglia_memoria):
+    """Elenco (testuale) delle regressioni rispetto alla baseline"""
+    problemi = []
+    for fase, misure in risultati['fasi'].items():
+        riferimento = baseline.get('fasi', {}).get(fase)
+        if not riferimento:
+            continue
+        limite = max(riferimento['p95_ms'] * (1 + soglia_tempo), riferimento['p95_ms'] + TOLLERANZA_MS)
+        if misure['p95_ms'] > limite:
+            problemi.append(f"{fase}: p95 {misure['p95_ms']:.1f} ms (baseline {riferimento['p95_ms']:.1f} ms)")
+
+    for corpus, misure in risultati['accuratezza'].items():
+        riferimento = baseline.get('accuratezza', {}).get(corpus)
+        if not riferimento:
+            continue
+        for metrica in ('precision', 'recall'):
+            if misure[metrica] < riferimento[metrica] - soglia_accuratezza:
+                problemi.append(f"{corpus}: {metrica} {misure[metrica]:.3f} (baseline {riferimento[metrica]:.3f})")
+
+    picco = risultati['picco_rss_mb']['processo']
+    picco_baseline = baseline.get('picco_rss_mb', {}).get('processo')
+    if picco and picco_baseline and picco > picco_baseline * (1 + soglia_memoria):
+        problemi.append(f"picco RSS {picco:.0f} MB (baseline {picco_baseline:.0f} MB)")
+    return problemi
+
+
+def stampa_risultati(risultati):
+    print(f"{'fase':<12}{'p50 (ms)':>12}{'p95 (ms)':>12}{'campioni':>10}")
+    for fase in FASI:
+        misure = risultati['fasi'].get(fase)
+        if misure:
+            print(f"{fase:<12}{misure['p50_ms']:>12.2f}{misure['p95_ms']:>12.2f}{misure['campioni']:>10}")
+    print()
+    for corpus, misure in risultati['accuratezza'].items():
+        print(f"{corpus}: precision {misure['precision']:.3f}, recall {misure['recall']:.3f} "
+              f"({misure['prodotti_estratti']} estratti, {misure['prodotti_attesi']} attesi)")
+    picco = risultati['picco_rss_mb']
+    if picco['processo'] is not None:
+        print(f"Picco RSS: {picco['processo']} MB (processi figli: {picco['figli']} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark della pipeline OCR degli scontrini")
+    parser.add_argument('--ripetizioni', type=int, default=3, help="esecuzioni per scontrino (default 3)")
+    parser.add_argument('--sintetici', type=int, default=10, help="scontrini sintetici da generare (default 10)")
+    parser.add_argument('--seme', type=int, default=42, help="seme del corpus sintetico")
+    parser.add_argument('--solo-testo', action='store_true',
+                        help="misura solo le fasi sul testo, sul corpus sintetico (non serve Tesseract)")
+    parser.add_argument('--profilo', choices=sorted(PROFILI_PREPROCESSAMENTO), default='accurato',
+                        help="profilo di preprocessing da misurare (default accurato)")
+    parser.add_argument('--baseline', default=FILE_BASELINE, help="file della baseline")
+    parser.add_argument('--salva-baseline', action='store_true', help="salva i risultati come nuova baseline")
+    parser.add_argument('--soglia-tempo', type=float, default=0.20, help="peggioramento massimo del p95 (default 0.20 = +20%%)")
+    parser.add_argument('--soglia-accuratezza', type=float, default=0.02, help="calo massimo di precision/recall (default 0.02)")
+    parser.add_argument('--soglia-memoria', type=float, default=0.20, help="aumento massimo del picco RSS (default 0.20)")
+    parser.add_argument('--output', help="scrive anche i risultati in JSON su questo file")
+    args = parser.parse_args()
+
+    if args.solo_testo:
+        scontrini = corpus_sintetico(args.sintetici, args.seme, con_immagini=False)
+    else:
+        import pytesseract
+        try:
+            pytesseract.get_tesseract_version()
+        except pytesseract.TesseractNotFoundError:
+            print("Tesseract non trovato: installalo oppure usa --solo-testo")
+            return 2
+        scontrini = corpus_uploads() + corpus_sintetico(args.sintetici, args.seme)
+
+    risultati = esegui_benchmark(scontrini, corpus_nomi(args.seme), args.ripetizioni, args.solo_testo, args.profilo)
+    stampa_risultati(risultati)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(risultati, f, indent=2)
+
+    if args.salva_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(risultati, f, indent=2)
+        print(f"\nBaseline salvata in {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print("\nNessuna baseline: esegui con --salva-baseline per crearla")
+        return 0
+
+    if baseline.get('solo_testo') != risultati['solo_testo'] or baseline.get('profilo') != risultati['profilo']:
+        print("\nBaseline generata con una modalità diversa (--solo-testo o --profilo): confronto saltato")
+        return 0
+
+    problemi = regressioni(risultati, baseline, args.soglia_tempo, args.soglia_accuratezza, args.soglia_memoria)
+    if problemi:
+        print("\nREGRESSIONI rispetto alla baseline:")
+        for problema in problemi:
+            print(f"  - {problema}")
+        return 1
+    print("\nNessuna regressione rispetto alla baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Test di carico del livello web (Flask), senza Firebase.
+
+Avvia `app` con l'archivio SQLite locale e auth.verify_id_token sostituito da
+una verifica finta (il cookie 'token' è direttamente l'uid), popola utenti con
+dispense di dimensioni diverse e ripete un mix realistico di richieste:
+/home, /dispensa/<nome>, /aggiungi, /sposta_in_lista_spesa e /analizza_scontrino.
+
+Per ogni dimensione riporta il throughput, i percentili di latenza per rotta e
+le chiamate all'archivio (letture, scritture, commit) per richiesta.
+Le richieste sono eseguite una alla volta nello stesso processo: è il carico
+massimo di un worker gunicorn sincrono, esclusi rete e parsing HTTP.
+
+Uso (dalla cartella del progetto):
+    python scripts/carico_web.py
+    python scripts/carico_web.py --dimensioni 10,500,5000 --richieste 2000
+    python scripts/carico_web.py --ocr reale   # /analizza_scontrino con Tesseract vero
+"""
+import argparse
+import io
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CARTELLA_PROGETTO)
+
+# Prima di importare app: archivio locale, nessun thread di pulizia né preriscaldamento OCR,
+# analisi nel processo stesso (così l'OCR finto sostituito qui sotto è quello usato)
+os.environ['DISPENSA_ARCHIVIO'] = 'sqlite'
+os.environ['PULIZIA_SCADUTI_INTERVALLO_MINUTI'] = '0'
+os.environ['OCR_PRERISCALDA'] = '0'
+os.environ['OCR_PROCESSO_DEDICATO'] = '0'
+
+import metriche
+
+NOMI_DISPENSE = ['Frigo', 'Freezer', 'Dispensa', 'Cantina', 'Ufficio']
+
+# Peso relativo di ogni rotta nel mix di richieste
+MIX_RICHIESTE = {
+    'home': 30,
+    'dispensa': 30,
+    'aggiungi': 25,
+    'sposta_in_lista_spesa': 10,
+    'analizza_scontrino': 5,
+}
+
+TESTO_SCONTRINO_FINTO = """RIEPILOGO DIGITALE ACQUISTO
+FINOCCHIO
+  0,510 kg x 1,79  EUR/kg
+CAPPUCCIO
+  2,422 kg x 0,99  EUR/kg
+MOZZARELLA
+CAROTE IGP 800G
+TOTALE COMPLESSIVO     12,56"""
+
+
+def verifica_token_finta(id_token, *args, **kwargs):
+    return {'uid': id_token, 'exp': time.time() + 3600}
+
+
+def conta_chiamate():
+    """
+    Letture, scritture e commit sull'archivio finora, dai contatori di
+    metriche.misura_archivio (app.py misura già il proprio archivio).
+    """
+    totali = metriche.OPERAZIONI_ARCHIVIO.totali_per('tipo')
+    return Counter({'letture': totali['lettura'], 'scritture': totali['scrittura'], 'commit': totali['commit']})
+
+
+def catalogo_alimenti(food_data):
+    return [(p, c['nome_categoria']) for c in food_data['categorie_cibi'] for p in c['prodotti']]
+
+
+def popola_utente(archivio, uid, n_alimenti, catalogo, rng):
+    """Crea le dispense dell'utente con `n_alimenti` distribuiti a caso; ~2% già scaduti"""
+    oggi = date.today()
+    dispense = {nome: {} for nome in NOMI_DISPENSE}
+    # Gli scaduti finiscono nella lista 'Prodotti Scaduti' alla prima visita: non vanno spostati
+    non_scaduti = {nome: [] for nome in NOMI_DISPENSE}
+    for i in range(n_alimenti):
+        prodotto, categoria = rng.choice(catalogo)
+        giorni = rng.randint(-30, -1) if rng.random() < 0.02 else rng.randint(1, 365)
+        nome_dispensa = rng.choice(NOMI_DISPENSE)
+        nome_alimento = f"{prodotto} {i}"
+        dispense[nome_dispensa][nome_alimento] = {
+            'quantita': rng.randint(1, 5),
+            'unita': 'pz',
+            'categoria': categoria,
+            'tipo': 'alimento',
+            'scadenza': (oggi + timedelta(days=giorni)).strftime('%Y-%m-%d')
+        }
+        if giorni > 0:
+            non_scaduti[nome_dispensa].append(nome_alimento)
+    batch = archivio.nuovo_batch()
+    for nome, alimenti in dispense.items():
+        archivio.salva_dispensa(batch, uid, nome, alimenti)
+    batch.commit()
+    return non_scaduti
+
+
+class Utente:
+    """Client di un utente e nomi degli alimenti che dovrebbero essere nelle sue dispense"""
+
+    def __init__(self, app, uid, alimenti, rng, immagine):
+        self.client = app.test_client()
+        self.client.set_cookie('token', uid)
+        self.alimenti = alimenti
+        self.rng = rng
+        self.immagine = immagine
+        self.contatore = 0
+
+    def richiesta(self, rotta):
+        dispensa = self.rng.choice(NOMI_DISPENSE)
+        if rotta == 'home':
+            return self.client.get('/home')
+        if rotta == 'dispensa':
+            return self.client.get(f'/dispensa/{dispensa}')
+        if rotta == 'aggiungi':
+            self.contatore += 1
+            nome = f"prodotto carico {self.contatore}"
+            self.alimenti[dispensa].append(nome)
+            return self.client.post('/aggiungi', data={
+                'nome_dispensa': dispensa,
+                'nome_alimento': nome,
+                'quantita': '1',
+                'unita': 'pz',
+                'scadenza': (date.today() + timedelta(days=30)).strftime('%Y-%m-%d')
+            }, headers={'X-Requested-With': 'XMLHttpRequest'})
+        if rotta == 'sposta_in_lista_spesa':
+            if not self.alimenti[dispensa]:
+                return self.client.get(f'/dispensa/{dispensa}')
+            nome = self.alimenti[dispensa].pop(self.rng.randrange(len(self.alimenti[dispensa])))
+            return self.client.post('/sposta_in_lista_spesa', data={
+                'nome_dispensa': dispensa,
+                'nome_alimento': nome,
+                'lista_destinazione': 'Spesa'
+            })
+        if rotta == 'analizza_scontrino':
+            return self.client.post('/analizza_scontrino', data={
+                'scontrino': (io.BytesIO(self.immagine), 'scontrino.png')
+            }, content_type='multipart/form-data')
+        raise ValueError(rotta)
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    # nearest-rank
+    return ordinati[max(0, math.ceil(p / 100 * len(ordinati)) - 1)]
+
+
+def esegui(app, archivio, n_alimenti, n_utenti, n_richieste, riscaldamento, catalogo, rng, immagine):
+    utenti = []
+    for i in range(n_utenti):
+        uid = f"carico_{n_alimenti}_{i}"
+        alimenti = popola_utente(archivio, uid, n_alimenti, catalogo, rng)
+        utenti.append(Utente(app, uid, alimenti, rng, immagine))
+
+    rotte = list(MIX_RICHIESTE)
+    pesi = [MIX_RICHIESTE[r] for r in rotte]
+
+    # Le prime richieste (pulizia scaduti del giorno, cache dei template...) non vengono misurate
+    for _ in range(riscaldamento):
+        rng.choice(utenti).richiesta(rng.choices(rotte, pesi)[0])
+
+    latenze = defaultdict(list)
+    chiamate = defaultdict(Counter)
+    errori = Counter()
+    inizio = time.perf_counter()
+    for _ in range(n_richieste):
+        rotta = rng.choices(rotte, pesi)[0]
+        prima = conta_chiamate()
+        t0 = time.perf_counter()
+        risposta = rng.choice(utenti).richiesta(rotta)
+        latenze[rotta].append((time.perf_counter() - t0) * 1000)
+        chiamate[rotta].update(conta_chiamate() - prima)
+        if risposta.status_code >= 400:
+            errori[rotta] += 1
+    durata = time.perf_counter() - inizio
+
+    return {
+        'throughput': n_richieste / durata,
+        'latenze': latenze,
+        'chiamate': chiamate,
+        'errori': errori,
+    }
+
+
+def stampa(n_alimenti, risultati):
+    tutte = [v for valori in risultati['latenze'].values() for v in valori]
+    print(f"\n=== {n_alimenti} alimenti per utente: {risultati['throughput']:.1f} richieste/s, "
+          f"p50 {percentile(tutte, 50):.2f} ms, p95 {percentile(tutte, 95):.2f} ms, p99 {percentile(tutte, 99):.2f} ms")
+    print(f"{'rotta':<24}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'letture':>10}{'scritture':>11}{'commit':>8}{'errori':>8}")
+    for rotta in MIX_RICHIESTE:
+        valori = risultati['latenze'].get(rotta)
+        if not valori:
+            continue
+        n = len(valori)
+        chiamate = risultati['chiamate'][rotta]
+        print(f"{rotta:<24}{n:>6}{percentile(valori, 50):>10.2f}{percentile(valori, 95):>10.2f}"
+              f"{percentile(valori, 99):>10.2f}{chiamate['letture'] / n:>10.2f}{chiamate['scritture'] / n:>11.2f}"
+              f"{chiamate['commit'] / n:>8.2f}{risultati['errori'][rotta]:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico del livello web con archivio SQLite e auth finta")
+    parser.add_argument('--dimensioni', default='10,100,1000,5000', help="alimenti per utente, separati da virgola")
+    parser.add_argument('--utenti', type=int, default=5, help="utenti per dimensione (default 5)")
+    parser.add_argument('--richieste', type=int, default=1000, help="richieste misurate per dimensione (default 1000)")
+    parser.add_argument('--riscaldamento', type=int, default=50, help="richieste iniziali non misurate (default 50)")
+    parser.add_argument('--ocr', choices=('finto', 'reale'), default='finto',
+                        help="'finto' sostituisce Tesseract con un testo fisso, così si misura solo il livello web")
+    parser.add_argument('--sqlite-path', default=':memory:', help="file del database SQLite (default in memoria)")
+    parser.add_argument('--seme', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['DISPENSA_SQLITE_PATH'] = args.sqlite_path
+
+    from firebase_admin import auth
+    auth.verify_id_token = verifica_token_finta
+
+    import app as modulo_app
+    from indice_alimenti import food_data
+
+    import ocr_processor
+    from benchmark_ocr import disegna_scontrino
+    if args.ocr == 'finto':
+        ocr_processor.riconosci_testo_e_confidenza = lambda img: (TESTO_SCONTRINO_FINTO, 100.0)
+    # Senza cache ogni richiesta esegue davvero l'analisi
+    ocr_processor.cache_risultati.max_voci_memoria = 0
+    ocr_processor.cache_risultati.max_byte_disco = 0
+
+    modulo_app.app.logger.disabled = True
+
+    rng = random.Random(args.seme)
+    catalogo = catalogo_alimenti(food_data)
+    immagine = disegna_scontrino(TESTO_SCONTRINO_FINTO)
+    for n_alimenti in (int(d) for d in args.dimensioni.split(',')):
+        risultati = esegui(modulo_app.app, modulo_app.archivio, n_alimenti, args.utenti,
+                           args.richieste, args.riscaldamento, catalogo, rng, immagine)
+        stampa(n_alimenti, risultati)
+
+
+if __name__ == '__main__':
+    main()
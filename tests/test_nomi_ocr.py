@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from ocr_processor import e_prodotto_alimentare, identifica_prodotti
+
+
+@pytest.mark.parametrize('nome', ['MOZZAREILA', 'M0ZZARELLA', 'ZUCCHIME', 'POMODORl'])
+def test_nomi_letti_male_restano_alimentari(nome):
+    assert e_prodotto_alimentare(nome)
+
+
+@pytest.mark.parametrize('nome', ['PENNA', 'COLLA', 'SAPONE', 'SPUGNA', 'CESTO'])
+def test_non_alimentari_vicini_a_un_prodotto_scartati(nome):
+    assert not e_prodotto_alimentare(nome)
+
+
+def test_categoria_dal_match_approssimato():
+    prodotti = identifica_prodotti('MOZZAREILA BIO\nP0M0D0Ri CILIEGINO')
+    assert [p['categoria'] for p in prodotti] == ['latticini', 'verdura']
@@ -0,0 +1,46 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_processor import analizza_testi_scontrino, unisci_testi_foto
+
+FAGIOLI = 'FAGIOLI BORLOTTI\n  0,500 kg x 2,00 EUR/kg'
+
+
+def nomi_prodotti(testi):
+    risultato = analizza_testi_scontrino(testi)
+    assert risultato['success']
+    return [p['nome'] for p in risultato['prodotti']]
+
+
+def test_foto_senza_righe_in_comune_vengono_accodate():
+    testi = [
+        'FINOCCHIO\n  0,510 kg x 1,79 EUR/kg\nMANGO\n  0,450 kg x 2,99 EUR/kg',
+        'PATATE\n  0,460 kg x 2,49 EUR/kg\nCAROTE\n  1,200 kg x 0,99 EUR/kg',
+    ]
+    assert nomi_prodotti(testi) == ['Finocchio', 'Mango', 'Patate', 'Carote']
+
+
+def test_prodotto_ripetuto_a_cavallo_delle_foto_non_si_perde():
+    testi = [
+        'FINOCCHIO\n  0,510 kg x 1,79 EUR/kg\n' + FAGIOLI + '\n' + FAGIOLI,
+        FAGIOLI + '\nPATATE\n  0,460 kg x 2,49 EUR/kg',
+    ]
+    assert nomi_prodotti(testi).count('Fagioli Borlotti') == 3
+
+
+def test_parte_ripresa_in_entrambe_le_foto_viene_tolta():
+    testi = [
+        'FINOCCHIO\n  0,510 kg x 1,79 EUR/kg\nMANGO\n  0,450 kg x 2,99 EUR/kg',
+        'Finocchio\n0,510 kg  x 1,79 EUR/kg\nMANGO\n  0,450 kg x 2,99 EUR/kg\nPATATE\n  0,460 kg x 2,49 EUR/kg',
+    ]
+    assert nomi_prodotti(testi) == ['Finocchio', 'Mango', 'Patate']
+
+
+def test_righe_in_comune_diverse_solo_in_una_cifra_non_sono_sovrapposte():
+    testi = [
+        'MANGO\n  0,450 kg x 2,99 EUR/kg\nPATATE\n  0,460 kg x 2,49 EUR/kg',
+        'MANGO\n  0,450 kg x 2,99 EUR/kg\nPATATE\n  0,480 kg x 2,49 EUR/kg',
+    ]
+    assert unisci_testi_foto(testi).count('PATATE') == 2
@@ -0,0 +1,176 @@
+# ========== UNITÀ DI LAVORO PER LE DISPENSE ==========
+# Durante una richiesta le dispense di un utente vengono lette al massimo una
+# volta; le modifiche restano in memoria e al commit si scrivono solo i
+# documenti effettivamente cambiati, tutti in un unico batch atomico.
+# Le modifiche ai singoli alimenti diventano scritture per campo
+# ('alimenti.<nome>'), senza caricare né riscrivere l'intera dispensa.
+
+
+class UnitaDiLavoroDispense:
+    """
+    Dispense di un utente per la durata di una richiesta.
+    Funzioni di accesso ai dati (in app.py: carica_dispense_utente, ecc.):
+    - `carica(uid)` -> {nome_dispensa: alimenti}
+    - `carica_alimento(uid, nome_dispensa, nome_alimento)` -> dati o None
+    - `salva(uid, nome, alimenti, batch)` riscrive l'intera dispensa
+    - `salva_alimenti(uid, nome, modifiche, alimenti, batch)` scrive solo gli
+      alimenti in `modifiche` ({nome_alimento: dati, oppure None per eliminarlo});
+      `alimenti` è il contenuto completo se in memoria, altrimenti None
+    - `elimina(uid, nome, batch)`
+    `crea_batch()` restituisce un batch di scrittura con metodo commit().
+    """
+
+    def __init__(self, uid, carica, carica_alimento, salva, salva_alimenti, elimina, crea_batch):
+        self.uid = uid
+        self._carica = carica
+        self._carica_alimento = carica_alimento
+        self._salva = salva
+        self._salva_alimenti = salva_alimenti
+        self._elimina = elimina
+        self._crea_batch = crea_batch
+        self._operazioni = []
+        self._dopo_commit = []
+        self._dispense = {}
+        self._completo = False
+        self._modificate = set()
+        self._eliminate = set()
+        self._alimenti_modificati = {}
+
+    def dispense(self):
+        """Dizionario nome_dispensa -> alimenti, caricato alla prima chiamata."""
+        if not self._completo:
+            caricate = self._carica(self.uid)
+            # Le dispense già lette (o modificate) in questa richiesta hanno la precedenza
+            caricate.update(self._dispense)
+            for nome in self._eliminate:
+                caricate.pop(nome, None)
+            # Alimenti modificati prima del caricamento completo
+            for nome, modifiche in self._alimenti_modificati.items():
+                alimenti = caricate.setdefault(nome, {})
+                for nome_alimento, dati in modifiche.items():
+                    if dati is None:
+                        alimenti.pop(nome_alimento, None)
+                    else:
+                        alimenti[nome_alimento] = dati
+            self._dispense = caricate
+            self._completo = True
+        return self._dispense
+
+    def caricata(self):
+        """True se tutte le dispense sono già in memoria."""
+        return self._completo
+
+    def registra(self, dispense):
+        """
+        Aggiunge dispense lette a parte (es. da una query mirata) senza caricare
+        tutte le altre; restituisce la vista {nome: alimenti} su quelle registrate.
+        """
+        for nome, alimenti in dispense.items():
+            if nome not in self._dispense and nome not in self._eliminate and nome not in self._alimenti_modificati:
+                self._dispense[nome] = alimenti
+        return {nome: self._dispense[nome] for nome in dispense if nome in self._dispense}
+
+    def crea_dispensa(self, nome):
+        dispense = self.dispense()
+        if nome not in dispense:
+            dispense[nome] = {}
+            self._segna(nome)
+        return dispense[nome]
+
+    def imposta_alimento(self, nome_dispensa, nome_alimento, dati):
+        if nome_dispensa in self._eliminate:
+            # Dispensa eliminata e ricreata nella stessa richiesta: va riscritta per intero
+            self._dispense[nome_dispensa] = {nome_alimento: dati}
+            self._segna(nome_dispensa)
+            return
+
+        alimenti = self._dispense.get(nome_dispensa)
+        if alimenti is None and self._completo:
+            alimenti = self._dispense[nome_dispensa] = {}
+        if alimenti is not None:
+            alimenti[nome_alimento] = dati
+        self._registra_modifica(nome_dispensa, nome_alimento, dati)
+
+    def rimuovi_alimento(self, nome_dispensa, nome_alimento):
+        """Rimuove e restituisce i dati dell'alimento, oppure None se non presente."""
+        alimenti = self._dispense.get(nome_dispensa)
+        if alimenti is not None:
+            dati = alimenti.pop(nome_alimento, None)
+        elif self._completo or nome_dispensa in self._eliminate:
+            dati = None
+        else:
+            # Dispensa non in memoria: basta leggere il solo alimento
+            dati = self._alimento_non_caricato(nome_dispensa, nome_alimento)
+
+        if dati is None:
+            return None
+        self._registra_modifica(nome_dispensa, nome_alimento, None)
+        return dati
+
+    def _alimento_non_caricato(self, nome_dispensa, nome_alimento):
+        modifiche = self._alimenti_modificati.get(nome_dispensa, {})
+        if nome_alimento in modifiche:
+            return modifiche[nome_alimento]
+        return self._carica_alimento(self.uid, nome_dispensa, nome_alimento)
+
+    def sostituisci_dispensa(self, nome, alimenti):
+        self._dispense[nome] = alimenti
+        self._segna(nome)
+
+    def elimina_dispensa(self, nome):
+        self._dispense.pop(nome, None)
+        self._modificate.discard(nome)
+        self._alimenti_modificati.pop(nome, None)
+        self._eliminate.add(nome)
+
+    def _segna(self, nome):
+        self._eliminate.discard(nome)
+        self._alimenti_modificati.pop(nome, None)
+        self._modificate.add(nome)
+
+    def _registra_modifica(self, nome_dispensa, nome_alimento, dati):
+        if nome_dispensa in self._modificate:
+            return  # la dispensa sarà comunque riscritta per intero
+        self._alimenti_modificati.setdefault(nome_dispensa, {})[nome_alimento] = dati
+
+    def in_commit(self, operazione):
+        """Registra `operazione(batch)`: altre scritture (es. liste spesa) da includere nello stesso commit."""
+        self._operazioni.append(operazione)
+
+    def dopo_commit(self, funzione):
+        """Registra `funzione()` da eseguire solo se il prossimo commit va a buon fine."""
+        self._dopo_commit.append(funzione)
+
+    def ha_modifiche(self):
+        return bool(self._modificate or self._eliminate or self._alimenti_modificati or self._operazioni)
+
+    def commit(self):
+        """
+        Scrive in un solo batch le dispense eliminate o riscritte, gli alimenti
+        modificati e le operazioni registrate; restituisce True se il commit è
+        andato a buon fine.
+        """
+        batch = self._crea_batch()
+        for nome in sorted(self._eliminate):
+            self._elimina(self.uid, nome, batch)
+        for nome in sorted(self._modificate):
+            self._salva(self.uid, nome, self._dispense[nome], batch)
+        for nome in sorted(self._alimenti_modificati):
+            self._salva_alimenti(self.uid, nome, self._alimenti_modificati[nome], self._dispense.get(nome), batch)
+        for operazione in self._operazioni:
+            operazione(batch)
+
+        self._modificate.clear()
+        self._eliminate.clear()
+        self._alimenti_modificati.clear()
+        self._operazioni = []
+        dopo_commit, self._dopo_commit = self._dopo_commit, []
+
+        try:
+            batch.commit()
+        except Exception as e:
+            print(f"Errore nel salvataggio delle dispense: {e}")
+            return False
+        for funzione in dopo_commit:
+            funzione()
+        return True